@@ -2,8 +2,13 @@ from flask import Flask
 from flask_cors import CORS
 from config import Config
 from .extensions import db, login_manager, jwt, migrate
-from .routes import auth, rag, admin, documents
-from .middleware import check_if_user_deleted
+from .routes import auth, rag, admin, documents, metrics
+from .middleware import load_principal
+from .services.rag_registry import RAGRegistry
+from .services.answer_cache import AnswerCache
+from .services.ingestion import IngestionQueue
+from .services.principals import PrincipalCache
+from .utils.metrics import register_collector
 import redis
 
 def create_app():
@@ -19,11 +24,36 @@ def create_app():
     # 设置Redis用于JWT令牌撤销
     app.redis = redis.StrictRedis.from_url(app.config['REDIS_URL'])
 
+    # 进程内共享的各组织 RAG 实例缓存，避免每个请求都从磁盘重新加载索引
+    app.rag_registry = RAGRegistry(
+        max_entries=app.config['RAG_CACHE_MAX_ORGANIZATIONS'],
+        memory_budget=app.config['RAG_CACHE_MEMORY_BUDGET_MB'] * 1024 * 1024
+    )
+    app.answer_cache = AnswerCache(
+        app.redis,
+        ttl=app.config['ANSWER_CACHE_TTL'],
+        similarity_threshold=app.config['ANSWER_CACHE_SIMILARITY_THRESHOLD']
+    )
+    # 上传的文档由后台任务解析和建立索引
+    app.ingestion_queue = IngestionQueue(app.redis)
+    # 每个请求的用户身份取自访问令牌中的声明，用户被修改或删除后改从数据库加载
+    app.principals = PrincipalCache(
+        app.redis,
+        ttl=app.config['PRINCIPAL_CACHE_TTL'],
+        max_age=app.config['JWT_ACCESS_TOKEN_EXPIRES'].total_seconds()
+    )
+
     app.register_blueprint(auth.bp, url_prefix='/api/auth')
     app.register_blueprint(rag.bp, url_prefix='/api/rag')
     app.register_blueprint(admin.bp, url_prefix='/api/admin')
     app.register_blueprint(documents.bp, url_prefix='/api/documents')
+    app.register_blueprint(metrics.bp)
 
-    app.before_request(check_if_user_deleted)
+    app.before_request(metrics.start_request_metrics)
+    app.before_request(load_principal)
+    app.after_request(metrics.record_response_status)
+    app.teardown_request(metrics.finish_request_metrics)
+    # 缓存命中数、索引大小等在抓取时读取，不占用请求路径
+    register_collector("services", lambda: metrics.collect_service_metrics(app))
 
     return app
\ No newline at end of file
@@ -1,8 +1,10 @@
 import os
 import logging
 from app import create_app, db
-from app.models import User, Organization
+from app.models import User, Organization, Document
+from app.services.document_parser import file_hash
 from app.utils.security import hash_password
+from sqlalchemy import inspect, text
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -13,6 +15,7 @@ def init_db():
     with app.app_context():
         db.create_all()
         logger.info("Database tables created successfully")
+        upgrade_schema(app)
 
         admin_user = User.query.filter_by(username='admin').first()
         admin_password = os.environ.get('ADMIN_PASSWORD', 'secure_admin_password')
@@ -42,6 +45,31 @@ def init_db():
         db.session.commit()
         logger.info("Admin user password set/updated")
 
+def upgrade_schema(app):
+    # create_all 只创建缺失的表，已有数据库中的表需要补上后来新增的列
+    columns = {column['name'] for column in inspect(db.engine).get_columns('document')}
+    if 'content_hash' not in columns:
+        logger.info("Adding document.content_hash")
+        db.session.execute(text('ALTER TABLE document ADD COLUMN content_hash VARCHAR(64)'))
+        db.session.execute(text('CREATE INDEX ix_document_organization_content_hash '
+                                'ON document (organization_id, content_hash)'))
+        db.session.commit()
+    if 'ingest_status' not in columns:
+        # 已有文档按已导入处理；导入失败的文档重新上传前需要先删除，或重建索引
+        logger.info("Adding document.ingest_status")
+        db.session.execute(text("ALTER TABLE document ADD COLUMN ingest_status VARCHAR(20) NOT NULL DEFAULT 'indexed'"))
+        db.session.commit()
+
+    # 为已有文档补算内容哈希，之后重复上传这些文件也能被识别
+    documents = Document.query.filter(Document.content_hash.is_(None), Document.file_path.isnot(None)).all()
+    for document in documents:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], document.file_path)
+        if os.path.exists(path):
+            document.content_hash = file_hash(path)
+    if documents:
+        db.session.commit()
+        logger.info(f"Computed content hashes of {len(documents)} documents")
+
 if __name__ == '__main__':
     init_db()
     logger.info("Database initialization complete")
\ No newline at end of file
@@ -1,14 +1,23 @@
-from flask import jsonify, current_app
-from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity
+from flask import jsonify, current_app, g
+from flask_jwt_extended import verify_jwt_in_request, get_jwt_identity, get_jwt
 
-def check_if_user_deleted():
+def load_principal():
+    # 每个请求只解析一次用户身份，路由通过 current_principal() 读取
+    g.principal = None
     try:
         verify_jwt_in_request(optional=True)
         user_id = get_jwt_identity()
-        if user_id is not None:
-            if current_app.redis.sismember('deleted_users', str(user_id)):
-                return jsonify({"error": "User account has been deleted"}), 401
+        claims = get_jwt()
     except:
         # If there's an error verifying the JWT, we just skip the check
-        pass
-    return None
\ No newline at end of file
+        return None
+    if user_id is not None:
+        principal = current_app.principals.resolve(user_id, claims)
+        if principal is None:
+            return jsonify({"error": "User account has been deleted"}), 401
+        g.principal = principal
+    return None
+
+def current_principal():
+    """The Principal of the authenticated user making this request, or None."""
+    return g.get('principal')
\ No newline at end of file
@@ -0,0 +1,41 @@
+import os
+import re
+import sys
+import logging
+from app import create_app
+from app.services.chunk_store import migrate_pickled_docstore
+from app.services.ingestion import organization_lock
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_ORGANIZATION_DIR = re.compile(r'^organization_(\d+)$')
+
+
+def migrate_docstores(organization_ids=None):
+    """
+    Convert every organization's pickled docstore (index.pkl) into a
+    SQLite chunk store. Usage: python -m app.migrate_docstore [organization_id ...]
+    """
+    app = create_app()
+    folder = app.config['VECTORSTORE_FOLDER']
+    migrated = 0
+    for name in sorted(os.listdir(folder)):
+        match = _ORGANIZATION_DIR.match(name)
+        if not match:
+            continue
+        organization_id = int(match.group(1))
+        if organization_ids and organization_id not in organization_ids:
+            continue
+        # 与导入任务互斥，避免转换过程中索引被改写
+        with organization_lock(app.redis, organization_id, wait=app.config['INGESTION_LOCK_TIMEOUT']):
+            count = migrate_pickled_docstore(os.path.join(folder, name))
+        if count is None:
+            logger.info(f"Organization {organization_id}: nothing to migrate")
+        else:
+            logger.info(f"Organization {organization_id}: migrated {count} chunks")
+            migrated += 1
+    logger.info(f"Migrated {migrated} organizations")
+
+if __name__ == '__main__':
+    migrate_docstores({int(arg) for arg in sys.argv[1:]})
@@ -29,5 +29,9 @@ class Document(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False) #原始文件名
     file_path = db.Column(db.String(255), nullable=True) #存储在系统中的文件名（UUID）
+    content_hash = db.Column(db.String(64), nullable=True) #文件内容的 sha256，用于识别重复上传
+    ingest_status = db.Column(db.String(20), nullable=False, default='queued') #'queued'、'indexed' 或 'failed'
     organization_id = db.Column(db.Integer, db.ForeignKey('organization.id'), nullable=False)
-    organization = db.relationship('Organization', backref=db.backref('documents', lazy=True))
\ No newline at end of file
+    organization = db.relationship('Organization', backref=db.backref('documents', lazy=True))
+
+    __table_args__ = (db.Index('ix_document_organization_content_hash', 'organization_id', 'content_hash'),)
\ No newline at end of file
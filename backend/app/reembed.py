@@ -0,0 +1,49 @@
+import os
+import re
+import sys
+import logging
+from app import create_app
+from app.services.embedding_providers import provider_name_for
+from app.services.ingestion import organization_lock
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+_ORGANIZATION_DIR = re.compile(r'^organization_(\d+)$')
+
+
+def reembed_organizations(organization_ids=None):
+    """
+    Rebuild the index of every organization whose configured embedding
+    provider (EMBEDDING_PROVIDER / EMBEDDING_PROVIDER_OVERRIDES) differs
+    from the one its index was built with. Usage:
+    python -m app.reembed [organization_id ...]
+    """
+    app = create_app()
+    folder = app.config['VECTORSTORE_FOLDER']
+    migrated = 0
+    for name in sorted(os.listdir(folder)):
+        match = _ORGANIZATION_DIR.match(name)
+        if not match:
+            continue
+        organization_id = int(match.group(1))
+        if organization_ids and organization_id not in organization_ids:
+            continue
+        # 与导入任务互斥；迁移期间查询继续使用旧索引
+        with app.app_context():
+            with organization_lock(app.redis, organization_id, wait=app.config['INGESTION_LOCK_TIMEOUT']):
+                rag_system = app.rag_registry.get(organization_id)
+                if not rag_system.needs_reembedding():
+                    logger.info(f"Organization {organization_id}: already uses "
+                                f"{rag_system.embedding_provider.name}")
+                    continue
+                previous = rag_system.embedding_provider.name
+                rag_system.reembed()
+                app.rag_registry.mark_updated(organization_id)
+                app.answer_cache.invalidate(organization_id)
+        logger.info(f"Organization {organization_id}: re-embedded {previous} -> {provider_name_for(organization_id)}")
+        migrated += 1
+    logger.info(f"Re-embedded {migrated} organizations")
+
+if __name__ == '__main__':
+    reembed_organizations({int(arg) for arg in sys.argv[1:]})
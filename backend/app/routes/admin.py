@@ -1,8 +1,12 @@
 from flask import Blueprint, request, jsonify, current_app
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required
 from ..models import User, Organization
 from ..extensions import db
+from ..middleware import current_principal
 from ..utils.security import hash_password
+from ..services.embedding_cache import get_embedding_cache, get_query_vector_cache
+from ..services.document_parser import get_partition_cache
+from ..services.leak_filter import invalidate_leak_filter
 
 bp = Blueprint('admin', __name__)
 
@@ -19,6 +23,7 @@ def create_organization():
     organization = Organization(name=data['name'])
     db.session.add(organization)
     db.session.commit()
+    invalidate_leak_filter()
     return jsonify({"id": organization.id, "name": organization.name}), 201
 
 @bp.route('/organizations/<int:id>', methods=['DELETE'])
@@ -29,8 +34,49 @@ def delete_organization(id):
         return jsonify({"error": "Organization not found"}), 404
     db.session.delete(organization)
     db.session.commit()
+    current_app.rag_registry.invalidate(id)
+    current_app.answer_cache.invalidate(id)
+    get_partition_cache().purge(id)
+    invalidate_leak_filter()
     return jsonify({"message": "Organization deleted successfully"}), 200
 
+@bp.route('/rag-cache', methods=['GET'])
+@jwt_required()
+def get_rag_cache_stats():
+    principal = current_principal()
+    if not principal or not principal.is_admin:
+        return jsonify({"error": "Unauthorized"}), 403
+    stats = current_app.rag_registry.stats()
+    stats["embedding_cache"] = get_embedding_cache().stats()
+    stats["query_vector_cache"] = get_query_vector_cache().stats()
+    return jsonify(stats), 200
+
+@bp.route('/organizations/<int:id>/answer-cache', methods=['GET'])
+@jwt_required()
+def get_answer_cache_stats(id):
+    principal = current_principal()
+    if not principal or not principal.is_admin:
+        return jsonify({"error": "Unauthorized"}), 403
+    return jsonify(current_app.answer_cache.stats(id)), 200
+
+@bp.route('/organizations/<int:id>/vector-index', methods=['GET'])
+@jwt_required()
+def get_vector_index_info(id):
+    principal = current_principal()
+    if not principal or not principal.is_admin:
+        return jsonify({"error": "Unauthorized"}), 403
+    return jsonify(current_app.rag_registry.get(id).index_info()), 200
+
+@bp.route('/organizations/<int:id>/vector-index/recall', methods=['GET'])
+@jwt_required()
+def get_vector_index_recall(id):
+    principal = current_principal()
+    if not principal or not principal.is_admin:
+        return jsonify({"error": "Unauthorized"}), 403
+    k = request.args.get('k', 10, type=int)
+    queries = request.args.get('queries', 100, type=int)
+    return jsonify(current_app.rag_registry.get(id).recall_report(k=k, queries=queries)), 200
+
 @bp.route('/users', methods=['GET'])
 @jwt_required()
 def get_users():
@@ -59,10 +105,8 @@ def create_user():
 @bp.route('/users/<int:id>', methods=['PUT'])
 @jwt_required()
 def update_user(id):
-    current_user_id = get_jwt_identity()
-    current_user = User.query.get(current_user_id)
-
-    if not current_user or current_user.role != 'admin':
+    principal = current_principal()
+    if not principal or not principal.is_admin:
         return jsonify({"error": "Unauthorized"}), 403
 
     user = User.query.get(id)
@@ -83,6 +127,7 @@ def update_user(id):
 
     try:
         db.session.commit()
+        current_app.principals.invalidate(user.id)
         return jsonify({"id": user.id, "username": user.username, "email": user.email,
                         "organization_id": user.organization_id, "role": user.role}), 200
     except Exception as e:
@@ -92,10 +137,8 @@ def update_user(id):
 @bp.route('/users/<int:id>', methods=['DELETE'])
 @jwt_required()
 def delete_user(id):
-    current_user_id = get_jwt_identity()
-    current_user = User.query.get(current_user_id)
-
-    if not current_user or current_user.role != 'admin':
+    principal = current_principal()
+    if not principal or not principal.is_admin:
         return jsonify({"error": "Unauthorized"}), 403
 
     user = User.query.get(id)
@@ -111,7 +154,7 @@ def delete_user(id):
     db.session.delete(user)
     db.session.commit()
 
-    # Add user ID to Redis set of deleted users
-    current_app.redis.sadd('deleted_users', str(id))
+    # 其他进程中该用户的令牌随即失效
+    current_app.principals.invalidate(id)
 
     return jsonify({"message": "User deleted successfully"}), 200
\ No newline at end of file
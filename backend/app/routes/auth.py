@@ -2,6 +2,7 @@ from flask import Blueprint, request, jsonify, current_app
 from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity, get_jwt
 from ..models import User, Organization
 from ..extensions import db
+from ..middleware import current_principal
 from ..utils.security import check_password_strength, hash_password, check_password
 import logging
 import re
@@ -12,6 +13,11 @@ USERNAME_REGEX = re.compile(r'^[a-zA-Z0-9_]{3,20}$')
 PASSWORD_MIN_LENGTH = 8
 PASSWORD_MAX_LENGTH = 128
 
+def create_user_access_token(user):
+    # 角色和组织写入令牌，受保护的路由无需再查询用户表
+    return create_access_token(identity=user.id,
+                               additional_claims={"role": user.role, "organization_id": user.organization_id})
+
 @bp.route('/organizations', methods=['GET'])
 def get_organizations():
     organizations = Organization.query.all()
@@ -32,7 +38,7 @@ def login():
     user = User.query.filter_by(username=username).first()
     if user and user.check_password(password):
         logging.info(f"Successful login for user: {username}")
-        access_token = create_access_token(identity=user.id)
+        access_token = create_user_access_token(user)
         refresh_token = create_refresh_token(identity=user.id)
         return jsonify(access_token=access_token, refresh_token=refresh_token, user_role=user.role), 200
     else:
@@ -42,8 +48,10 @@ def login():
 @bp.route('/refresh', methods=['POST'])
 @jwt_required(refresh=True)
 def refresh():
-    current_user = get_jwt_identity()
-    new_access_token = create_access_token(identity=current_user)
+    user = User.query.get(get_jwt_identity())
+    if not user:
+        return jsonify({"error": "User not found"}), 401
+    new_access_token = create_user_access_token(user)
     return jsonify(access_token=new_access_token), 200
 
 @bp.route('/check_username', methods=['POST'])
@@ -172,6 +180,7 @@ def delete_account():
     try:
         db.session.delete(user)
         db.session.commit()
+        current_app.principals.invalidate(user_id)
         jti = get_jwt()["jti"]
         current_app.redis.set(jti, "", ex=current_app.config["JWT_ACCESS_TOKEN_EXPIRES"])
         return jsonify({"message": "Account successfully deleted"}), 200
@@ -183,8 +192,7 @@ def delete_account():
 @bp.route('/verify-token', methods=['GET'])
 @jwt_required()
 def verify_token():
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
-    if not user:
+    principal = current_principal()
+    if not principal:
         return jsonify({"error": "User not found"}), 404
-    return jsonify({"message": "Token is valid", "user_id": current_user_id}), 200
\ No newline at end of file
+    return jsonify({"message": "Token is valid", "user_id": principal.user_id}), 200
\ No newline at end of file
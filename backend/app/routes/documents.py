@@ -1,8 +1,11 @@
 from flask import Blueprint, request, jsonify, current_app
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from ..models import User, Document
+from flask_jwt_extended import jwt_required
+from ..models import Document
 from ..extensions import db
-from ..services.rag_service import RAGSystem
+from ..middleware import current_principal
+from ..services.document_parser import get_partition_cache, warm_partition_cache
+from ..services.ingestion import organization_lock, OrganizationLocked, schedule_compaction
+import hashlib
 import os
 import urllib.parse
 import uuid
@@ -23,13 +26,25 @@ def safe_filename(filename):
     safe_name = f"{uuid.uuid4()}{ext}"
     return safe_name, filename
 
+def save_upload(file, file_path, chunk_size=1024 * 1024):
+    """Stream an uploaded file to disk and return the sha256 of its content."""
+    digest = hashlib.sha256()
+    with open(file_path, 'wb') as f:
+        for chunk in iter(lambda: file.stream.read(chunk_size), b''):
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+def _index_changed(organization_id):
+    # 索引已更新：刷新进程内缓存的实例信息，并使该组织的答案缓存失效
+    current_app.rag_registry.mark_updated(organization_id)
+    current_app.answer_cache.invalidate(organization_id)
+
 @bp.route('/organizations/<int:organization_id>/upload', methods=['POST'])
 @jwt_required()
 def upload_document(organization_id):
-    current_user_id = get_jwt_identity()
-    current_user = User.query.get(current_user_id)
-
-    if not current_user or current_user.role != 'admin':
+    principal = current_principal()
+    if not principal or not principal.is_admin:
         return jsonify({"error": "Unauthorized"}), 403
 
     if 'files' not in request.files:
@@ -40,33 +55,59 @@ def upload_document(organization_id):
         return jsonify({"error": "No selected files"}), 400
 
     uploaded_files = []
-    rag_system = RAGSystem(organization_id)
+    duplicates = []
     for file in files:
         if file and allowed_file(file.filename):
             safe_name, original_name = safe_filename(file.filename)
             if not os.path.exists(current_app.config['UPLOAD_FOLDER']):
                 os.makedirs(current_app.config['UPLOAD_FOLDER'])
             file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], safe_name)
-            file.save(file_path)
-
-            new_document = Document(filename=original_name, file_path=safe_name, organization_id=organization_id)
+            content_hash = save_upload(file, file_path)
+
+            # 内容完全相同的文件已在该组织中（包括本次请求中较早的文件）：已导入成功的不再解析和嵌入，返回已有文档
+            existing = Document.query.filter_by(organization_id=organization_id, content_hash=content_hash).first()
+            if existing and (existing.ingest_status == 'indexed' or existing in uploaded_files):
+                os.remove(file_path)
+                duplicates.append({"filename": original_name, "document_id": existing.id})
+                continue
+            if existing:
+                # 导入失败或尚未完成：重新导入已有文档，不新建记录；已有文件丢失时改用本次上传的文件
+                old_path = os.path.join(current_app.config['UPLOAD_FOLDER'], existing.file_path or '')
+                if existing.file_path and os.path.exists(old_path):
+                    os.remove(file_path)
+                else:
+                    existing.file_path = safe_name
+                existing.ingest_status = 'queued'
+                uploaded_files.append(existing)
+                continue
+
+            new_document = Document(filename=original_name, file_path=safe_name, content_hash=content_hash,
+                                    organization_id=organization_id)
             db.session.add(new_document)
             db.session.flush() #这会给 new_document 分配一个 id
             uploaded_files.append(new_document)
-            rag_system.add_document(file_path)
 
     db.session.commit()
 
-    return jsonify({"message": "Files uploaded and added to knowledge base successfully",
-                    "document_ids": [doc.id for doc in uploaded_files]}), 201
+    if duplicates and not uploaded_files:
+        return jsonify({"message": "Files are already in the knowledge base",
+                        "document_ids": [], "job_ids": [], "duplicates": duplicates}), 200
+
+    # 解析和建立索引在后台完成，通过 /jobs/<job_id> 查询进度
+    job_ids = [current_app.ingestion_queue.enqueue(organization_id, doc.id,
+                                                   os.path.join(current_app.config['UPLOAD_FOLDER'], doc.file_path))
+               for doc in uploaded_files]
+
+    return jsonify({"message": "Files uploaded and queued for processing",
+                    "document_ids": [doc.id for doc in uploaded_files],
+                    "job_ids": job_ids,
+                    "duplicates": duplicates}), 202
 
 @bp.route('/organizations/<int:organization_id>/documents', methods=['GET'])
 @jwt_required()
 def get_organization_documents(organization_id):
-    current_user_id = get_jwt_identity()
-    current_user = User.query.get(current_user_id)
-
-    if not current_user or current_user.role != 'admin':
+    principal = current_principal()
+    if not principal or not principal.is_admin:
         return jsonify({"error": "Unauthorized"}), 403
 
     documents = Document.query.filter_by(organization_id=organization_id).all()
@@ -75,22 +116,32 @@ def get_organization_documents(organization_id):
 @bp.route('/<int:document_id>', methods=['DELETE'])
 @jwt_required()
 def delete_document(document_id):
-    current_user_id = get_jwt_identity()
-    current_user = User.query.get(current_user_id)
-
-    if not current_user or current_user.role != 'admin':
+    principal = current_principal()
+    if not principal or not principal.is_admin:
         return jsonify({"error": "Unauthorized"}), 403
 
     document = Document.query.get(document_id)
     if not document:
         return jsonify({"error": "Document not found"}), 404
 
-    # 从 RAG 系统的知识库中移除文档
-    rag_system = RAGSystem(document.organization_id)
     # 获取文档的完整路径
     file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], document.file_path)
-    # 从 RAG 系统中移除文档
-    rag_system.remove_document(file_path)
+    try:
+        # 与后台导入任务互斥，避免同时写同一组织的索引
+        with organization_lock(current_app.redis, document.organization_id, wait=60):
+            # 持有锁之后再取实例，等锁期间其他进程写入的清单会被重新加载
+            rag_system = current_app.rag_registry.get(document.organization_id)
+            # 从 RAG 系统中移除文档；旧索引没有文档归属信息时，用其余文档重建索引
+            if not rag_system.remove_document(document.id):
+                remaining = Document.query.filter(Document.organization_id == document.organization_id,
+                                                  Document.id != document.id).all()
+                rag_system.rebuild_index([(doc.id, os.path.join(current_app.config['UPLOAD_FOLDER'], doc.file_path))
+                                          for doc in remaining if doc.file_path])
+    except OrganizationLocked:
+        return jsonify({"error": "The knowledge base is being updated, please try again later"}), 409
+    _index_changed(document.organization_id)
+    if rag_system.needs_compaction() or rag_system.needs_reembedding():
+        schedule_compaction(current_app._get_current_object(), document.organization_id)
 
     # 从文件系统中删除文件
     if os.path.exists(file_path):
@@ -100,4 +151,83 @@ def delete_document(document_id):
     db.session.delete(document)
     db.session.commit()
 
-    return jsonify({"message": "Document deleted successfully"}), 200
\ No newline at end of file
+    return jsonify({"message": "Document deleted successfully"}), 200
+
+@bp.route('/organizations/<int:organization_id>/parse-cache', methods=['GET'])
+@jwt_required()
+def get_parse_cache_stats(organization_id):
+    principal = current_principal()
+    if not principal or not principal.is_admin:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    return jsonify(get_partition_cache().stats(organization_id)), 200
+
+@bp.route('/organizations/<int:organization_id>/parse-cache/warm', methods=['POST'])
+@jwt_required()
+def warm_parse_cache(organization_id):
+    principal = current_principal()
+    if not principal or not principal.is_admin:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    documents = Document.query.filter_by(organization_id=organization_id).all()
+    file_paths = [os.path.join(current_app.config['UPLOAD_FOLDER'], doc.file_path) for doc in documents if doc.file_path]
+    # 解析在解析进程池中进行，不等待完成；进度见 GET parse-cache
+    queued = warm_partition_cache(organization_id, file_paths)
+    return jsonify({"message": "Files queued for parsing", "queued": queued}), 202
+
+@bp.route('/organizations/<int:organization_id>/parse-cache', methods=['DELETE'])
+@jwt_required()
+def purge_parse_cache(organization_id):
+    principal = current_principal()
+    if not principal or not principal.is_admin:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    removed = get_partition_cache().purge(organization_id)
+    return jsonify({"message": "Parse cache purged", "removed": removed}), 200
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def get_ingestion_job(job_id):
+    principal = current_principal()
+    if not principal or not principal.is_admin:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    job = current_app.ingestion_queue.get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
+@bp.route('/organizations/<int:organization_id>/jobs', methods=['GET'])
+@jwt_required()
+def get_organization_ingestion_jobs(organization_id):
+    principal = current_principal()
+    if not principal or not principal.is_admin:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    limit = request.args.get('limit', 50, type=int)
+    return jsonify(current_app.ingestion_queue.list_jobs(organization_id, limit)), 200
+
+@bp.route('/organizations/<int:organization_id>/rebuild', methods=['POST'])
+@jwt_required()
+def rebuild_organization_index(organization_id):
+    principal = current_principal()
+    if not principal or not principal.is_admin:
+        return jsonify({"error": "Unauthorized"}), 403
+
+    try:
+        with organization_lock(current_app.redis, organization_id, wait=60):
+            # 等锁期间可能有新导入的文档，持有锁之后再读取文档列表和索引
+            documents = Document.query.filter_by(organization_id=organization_id).all()
+            rag_system = current_app.rag_registry.get(organization_id)
+            summary = rag_system.rebuild_index([(doc.id, os.path.join(current_app.config['UPLOAD_FOLDER'], doc.file_path))
+                                                for doc in documents if doc.file_path])
+    except OrganizationLocked:
+        return jsonify({"error": "The knowledge base is being updated, please try again later"}), 409
+    _index_changed(organization_id)
+    if len(summary["failed"]) < summary["documents"]:
+        # 新索引已替换旧索引：记录每个文档是否导入成功
+        for doc in documents:
+            if doc.file_path:
+                doc.ingest_status = 'failed' if doc.id in summary["failed"] else 'indexed'
+        db.session.commit()
+    return jsonify(summary), 200
@@ -0,0 +1,58 @@
+from flask import Blueprint, Response, current_app, request, g
+from ..services.embedding_cache import get_embedding_cache, get_query_vector_cache
+from ..utils.metrics import REQUEST_SECONDS, REQUESTS_IN_FLIGHT, render
+import hmac
+import time
+
+bp = Blueprint('metrics', __name__)
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus text exposition of this worker process's metrics."""
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+def start_request_metrics():
+    g.metrics_endpoint = request.endpoint or "unmatched"
+    g.metrics_started = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc(g.metrics_endpoint)
+
+def record_response_status(response):
+    g.metrics_status = response.status_code
+    return response
+
+def finish_request_metrics(error=None):
+    # 流式响应在生成器结束后才会执行 teardown，耗时包含整个流
+    endpoint = g.pop('metrics_endpoint', None)
+    if endpoint is None:
+        return
+    REQUESTS_IN_FLIGHT.dec(endpoint)
+    status = g.pop('metrics_status', 500 if error is not None else 200)
+    REQUEST_SECONDS.observe(time.perf_counter() - g.pop('metrics_started'), endpoint, str(status))
+
+def collect_service_metrics(app):
+    """Scrape-time values: cache counters kept by the caches themselves and the sizes of loaded indexes."""
+    families = []
+    registry = app.rag_registry.stats()
+    families.append(("echosage_rag_registry_lookups_total", "counter", "RAG instance cache lookups by result",
+                     [({"result": "hit"}, registry["hits"]), ({"result": "miss"}, registry["misses"])]))
+    families.append(("echosage_rag_registry_organizations", "gauge", "Organizations with a loaded index",
+                     [({}, registry["organizations"])]))
+    for name, cache in (("embedding", get_embedding_cache()), ("query_vector", get_query_vector_cache())):
+        stats = cache.stats()
+        families.append((f"echosage_{name}_cache_lookups_total", "counter", f"{name} cache lookups by result",
+                         [({"result": "hit"}, stats["hits"]), ({"result": "miss"}, stats["misses"])]))
+        families.append((f"echosage_{name}_cache_entries", "gauge", f"Entries in the {name} cache",
+                         [({}, stats["entries"])]))
+
+    indexes = app.rag_registry.index_stats()
+    for field, documentation in (("bytes", "On-disk size of the organization's index"),
+                                 ("chunks", "Live chunks in the organization's index"),
+                                 ("segments", "Segments in the organization's index"),
+                                 ("tombstones", "Deleted vectors awaiting compaction")):
+        families.append((f"echosage_index_{field}", "gauge", documentation,
+                         [({"organization": str(organization_id)}, stats[field])
+                          for organization_id, stats in indexes.items()]))
+    return families
@@ -1,18 +1,120 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import jwt_required, get_jwt_identity
-from ..services.rag_service import RAGSystem
-from ..models import User, Organization
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
+from flask_jwt_extended import jwt_required
+from ..middleware import current_principal
+import json
+import logging
 
 bp = Blueprint('rag', __name__)
 
 @bp.route('/query', methods=['POST'])
 @jwt_required()
 def rag_query():
-    current_user_id = get_jwt_identity()
-    user = User.query.get(current_user_id)
-    organization = Organization.query.get(user.organization_id)
+    principal = current_principal()
+    if not principal:
+        return jsonify({"error": "Unauthorized"}), 403
+    organization_id = principal.organization_id
 
     question = request.json['question']
-    rag_system = RAGSystem(organization.id)
-    answer = rag_system.query(question)
+    debug = bool(request.json.get('debug')) or current_app.debug
+    rag_system = current_app.rag_registry.get(organization_id)
+
+    answer_cache = current_app.answer_cache
+    vector = rag_system.embeddings.embed_query(question) if answer_cache.uses_similarity else None
+    answer, cache_version = answer_cache.lookup(organization_id, question, vector)
+    if answer is not None:
+        return jsonify({"answer": answer, "cached": True})
+
+    answer = rag_system.query(question, debug=debug)
+    # 接口调用失败时 CustomAPILLM 返回以 "Error:" 开头的文本，不缓存
+    if not answer["result"].startswith("Error:"):
+        answer_cache.store(organization_id, cache_version, question,
+                           {"query": answer["query"], "result": answer["result"]}, vector)
     return jsonify({"answer": answer})
+
+@bp.route('/query/batch', methods=['POST'])
+@jwt_required()
+def rag_query_batch():
+    """
+    Answer a list of questions in one request: {"questions": [...], "debug": bool}.
+    Returns {"answers": [...]} in the same order; each answer has either "result" or "error".
+    """
+    principal = current_principal()
+    if not principal:
+        return jsonify({"error": "Unauthorized"}), 403
+    organization_id = principal.organization_id
+
+    questions = request.json.get('questions')
+    if not isinstance(questions, list) or not all(isinstance(q, str) and q.strip() for q in questions):
+        return jsonify({"error": "questions must be a list of non-empty strings"}), 400
+    max_questions = current_app.config['BATCH_QUERY_MAX_QUESTIONS']
+    if len(questions) > max_questions:
+        return jsonify({"error": f"At most {max_questions} questions per request"}), 400
+    debug = bool(request.json.get('debug')) or current_app.debug
+    rag_system = current_app.rag_registry.get(organization_id)
+
+    answer_cache = current_app.answer_cache
+    vectors = rag_system.embeddings.embed_queries(questions) if questions else []
+    answers = [None] * len(questions)
+    cache_versions = [None] * len(questions)
+    pending = []
+    for i, (question, vector) in enumerate(zip(questions, vectors)):
+        cached, cache_versions[i] = answer_cache.lookup(organization_id, question,
+                                                        vector if answer_cache.uses_similarity else None)
+        if cached is not None:
+            answers[i] = dict(cached, cached=True)
+        else:
+            pending.append(i)
+
+    results = rag_system.query_batch([questions[i] for i in pending], vectors=[vectors[i] for i in pending],
+                                     debug=debug)
+    for i, answer in zip(pending, results):
+        answers[i] = answer
+        if "result" in answer:
+            answer_cache.store(organization_id, cache_versions[i], questions[i],
+                               {"query": answer["query"], "result": answer["result"]},
+                               vectors[i] if answer_cache.uses_similarity else None)
+    return jsonify({"answers": answers})
+
+def _sse(event):
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+@bp.route('/query/stream', methods=['POST'])
+@jwt_required()
+def rag_query_stream():
+    """Same as /query, but the answer is streamed to the client as Server-Sent Events."""
+    principal = current_principal()
+    if not principal:
+        return jsonify({"error": "Unauthorized"}), 403
+    organization_id = principal.organization_id
+
+    question = request.json['question']
+    rag_system = current_app.rag_registry.get(organization_id)
+    answer_cache = current_app.answer_cache
+    vector = rag_system.embeddings.embed_query(question) if answer_cache.uses_similarity else None
+    cached, cache_version = answer_cache.lookup(organization_id, question, vector)
+
+    def generate():
+        if cached is not None:
+            yield _sse({"type": "token", "text": cached["result"]})
+            yield _sse({"type": "done", "result": cached["result"], "cached": True})
+            return
+
+        events = rag_system.stream_query(question)
+        try:
+            for event in events:
+                if event["type"] == "done":
+                    answer_cache.store(organization_id, cache_version, question,
+                                       {"query": question, "result": event["result"]}, vector)
+                yield _sse(event)
+        except GeneratorExit:
+            # 客户端断开连接，关闭上游请求
+            logging.info(f"Client disconnected from streamed query of organization {organization_id}")
+            raise
+        except Exception as e:
+            logging.error(f"Streamed query failed: {str(e)}")
+            yield _sse({"type": "error", "error": "Error: streaming failed"})
+        finally:
+            events.close()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
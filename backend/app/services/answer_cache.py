@@ -0,0 +1,145 @@
+from .embedding_cache import normalize_text
+from ..utils.metrics import CACHE_LOOKUPS
+import hashlib
+import json
+import logging
+import numpy as np
+import redis
+
+logger = logging.getLogger(__name__)
+
+_TRAILING_PUNCTUATION = " ?？!！。.,，"
+
+
+def normalize_question(question):
+    return normalize_text(question).lower().rstrip(_TRAILING_PUNCTUATION)
+
+
+class AnswerCache:
+    """
+    Per-organization answer cache stored in Redis.
+
+    Lookups first try an exact match on the normalized question; when a
+    similarity threshold is configured, the question embedding is then
+    compared (cosine) against recently cached questions of the same
+    organization. All keys embed the organization's index version, so
+    bumping the version when documents change invalidates every answer at
+    once and the stale keys simply expire.
+
+    Keys:
+        answer_cache:<org>:version            index version counter
+        answer_cache:<org>:v<n>:q:<sha256>    cached answer (JSON), with TTL
+        answer_cache:<org>:v<n>:vectors       list of sha256 hex + float32 question vector,
+                                              newest first, trimmed to max_similar_candidates
+        answer_cache:<org>:stats              hash of hit/miss counters
+    """
+
+    def __init__(self, redis_client, ttl=3600, similarity_threshold=0.0, max_similar_candidates=500):
+        self.redis = redis_client
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.max_similar_candidates = max_similar_candidates
+
+    @property
+    def uses_similarity(self):
+        return self.similarity_threshold > 0
+
+    def _prefix(self, organization_id, version):
+        return f"answer_cache:{organization_id}:v{version}"
+
+    def lookup(self, organization_id, question, vector=None):
+        """
+        Return (cached answer or None, version). Pass the version on to
+        store(), so an answer computed while the organization's documents
+        changed is filed under the version it was computed against and is
+        never served after the invalidation. The version is None when
+        Redis is unavailable.
+        """
+        version = None
+        try:
+            version = int(self.redis.get(f"answer_cache:{organization_id}:version") or 0)
+            prefix = self._prefix(organization_id, version)
+            digest = hashlib.sha256(normalize_question(question).encode('utf-8')).hexdigest()
+            cached = self.redis.get(f"{prefix}:q:{digest}")
+            if cached is not None:
+                self._count(organization_id, "hits_exact")
+                CACHE_LOOKUPS.inc("answer", "hit_exact")
+                return json.loads(cached), version
+
+            if self.uses_similarity and vector is not None:
+                answer = self._lookup_similar(prefix, vector)
+                if answer is not None:
+                    self._count(organization_id, "hits_similar")
+                    CACHE_LOOKUPS.inc("answer", "hit_similar")
+                    return answer, version
+
+            self._count(organization_id, "misses")
+            CACHE_LOOKUPS.inc("answer", "miss")
+        except redis.RedisError as e:
+            logger.warning(f"Answer cache lookup failed: {str(e)}")
+        return None, version
+
+    def _lookup_similar(self, prefix, vector):
+        vectors_key = f"{prefix}:vectors"
+        # 列表在 store() 中裁剪，每次最多读取 max_similar_candidates 个向量
+        entries = self.redis.lrange(vectors_key, 0, self.max_similar_candidates - 1)
+        if not entries:
+            return None
+        matrix = np.stack([np.frombuffer(entry[64:], dtype=np.float32) for entry in entries])
+        query = np.asarray(vector, dtype=np.float32)
+        scores = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-12)
+        best = int(np.argmax(scores))
+        if scores[best] < self.similarity_threshold:
+            return None
+
+        digest = entries[best][:64].decode('ascii')
+        cached = self.redis.get(f"{prefix}:q:{digest}")
+        if cached is None:
+            # 答案已过期，清理对应的向量
+            self.redis.lrem(vectors_key, 0, entries[best])
+            return None
+        return json.loads(cached)
+
+    def store(self, organization_id, version, question, answer, vector=None):
+        """Cache an answer under the version lookup() returned for the question."""
+        if version is None:
+            return
+        try:
+            prefix = self._prefix(organization_id, version)
+            digest = hashlib.sha256(normalize_question(question).encode('utf-8')).hexdigest()
+            pipe = self.redis.pipeline()
+            pipe.set(f"{prefix}:q:{digest}", json.dumps(answer, ensure_ascii=False), ex=self.ttl)
+            if self.uses_similarity and vector is not None:
+                vectors_key = f"{prefix}:vectors"
+                pipe.lpush(vectors_key, digest.encode('ascii') + np.asarray(vector, dtype=np.float32).tobytes())
+                pipe.ltrim(vectors_key, 0, self.max_similar_candidates - 1)
+                pipe.expire(vectors_key, self.ttl)
+            pipe.execute()
+        except redis.RedisError as e:
+            logger.warning(f"Answer cache store failed: {str(e)}")
+
+    def invalidate(self, organization_id):
+        """Drop every cached answer of an organization (called when its documents change)."""
+        try:
+            self.redis.incr(f"answer_cache:{organization_id}:version")
+            self._count(organization_id, "invalidations")
+        except redis.RedisError as e:
+            logger.warning(f"Answer cache invalidation failed: {str(e)}")
+
+    def stats(self, organization_id):
+        counters = {k.decode('utf-8'): int(v) for k, v in
+                    self.redis.hgetall(f"answer_cache:{organization_id}:stats").items()}
+        hits = counters.get("hits_exact", 0) + counters.get("hits_similar", 0)
+        lookups = hits + counters.get("misses", 0)
+        return {
+            "hits_exact": counters.get("hits_exact", 0),
+            "hits_similar": counters.get("hits_similar", 0),
+            "misses": counters.get("misses", 0),
+            "invalidations": counters.get("invalidations", 0),
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "ttl": self.ttl,
+            "similarity_threshold": self.similarity_threshold,
+        }
+
+    def _count(self, organization_id, counter):
+        self.redis.hincrby(f"answer_cache:{organization_id}:stats", counter, 1)
@@ -0,0 +1,295 @@
+from langchain_core.documents import Document
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import weakref
+import logging
+
+logger = logging.getLogger(__name__)
+
+# SQLite 限制单条语句的参数个数
+_BATCH = 500
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class ChunkStore:
+    """
+    Text and metadata of every chunk in an organization's index, stored in
+    SQLite and keyed by the chunk's position in the FAISS index, plus which
+    chunks each document refers to (chunks shared by documents are stored
+    once).
+
+    Opening a store reads nothing: queries fetch just the chunk IDs of the
+    positions FAISS returned and the texts of the chunks that make it into
+    the prompt. The database uses a rollback journal rather than WAL, so a
+    rebuilt store is a single file that other processes can keep reading
+    after the manifest has moved on to a new one.
+    """
+
+    FILE_NAME = "chunks.sqlite3"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # 注册表丢弃的 RAG 实例在最后一个使用者释放后才被回收，连接随之关闭
+        weakref.finalize(self, self._conn.close)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "position INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL UNIQUE, text TEXT NOT NULL, metadata TEXT NOT NULL, "
+            "text_hash TEXT)"
+        )
+        self._conn.commit()
+        self._add_text_hashes()
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_text_hash ON chunks (text_hash)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS document_chunks ("
+            "document_id TEXT NOT NULL, chunk_id TEXT NOT NULL, PRIMARY KEY (document_id, chunk_id))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS document_chunks_chunk_id ON document_chunks (chunk_id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS store_info (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+        self._count = None
+
+    def _add_text_hashes(self):
+        # 旧版 chunk store 没有 text_hash 列：补上并为已有行计算哈希，多个进程同时打开时只有一个执行
+        if "text_hash" in {row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")}:
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if "text_hash" not in {row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")}:
+                self._conn.create_function("text_hash", 1, text_hash, deterministic=True)
+                self._conn.execute("ALTER TABLE chunks ADD COLUMN text_hash TEXT")
+                self._conn.execute("UPDATE chunks SET text_hash = text_hash(text)")
+                logger.info(f"Added text hashes to {self.path}")
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+
+    def import_documents(self, documents):
+        """
+        Copy the {document_id: [chunk_id, ...]} map that older manifests
+        held into the store, once: later changes to the map must not be
+        overwritten by a process still reading an old manifest.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                imported = self._conn.execute("SELECT 1 FROM store_info WHERE key = 'documents_imported'").fetchone()
+                if not imported:
+                    self._conn.executemany(
+                        "INSERT OR IGNORE INTO document_chunks (document_id, chunk_id) VALUES (?, ?)",
+                        [(str(document_id), chunk_id) for document_id, chunk_ids in documents.items()
+                         for chunk_id in chunk_ids]
+                    )
+                    self._conn.execute("INSERT INTO store_info (key, value) VALUES ('documents_imported', '1')")
+                    logger.info(f"Imported chunk references of {len(documents)} documents into {self.path}")
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    @classmethod
+    def create(cls, path, chunk_ids, texts, metadatas, positions=None, documents=None):
+        """
+        Write a new store holding the given chunks (at positions 0..n-1
+        unless given) and the {document_id: [chunk_id, ...]} map, and close it.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        store = cls(path)
+        store.add(positions if positions is not None else range(len(chunk_ids)), chunk_ids, texts, metadatas)
+        store.import_documents(documents or {})
+        store.close()
+
+    def __len__(self):
+        with self._lock:
+            if self._count is None:
+                self._count = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+            return self._count
+
+    def add(self, positions, chunk_ids, texts, metadatas):
+        rows = [(position, chunk_id, text, json.dumps(metadata, ensure_ascii=False), text_hash(text))
+                for position, chunk_id, text, metadata in zip(positions, chunk_ids, texts, metadatas)]
+        with self._lock:
+            # 同一文本块 ID 再次写入时替换旧行（旧位置的向量随之成为墓碑）
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO chunks (position, chunk_id, text, metadata, text_hash) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+            self._count = None
+
+    def delete(self, chunk_ids):
+        chunk_ids = list(chunk_ids)
+        with self._lock:
+            for start in range(0, len(chunk_ids), _BATCH):
+                batch = chunk_ids[start:start + _BATCH]
+                self._conn.execute(f"DELETE FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})", batch)
+            self._conn.commit()
+            self._count = None
+
+    def chunk_ids_at(self, positions):
+        """Return {position: chunk_id} for the positions that hold a live chunk."""
+        positions = [int(p) for p in positions]
+        found = {}
+        with self._lock:
+            for start in range(0, len(positions), _BATCH):
+                batch = positions[start:start + _BATCH]
+                found.update(self._conn.execute(
+                    f"SELECT position, chunk_id FROM chunks WHERE position IN ({','.join('?' * len(batch))})", batch
+                ).fetchall())
+        return found
+
+    def positions_of(self, chunk_ids):
+        """Return {chunk_id: position} for the chunk IDs that exist."""
+        chunk_ids = list(chunk_ids)
+        found = {}
+        with self._lock:
+            for start in range(0, len(chunk_ids), _BATCH):
+                batch = chunk_ids[start:start + _BATCH]
+                found.update(self._conn.execute(
+                    f"SELECT chunk_id, position FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})", batch
+                ).fetchall())
+        return found
+
+    def find_texts(self, texts):
+        """Return {text: chunk_id} for the texts that some stored chunk holds verbatim."""
+        texts = set(texts)
+        hashes = list({text_hash(text) for text in texts})
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), _BATCH):
+                batch = hashes[start:start + _BATCH]
+                for chunk_id, text in self._conn.execute(
+                    f"SELECT chunk_id, text FROM chunks WHERE text_hash IN ({','.join('?' * len(batch))})", batch
+                ):
+                    # 按索引找到候选行，再比较原文
+                    if text in texts:
+                        found[text] = chunk_id
+        return found
+
+    def update_metadata(self, metadatas):
+        """Replace the metadata of existing chunks, given {chunk_id: metadata}."""
+        rows = [(json.dumps(metadata, ensure_ascii=False), chunk_id) for chunk_id, metadata in metadatas.items()]
+        with self._lock:
+            self._conn.executemany("UPDATE chunks SET metadata = ? WHERE chunk_id = ?", rows)
+            self._conn.commit()
+
+    def document_chunk_ids(self, document_id):
+        """IDs of the chunks a document refers to; empty if the document is not indexed."""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                "SELECT chunk_id FROM document_chunks WHERE document_id = ?", (str(document_id),)
+            )]
+
+    def set_document_chunks(self, document_id, chunk_ids):
+        with self._lock:
+            self._conn.execute("DELETE FROM document_chunks WHERE document_id = ?", (str(document_id),))
+            self._conn.executemany("INSERT OR IGNORE INTO document_chunks (document_id, chunk_id) VALUES (?, ?)",
+                                   [(str(document_id), chunk_id) for chunk_id in chunk_ids])
+            self._conn.commit()
+
+    def delete_document(self, document_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM document_chunks WHERE document_id = ?", (str(document_id),))
+            self._conn.commit()
+
+    def chunk_owners(self, chunk_ids, excluding):
+        """Return {chunk_id: document_id} for the chunks some document other than `excluding` refers to."""
+        chunk_ids = list(chunk_ids)
+        found = {}
+        with self._lock:
+            for start in range(0, len(chunk_ids), _BATCH):
+                batch = chunk_ids[start:start + _BATCH]
+                for chunk_id, document_id in self._conn.execute(
+                    f"SELECT chunk_id, document_id FROM document_chunks "
+                    f"WHERE chunk_id IN ({','.join('?' * len(batch))}) AND document_id != ?",
+                    batch + [str(excluding)]
+                ):
+                    found.setdefault(chunk_id, document_id)
+        return found
+
+    def tagged_count(self):
+        """Number of chunks some document refers to."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(DISTINCT chunk_id) FROM document_chunks").fetchone()[0]
+
+    def documents(self):
+        """The whole {document_id: [chunk_id, ...]} map."""
+        documents = {}
+        with self._lock:
+            for document_id, chunk_id in self._conn.execute("SELECT document_id, chunk_id FROM document_chunks"):
+                documents.setdefault(document_id, []).append(chunk_id)
+        return documents
+
+    def chunk_ids(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT chunk_id FROM chunks")]
+
+    def get(self, chunk_ids):
+        """Return {chunk_id: Document} for the chunk IDs that exist."""
+        chunk_ids = list(chunk_ids)
+        found = {}
+        with self._lock:
+            for start in range(0, len(chunk_ids), _BATCH):
+                batch = chunk_ids[start:start + _BATCH]
+                rows = self._conn.execute(
+                    f"SELECT chunk_id, text, metadata FROM chunks WHERE chunk_id IN ({','.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+                for chunk_id, text, metadata in rows:
+                    found[chunk_id] = Document(page_content=text, metadata=json.loads(metadata))
+        return found
+
+    def iter_chunks(self, batch_size=1000):
+        """Yield (position, chunk_id, text, metadata) for every chunk, in position order."""
+        last = -1
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT position, chunk_id, text, metadata FROM chunks WHERE position > ? ORDER BY position LIMIT ?",
+                    (last, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for position, chunk_id, text, metadata in rows:
+                yield position, chunk_id, text, json.loads(metadata)
+            last = rows[-1][0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_pickled_docstore(directory):
+    """
+    Convert the index.pkl written by LangChain's FAISS.save_local (a pickled
+    InMemoryDocstore and index_to_docstore_id map) into a ChunkStore, then
+    delete the pickle. Only run this on files this application wrote:
+    unpickling executes code. Returns the number of chunks migrated, or
+    None when the directory has no pickle.
+    """
+    pickle_path = os.path.join(directory, "index.pkl")
+    if not os.path.exists(pickle_path):
+        return None
+    with open(pickle_path, 'rb') as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+
+    positions = sorted(index_to_docstore_id)
+    chunk_ids = [index_to_docstore_id[position] for position in positions]
+    docs = [docstore.search(chunk_id) for chunk_id in chunk_ids]
+    staging_path = os.path.join(directory, f"{ChunkStore.FILE_NAME}.tmp")
+    ChunkStore.create(staging_path, chunk_ids, [doc.page_content for doc in docs],
+                      [doc.metadata for doc in docs], positions=positions)
+    os.replace(staging_path, os.path.join(directory, ChunkStore.FILE_NAME))
+    os.remove(pickle_path)
+    logger.info(f"Migrated {len(chunk_ids)} chunks of {directory} from index.pkl to {ChunkStore.FILE_NAME}")
+    return len(chunk_ids)
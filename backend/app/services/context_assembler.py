@@ -0,0 +1,67 @@
+from .lexical_index import CJK_CHAR
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text):
+    """Rough token count for budgeting; it only needs to be consistent across chunks, not exact."""
+    # 汉字、假名、韩文每个字符约为一个 token，其他文本约 4 个字符一个 token
+    cjk = len(CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def assemble_context(query_vector, docs, doc_vectors, token_budget, mmr_lambda=0.7, duplicate_threshold=0.95):
+    """
+    Choose which retrieved chunks go into the prompt:
+
+    1. drop chunks whose embedding has cosine similarity >= duplicate_threshold
+       with a better-ranked chunk (overlapping passages, repeated boilerplate);
+    2. order the rest by maximal marginal relevance,
+       mmr_lambda * sim(query, d) - (1 - mmr_lambda) * max sim(d, already chosen);
+    3. take chunks in that order while they fit in token_budget, skipping
+       any chunk too large for the space left.
+
+    docs are best first. Returns (chosen docs, report) where the report
+    counts candidates, duplicates and tokens used and saved.
+    """
+    report = {"candidates": len(docs), "duplicates": 0, "selected": 0, "tokens": 0, "tokens_saved": 0}
+    if not docs:
+        return [], report
+
+    tokens = np.array([estimate_tokens(doc.page_content) for doc in docs])
+    vectors = _normalize(doc_vectors)
+    relevance = vectors @ _normalize(query_vector)
+    similarity = vectors @ vectors.T
+
+    # 与排名更靠前的文本块近似重复的丢弃，保留排名靠前的那个
+    duplicate = np.triu(similarity >= duplicate_threshold, k=1).any(axis=0)
+    remaining = np.flatnonzero(~duplicate)
+    report["duplicates"] = int(duplicate.sum())
+
+    chosen = []
+    used = 0
+    # 每个候选与已选文本块的最大相似度，每选一个向量化更新一次
+    max_similarity = np.full(len(docs), -np.inf, dtype=np.float32)
+    while remaining.size:
+        redundancy = np.where(np.isfinite(max_similarity[remaining]), max_similarity[remaining], 0.0)
+        scores = mmr_lambda * relevance[remaining] - (1 - mmr_lambda) * redundancy
+        best = remaining[int(np.argmax(scores))]
+        remaining = remaining[remaining != best]
+        if used + tokens[best] > token_budget:
+            continue
+        chosen.append(int(best))
+        used += int(tokens[best])
+        max_similarity = np.maximum(max_similarity, similarity[best])
+
+    report["selected"] = len(chosen)
+    report["tokens"] = used
+    report["tokens_saved"] = int(tokens.sum()) - used
+    return [docs[i] for i in chosen], report
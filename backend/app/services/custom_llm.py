@@ -1,8 +1,85 @@
 from langchain.llms.base import LLM
-from typing import Any, List, Optional, Dict
+from langchain_core.outputs import GenerationChunk
+from typing import Any, List, Optional, Dict, Iterator
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import requests
+import httpx
 from pydantic import Field
+from config import Config
+from ..utils.metrics import LLM_RETRIES
+import asyncio
+import json
 import logging
+import random
+import threading
+import time
+import weakref
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+# httpx.AsyncClient 绑定在创建它的事件循环上，每个循环各用一个
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_session() -> requests.Session:
+    """The process-wide keep-alive session used for all LLM API calls."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=Config.LLM_POOL_SIZE, pool_maxsize=Config.LLM_POOL_SIZE,
+                                  max_retries=0)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(Config.LLM_READ_TIMEOUT, connect=Config.LLM_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=Config.LLM_POOL_SIZE, max_keepalive_connections=Config.LLM_POOL_SIZE)
+        )
+        _async_clients[loop] = client
+    return client
+
+
+def _backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Full-jitter exponential backoff, honouring a numeric Retry-After header."""
+    if retry_after:
+        try:
+            return min(float(retry_after), Config.LLM_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(Config.LLM_BACKOFF_MAX, Config.LLM_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _connect_failed(error: requests.exceptions.RequestException) -> bool:
+    """
+    Whether a request failed before reaching the server. Only these are
+    retried: after a read timeout or a dropped connection the server may
+    still be generating the completion, and sending it again would pay
+    for it twice.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    # 连接池不重试时，建立连接失败表现为 ConnectionError(MaxRetryError(reason=NewConnectionError))
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
+
+
+def _retry_allowed(attempt: int, delay: float, deadline: float) -> bool:
+    # 重试次数和总耗时都有上限：退避结束时已超过截止时间就不再重试
+    return attempt < Config.LLM_MAX_RETRIES and time.monotonic() + delay < deadline
+
 
 class CustomAPILLM(LLM):
     api_url: str = Field(..., description="API URL for the custom LLM")
@@ -13,49 +90,165 @@ class CustomAPILLM(LLM):
         self.api_url = api_url
         self.api_key = api_key
 
-    def _call(self, prompt: str, stop: Optional[List[str]] = None) -> str:
-        headers = {
+    def _headers(self) -> Dict[str, str]:
+        return {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json"
         }
-        data = {
+
+    def _payload(self, prompt: str, stop: Optional[List[str]], stream: bool) -> Dict[str, Any]:
+        return {
             "model": "glm-4",
             "messages": [{"role": "user", "content": prompt}],
             "max_tokens": 4096,
             "stop": stop,
-            "stream": False,
+            "stream": stream,
         }
-        try:
-            response = requests.post(self.api_url, headers=headers, json=data)
-            response.raise_for_status()
-
-            logging.info(f"API Response: {response.text}")
-
-            json_response = response.json()
-            logging.info(f"JSON Response: {json_response}")
-
-            if 'choices' in json_response and len(json_response['choices']) > 0:
-                choice = json_response['choices'][0]
-                if 'message' in choice and 'content' in choice['message']:
-                    return choice['message']['content'].strip()
-                elif 'text' in choice:
-                    return choice['text'].strip()
-                else:
-                    logging.error(f"Unexpected choice structure: {choice}")
-                    return "Error: Unexpected API response structure"
+
+    def _post(self, data: Dict[str, Any], stream: bool = False) -> requests.Response:
+        """
+        POST through the pooled session, retrying failed connects and
+        429/5xx responses until LLM_MAX_RETRIES or LLM_REQUEST_DEADLINE
+        is reached. Read timeouts are not retried.
+        """
+        deadline = time.monotonic() + Config.LLM_REQUEST_DEADLINE
+        for attempt in range(Config.LLM_MAX_RETRIES + 1):
+            # 每次尝试的读超时不超过剩余的总时间
+            read_timeout = max(0.1, min(Config.LLM_READ_TIMEOUT, deadline - time.monotonic()))
+            try:
+                response = get_session().post(self.api_url, headers=self._headers(), json=data,
+                                              timeout=(Config.LLM_CONNECT_TIMEOUT, read_timeout), stream=stream)
+            except requests.exceptions.RequestException as e:
+                delay = _backoff_delay(attempt)
+                if not _connect_failed(e) or not _retry_allowed(attempt, delay, deadline):
+                    raise
+                logger.warning(f"API connection failed ({str(e)}), retrying in {delay:.2f}s")
+                LLM_RETRIES.inc("connection")
+            else:
+                delay = _backoff_delay(attempt, response.headers.get("Retry-After"))
+                if response.status_code not in RETRYABLE_STATUS_CODES or not _retry_allowed(attempt, delay, deadline):
+                    response.raise_for_status()
+                    return response
+                logger.warning(f"API returned {response.status_code}, retrying in {delay:.2f}s")
+                LLM_RETRIES.inc(str(response.status_code))
+                response.close()
+            time.sleep(delay)
+
+    async def _apost(self, data: Dict[str, Any]) -> httpx.Response:
+        """Async counterpart of _post(), with the same retry policy."""
+        client = get_async_client()
+        deadline = time.monotonic() + Config.LLM_REQUEST_DEADLINE
+        for attempt in range(Config.LLM_MAX_RETRIES + 1):
+            read_timeout = max(0.1, min(Config.LLM_READ_TIMEOUT, deadline - time.monotonic()))
+            try:
+                response = await client.post(self.api_url, headers=self._headers(), json=data,
+                                             timeout=httpx.Timeout(read_timeout, connect=Config.LLM_CONNECT_TIMEOUT))
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                delay = _backoff_delay(attempt)
+                if not _retry_allowed(attempt, delay, deadline):
+                    raise
+                logger.warning(f"API connection failed ({str(e)}), retrying in {delay:.2f}s")
+                LLM_RETRIES.inc("connection")
+            else:
+                delay = _backoff_delay(attempt, response.headers.get("Retry-After"))
+                if response.status_code not in RETRYABLE_STATUS_CODES or not _retry_allowed(attempt, delay, deadline):
+                    response.raise_for_status()
+                    return response
+                logger.warning(f"API returned {response.status_code}, retrying in {delay:.2f}s")
+                LLM_RETRIES.inc(str(response.status_code))
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _log_response(content: bytes, started: float):
+        logger.info(f"API response: {len(content)} bytes in {(time.perf_counter() - started) * 1000:.0f} ms")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"API response body: {content[:10000]!r}")
+
+    @staticmethod
+    def _parse_response(json_response: Dict[str, Any]) -> str:
+        if 'choices' in json_response and len(json_response['choices']) > 0:
+            choice = json_response['choices'][0]
+            if 'message' in choice and 'content' in choice['message']:
+                return choice['message']['content'].strip()
+            elif 'text' in choice:
+                return choice['text'].strip()
             else:
-                logging.error(f"Unexpected API response structure: {json_response}")
+                logger.error(f"Unexpected choice structure: {choice}")
                 return "Error: Unexpected API response structure"
+        else:
+            logger.error(f"Unexpected API response structure: {json_response}")
+            return "Error: Unexpected API response structure"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        data = self._payload(prompt, stop, stream=False)
+        started = time.perf_counter()
+        try:
+            response = self._post(data)
+            self._log_response(response.content, started)
+            return self._parse_response(response.json())
         except requests.exceptions.RequestException as e:
-            logging.error(f"API request failed: {str(e)}")
+            logger.error(f"API request failed: {str(e)}")
             return f"Error: API request failed - {str(e)}"
         except ValueError as e:
-            logging.error(f"JSON decode error: {str(e)}")
+            logger.error(f"JSON decode error: {str(e)}")
             return f"Error: Invalid JSON response - {str(e)}"
         except KeyError as e:
-            logging.error(f"KeyError in API response: {str(e)}")
+            logger.error(f"KeyError in API response: {str(e)}")
             return f"Error: Unexpected API response structure - {str(e)}"
 
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        data = self._payload(prompt, stop, stream=False)
+        started = time.perf_counter()
+        try:
+            response = await self._apost(data)
+            self._log_response(response.content, started)
+            return self._parse_response(response.json())
+        except httpx.HTTPError as e:
+            logger.error(f"API request failed: {str(e)}")
+            return f"Error: API request failed - {str(e)}"
+        except ValueError as e:
+            logger.error(f"JSON decode error: {str(e)}")
+            return f"Error: Invalid JSON response - {str(e)}"
+        except KeyError as e:
+            logger.error(f"KeyError in API response: {str(e)}")
+            return f"Error: Unexpected API response structure - {str(e)}"
+
+    def _stream(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> Iterator[GenerationChunk]:
+        """
+        Stream the completion using the API's server-sent events protocol
+        ("data: {...}" lines terminated by "data: [DONE]"). Closing the
+        generator closes the upstream connection.
+        """
+        data = self._payload(prompt, stop, stream=True)
+        started = time.perf_counter()
+        with self._post(data, stream=True) as response:
+            response.encoding = 'utf-8'
+            first_token = True
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(payload)
+                except ValueError:
+                    logger.error(f"Invalid JSON in stream chunk: {payload[:200]}")
+                    continue
+                choices = chunk.get('choices') or []
+                if not choices:
+                    continue
+                choice = choices[0]
+                text = (choice.get('delta') or {}).get('content') or choice.get('text') or ''
+                if text:
+                    if first_token:
+                        logger.info(f"First streamed token after {(time.perf_counter() - started) * 1000:.0f} ms")
+                        first_token = False
+                    generation = GenerationChunk(text=text)
+                    if run_manager:
+                        run_manager.on_llm_new_token(text, chunk=generation)
+                    yield generation
+
     @property
     def _llm_type(self) -> str:
         return "custom_api"
@@ -63,4 +256,4 @@ class CustomAPILLM(LLM):
     @property
     def _identifying_params(self) -> Dict[str, Any]:
         """Get the identifying parameters."""
-        return {"api_url": self.api_url}
\ No newline at end of file
+        return {"api_url": self.api_url}
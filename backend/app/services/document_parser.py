@@ -0,0 +1,221 @@
+from unstructured.partition.auto import partition
+from unstructured import __version__ as unstructured_version
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from config import Config
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+import logging
+import mimetypes
+
+logger = logging.getLogger(__name__)
+
+# 解析器升级后旧的缓存结果自动失效
+PARSER_VERSION = f"unstructured-{unstructured_version}"
+
+
+def file_hash(file_path, chunk_size=1024 * 1024):
+    """sha256 of a file's content, read in chunks."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def partition_file(file_path):
+    """Run unstructured on a file and keep only what indexing needs: text and category."""
+    elements = partition(filename=file_path)
+    logger.info(f"Partitioned {len(elements)} elements from {file_path}")
+    for i, element in enumerate(elements):
+        logger.debug(f"Element {i}: Type: {type(element)}, Category: {element.category}")
+        logger.debug(f"Element {i} content preview: {str(element)[:100]}...")
+    return [{"text": str(element), "category": element.category}
+            for element in elements if hasattr(element, 'text')]
+
+
+class PartitionCache:
+    """
+    On-disk cache of partition results, one zlib-compressed JSON file per
+    (organization, file content hash, parser version).
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _organization_dir(self, organization_id):
+        return os.path.join(self.root, f"organization_{organization_id}")
+
+    def _path(self, organization_id, digest):
+        return os.path.join(self._organization_dir(organization_id), f"{digest}-{PARSER_VERSION}.json.z")
+
+    def contains(self, organization_id, digest):
+        return os.path.exists(self._path(organization_id, digest))
+
+    def get(self, organization_id, digest):
+        path = self._path(organization_id, digest)
+        try:
+            with open(path, 'rb') as f:
+                return json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, zlib.error) as e:
+            logger.warning(f"Discarding unreadable parse cache entry {path}: {str(e)}")
+            self._remove(path)
+            return None
+
+    def put(self, organization_id, digest, elements):
+        directory = self._organization_dir(organization_id)
+        os.makedirs(directory, exist_ok=True)
+        payload = zlib.compress(json.dumps(elements, ensure_ascii=False).encode('utf-8'), 6)
+        # 先写临时文件再原子替换，避免并发读到半截文件
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, self._path(organization_id, digest))
+        except Exception:
+            self._remove(tmp_path)
+            raise
+
+    def purge(self, organization_id):
+        """Delete every cached parse result of an organization, returning how many were removed."""
+        directory = self._organization_dir(organization_id)
+        if not os.path.isdir(directory):
+            return 0
+        count = sum(1 for name in os.listdir(directory) if name.endswith('.json.z'))
+        shutil.rmtree(directory, ignore_errors=True)
+        logger.info(f"Purged {count} parse cache entries of organization {organization_id}")
+        return count
+
+    def stats(self, organization_id):
+        directory = self._organization_dir(organization_id)
+        entries, size = 0, 0
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                if name.endswith('.json.z'):
+                    entries += 1
+                    size += os.path.getsize(os.path.join(directory, name))
+        return {"entries": entries, "bytes": size, "parser_version": PARSER_VERSION}
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_partition_cache = PartitionCache(Config.PARSE_CACHE_FOLDER)
+
+
+def get_partition_cache():
+    return _partition_cache
+
+
+def parse_document(file_path, organization_id):
+    """
+    Return the [{"text", "category"}] elements of a file, using the
+    organization's parse cache when the same content was parsed before.
+    """
+    file_size = os.path.getsize(file_path)
+    mime_type, _ = mimetypes.guess_type(file_path)
+    logger.info(f"File size: {file_size} bytes, MIME type: {mime_type}")
+
+    digest = file_hash(file_path)
+    elements = _partition_cache.get(organization_id, digest)
+    if elements is not None:
+        logger.info(f"Parse cache hit for {file_path} ({len(elements)} elements)")
+        return elements
+
+    logger.info("Partitioning document with unstructured")
+    elements = partition_file(file_path)
+    _partition_cache.put(organization_id, digest, elements)
+    return elements
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    """
+    Process pool for the CPU-bound partition work (PDF layout, OCR).
+    Uses spawn so children never inherit locks held by the parent's threads.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(max_workers=Config.PARSE_PROCESSES,
+                                              mp_context=multiprocessing.get_context('spawn'))
+        return _parse_pool
+
+
+def reset_parse_pool(broken):
+    """
+    Replace a pool broken by a crashed child (e.g. a segfault in a native
+    parser). Does nothing when another thread already replaced `broken`.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not broken:
+            return
+        _parse_pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
+
+
+def _warm_document(file_path, organization_id):
+    """Parse a file into the cache unless it is cached already. Returns True when it had to be parsed."""
+    digest = file_hash(file_path)
+    if _partition_cache.contains(organization_id, digest):
+        return False
+    _partition_cache.put(organization_id, digest, partition_file(file_path))
+    return True
+
+
+def warm_partition_cache(organization_id, file_paths):
+    """
+    Submit every given file to the parse pool to be cached, without
+    waiting for them; the outcome is logged once all are done. Returns the
+    number of files submitted.
+    """
+    file_paths = list(file_paths)
+    if not file_paths:
+        return 0
+    counts = {"parsed": 0, "cached": 0, "failed": 0}
+    pending = [len(file_paths)]
+    lock = threading.Lock()
+
+    def done(future, path, pool):
+        try:
+            outcome = "parsed" if future.result() else "cached"
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                reset_parse_pool(pool)
+            logger.error(f"Error warming parse cache for {path}: {str(e)}")
+            outcome = "failed"
+        with lock:
+            counts[outcome] += 1
+            pending[0] -= 1
+            if pending[0]:
+                return
+        logger.info(f"Warmed parse cache of organization {organization_id}: {counts['parsed']} parsed, "
+                    f"{counts['cached']} already cached, {counts['failed']} failed")
+
+    pool = get_parse_pool()
+    for path in file_paths:
+        try:
+            future = pool.submit(_warm_document, path, organization_id)
+        except BrokenProcessPool:
+            # 池已损坏：换新池后继续提交
+            reset_parse_pool(pool)
+            pool = get_parse_pool()
+            future = pool.submit(_warm_document, path, organization_id)
+        future.add_done_callback(lambda future, path=path, pool=pool: done(future, path, pool))
+    return len(file_paths)
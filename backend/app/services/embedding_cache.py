@@ -0,0 +1,305 @@
+from langchain_core.embeddings import Embeddings
+from array import array
+from collections import OrderedDict
+from config import Config
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import logging
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'\s+')
+
+# last_used 只在比这更旧时才更新，读取通常不需要写入和提交
+LAST_USED_RESOLUTION = 3600
+
+
+def normalize_text(text):
+    """Normalize a chunk so that trivially different copies share a cache entry."""
+    return _WHITESPACE.sub(' ', unicodedata.normalize('NFC', text)).strip()
+
+
+def cache_key(model, text):
+    return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed embedding cache stored in SQLite.
+
+    Entries are keyed by sha256(model, normalized text) and hold float32
+    vectors. When the cache grows past `max_entries` the least recently
+    used tenth is evicted; recency is tracked to the hour. The number of
+    entries is kept in the database by triggers, so processes sharing the
+    file agree on it.
+    """
+
+    def __init__(self, path, max_entries=500000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT NOT NULL, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        # 条目数由触发器维护，与建表和初始计数在同一事务中完成，其他进程的写入都会计入
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_info (id INTEGER PRIMARY KEY CHECK (id = 0), entries INTEGER NOT NULL)"
+            )
+            self._conn.execute("INSERT OR IGNORE INTO cache_info (id, entries) SELECT 0, COUNT(*) FROM embeddings")
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS embeddings_inserted AFTER INSERT ON embeddings "
+                "BEGIN UPDATE cache_info SET entries = entries + 1 WHERE id = 0; END"
+            )
+            self._conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS embeddings_deleted AFTER DELETE ON embeddings "
+                "BEGIN UPDATE cache_info SET entries = entries - 1 WHERE id = 0; END"
+            )
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+
+    def get_many(self, model, texts):
+        """Return {position: vector} for every text that is already cached."""
+        keys = [cache_key(model, text) for text in texts]
+        positions = {}
+        for i, key in enumerate(keys):
+            positions.setdefault(key, []).append(i)
+
+        found = {}
+        stale = []
+        unique_keys = list(positions)
+        now = time.time()
+        with self._lock:
+            # SQLite 限制单条语句的参数个数，分批查询
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector, last_used FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for key, blob, last_used in rows:
+                    vector = array('f')
+                    vector.frombytes(blob)
+                    for i in positions[key]:
+                        found[i] = vector.tolist()
+                    if last_used < now - LAST_USED_RESOLUTION:
+                        stale.append((now, key))
+            if stale:
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", stale)
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(texts) - len(found)
+        return found
+
+    def put_many(self, model, texts, vectors):
+        now = time.time()
+        rows = [(cache_key(model, text), model, array('f', vector).tobytes(), now)
+                for text, vector in zip(texts, vectors)]
+        with self._lock:
+            # 写锁从插入一直持有到淘汰完成，计数不会被其他进程同时改变
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, model, vector, last_used) VALUES (?, ?, ?, ?)", rows
+                )
+                count = self._entries()
+                if count > self.max_entries:
+                    self._evict(count)
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def get(self, model, text):
+        return self.get_many(model, [text]).get(0)
+
+    def put(self, model, text, vector):
+        self.put_many(model, [text], [vector])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._entries(),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def _entries(self):
+        # 调用方需持有 self._lock
+        return self._conn.execute("SELECT entries FROM cache_info WHERE id = 0").fetchone()[0]
+
+    def _evict(self, count):
+        # 调用方需持有 self._lock，并在写事务中
+        excess = count - int(self.max_entries * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,)
+        )
+        self.evictions += excess
+        logger.info(f"Evicted {excess} entries from embedding cache")
+
+
+class LRUCache:
+    """Small thread-safe in-memory LRU map."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "max_entries": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that consults an EmbeddingCache before calling the
+    underlying model. Models with a separate query path (ones that embed
+    questions differently from passages) compute question vectors through
+    it and cache them under a "query:" namespace; for other models a
+    question vector is the passage vector of the same text, so uncached
+    questions go through `pipeline` in batches. Question vectors are
+    additionally kept in an in-process LRU so repeated questions skip
+    SQLite as well.
+    """
+
+    def __init__(self, embeddings, cache, model, query_cache=None, pipeline=None, separate_query_path=False):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+        self.query_model = f"query:{model}" if separate_query_path else model
+        self.query_cache = query_cache
+        self.pipeline = pipeline
+        self.separate_query_path = separate_query_path
+
+    def embed_documents(self, texts):
+        found = self.cache.get_many(self.model, texts)
+        missing = [i for i in range(len(texts)) if i not in found]
+        if missing:
+            vectors = self.embeddings.embed_documents([texts[i] for i in missing])
+            self.cache.put_many(self.model, [texts[i] for i in missing], vectors)
+            found.update(zip(missing, vectors))
+        return [found[i] for i in range(len(texts))]
+
+    def embed_queries(self, texts):
+        """
+        embed_query() for many texts. Without a separate query path the
+        ones not cached are embedded in batches by the pipeline (rate
+        limited and retried); models with one get a single embed_queries()
+        request if they support it, otherwise one request per question.
+        """
+        keys = [cache_key(self.query_model, text) for text in texts]
+        found = {}
+        if self.query_cache is not None:
+            for i, key in enumerate(keys):
+                vector = self.query_cache.get(key)
+                if vector is not None:
+                    found[i] = vector
+        missing = [i for i in range(len(texts)) if i not in found]
+        if missing and not self.separate_query_path and self.pipeline is not None:
+            # 流水线自己查询和写入嵌入缓存
+            missing_texts = list({texts[i]: None for i in missing})
+            computed = dict(zip(missing_texts, self.pipeline.embed(missing_texts)))
+            found.update((i, computed[texts[i]]) for i in missing)
+            missing = []
+        if missing:
+            stored = self.cache.get_many(self.query_model, [texts[i] for i in missing])
+            found.update((missing[j], vector) for j, vector in stored.items())
+            missing = [i for i in missing if i not in found]
+        if missing:
+            missing_texts = list({texts[i]: None for i in missing})
+            if not self.separate_query_path:
+                vectors = self.embeddings.embed_documents(missing_texts)
+            elif hasattr(self.embeddings, "embed_queries"):
+                vectors = self.embeddings.embed_queries(missing_texts)
+            else:
+                vectors = [self.embeddings.embed_query(text) for text in missing_texts]
+            self.cache.put_many(self.query_model, missing_texts, vectors)
+            computed = dict(zip(missing_texts, vectors))
+            found.update((i, computed[texts[i]]) for i in missing)
+        if self.query_cache is not None:
+            for i, key in enumerate(keys):
+                self.query_cache.put(key, found[i])
+        return [found[i] for i in range(len(texts))]
+
+    def embed_query(self, text):
+        key = cache_key(self.query_model, text)
+        if self.query_cache is not None:
+            vector = self.query_cache.get(key)
+            if vector is not None:
+                return vector
+        vector = self.cache.get(self.query_model, text)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put(self.query_model, text, vector)
+        if self.query_cache is not None:
+            self.query_cache.put(key, vector)
+        return vector
+
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+_query_vector_cache = LRUCache(Config.QUERY_EMBEDDING_CACHE_SIZE)
+
+
+def get_embedding_cache():
+    """The process-wide embedding cache (shared by all organizations)."""
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(Config.EMBEDDING_CACHE_PATH, Config.EMBEDDING_CACHE_MAX_ENTRIES)
+        return _embedding_cache
+
+
+def get_query_vector_cache():
+    """The process-wide question -> vector LRU shared across requests."""
+    return _query_vector_cache
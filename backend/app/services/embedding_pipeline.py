@@ -0,0 +1,172 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .embedding_cache import cache_key
+from config import Config
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, at most `capacity` banked."""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` tokens are available and take them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def drain(self):
+        """Empty the bucket, e.g. after the upstream reported throttling."""
+        with self._lock:
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+
+class NoRateLimit:
+    """Limiter for local models, where a request costs CPU time rather than API quota."""
+
+    def acquire(self, tokens=1):
+        pass
+
+    def drain(self):
+        pass
+
+
+_shared_rate_limiter = None
+_shared_rate_limiter_lock = threading.Lock()
+
+
+def shared_rate_limiter():
+    """The process-wide limiter for embedding API requests (all organizations share one API key)."""
+    global _shared_rate_limiter
+    with _shared_rate_limiter_lock:
+        if _shared_rate_limiter is None:
+            _shared_rate_limiter = TokenBucket(Config.EMBEDDING_RATE_LIMIT, Config.EMBEDDING_RATE_BURST)
+        return _shared_rate_limiter
+
+
+def is_rate_limited(error):
+    """Best-effort detection of HTTP 429 / provider throttling errors."""
+    for obj in (error, getattr(error, 'response', None)):
+        if getattr(obj, 'status_code', None) == 429 or getattr(obj, 'status', None) == 429:
+            return True
+    message = str(error).lower()
+    return '429' in message or 'rate limit' in message or 'too many requests' in message
+
+
+class EmbeddingPipeline:
+    """
+    Embeds texts in batches, running up to `max_concurrency` batches at once
+    under a shared token-bucket rate limit (one token per API request).
+    Failed batches are retried with exponential backoff and jitter. When an
+    EmbeddingCache is given, only texts missing from it are sent upstream.
+    """
+
+    def __init__(self, embeddings, cache=None, model=None, batch_size=None, max_concurrency=None,
+                 rate_limiter=None, max_retries=None, backoff_base=1.0, backoff_max=30.0):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+        self.batch_size = batch_size or Config.EMBEDDING_BATCH_SIZE
+        self.max_concurrency = max_concurrency or Config.EMBEDDING_MAX_CONCURRENCY
+        self.rate_limiter = rate_limiter or shared_rate_limiter()
+        self.max_retries = Config.EMBEDDING_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def embed(self, texts, progress=None):
+        """
+        Return one embedding per text, in input order. `progress`, if given,
+        is called with the number of texts embedded so far.
+        """
+        if not texts:
+            return []
+        if self.cache is None:
+            return self._embed_all(texts, progress)
+
+        found = self.cache.get_many(self.model, texts)
+        missing = [i for i in range(len(texts)) if i not in found]
+        logger.info(f"Embedding cache: {len(found)} hits, {len(missing)} misses")
+        if progress:
+            progress(len(found))
+        if missing:
+            # 同一批次中重复的文本块只嵌入一次
+            unique = {}
+            for i in missing:
+                unique.setdefault(cache_key(self.model, texts[i]), []).append(i)
+            missing_texts = [texts[positions[0]] for positions in unique.values()]
+            hits = len(found)
+            vectors = self._embed_all(missing_texts, progress and (lambda done: progress(hits + done)))
+            self.cache.put_many(self.model, missing_texts, vectors)
+            for positions, vector in zip(unique.values(), vectors):
+                for i in positions:
+                    found[i] = vector
+            if progress:
+                progress(len(texts))
+        return [found[i] for i in range(len(texts))]
+
+    def _embed_all(self, texts, progress=None):
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        logger.info(f"Embedding {len(texts)} chunks in {len(batches)} batches "
+                    f"(batch size {self.batch_size}, concurrency {self.max_concurrency})")
+
+        results = [None] * len(batches)
+        done = 0
+        if len(batches) == 1 or self.max_concurrency <= 1:
+            for i, batch in enumerate(batches):
+                results[i] = self._embed_batch(batch)
+                done += len(batch)
+                if progress:
+                    progress(done)
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(batches)),
+                                    thread_name_prefix="embedding") as executor:
+                futures = {executor.submit(self._embed_batch, batch): i for i, batch in enumerate(batches)}
+                for future in as_completed(futures):
+                    i = futures[future]
+                    results[i] = future.result()
+                    done += len(batches[i])
+                    if progress:
+                        progress(done)
+
+        return [vector for batch in results for vector in batch]
+
+    def _embed_batch(self, batch):
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                vectors = self.embeddings.embed_documents(batch)
+                if len(vectors) != len(batch):
+                    raise ValueError(f"Expected {len(batch)} embeddings, got {len(vectors)}")
+                return vectors
+            except Exception as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    logger.error(f"Embedding batch failed after {self.max_retries} retries: {str(e)}")
+                    raise
+                throttled = is_rate_limited(e)
+                if throttled:
+                    self.rate_limiter.drain()
+                delay = min(self.backoff_max, self.backoff_base * (2 ** (attempt - 1)))
+                delay = random.uniform(delay / 2, delay)
+                logger.warning(f"Embedding batch {'throttled' if throttled else 'failed'} "
+                               f"(attempt {attempt}/{self.max_retries}), retrying in {delay:.1f}s: {str(e)}")
+                time.sleep(delay)
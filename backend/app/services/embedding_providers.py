@@ -0,0 +1,183 @@
+from langchain_core.embeddings import Embeddings
+from .embedding_pipeline import EmbeddingPipeline, NoRateLimit
+from config import Config
+import numpy as np
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingProvider:
+    """
+    A configured embedding backend: the LangChain Embeddings that computes
+    the vectors, the model id that namespaces them in the embedding cache,
+    and how EmbeddingPipeline should drive it. Remote providers share the
+    API rate limit; local ones are bounded only by CPU. Set
+    separate_query_path when embed_query() differs from embed_documents()
+    (e.g. the model prepends a query instruction).
+    """
+
+    def __init__(self, name, model, embeddings, local=False, batch_size=None, max_concurrency=None,
+                 separate_query_path=False):
+        self.name = name
+        self.model = model
+        self.embeddings = embeddings
+        self.local = local
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.separate_query_path = separate_query_path
+
+    def pipeline(self, cache=None):
+        if not self.local:
+            return EmbeddingPipeline(self.embeddings, cache=cache, model=self.model,
+                                     batch_size=self.batch_size, max_concurrency=self.max_concurrency)
+        # 本地模型的错误不是暂时性的，不重试
+        return EmbeddingPipeline(self.embeddings, cache=cache, model=self.model, batch_size=self.batch_size,
+                                 max_concurrency=self.max_concurrency, rate_limiter=NoRateLimit(), max_retries=0)
+
+    def warm_up(self):
+        if hasattr(self.embeddings, "warm_up"):
+            self.embeddings.warm_up()
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence-embedding model exported to ONNX (model.onnx plus a Hugging
+    Face tokenizer.json in `model_dir`), run on CPU with onnxruntime.
+    Texts are batched by length to keep padding low; the session spreads
+    each batch over `threads` cores. Vectors are L2-normalized.
+    """
+
+    def __init__(self, model_dir, batch_size=32, threads=0, max_length=512, pooling="cls"):
+        try:
+            import onnxruntime
+            from tokenizers import Tokenizer
+        except ImportError as e:
+            raise ImportError("The onnx embedding provider needs the onnxruntime and tokenizers packages") from e
+        if pooling not in ("cls", "mean"):
+            raise ValueError(f"Unknown pooling {pooling!r}, expected 'cls' or 'mean'")
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, "model.onnx"), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length)
+        # 填充到批次内最长的文本
+        self.tokenizer.enable_padding()
+        self.batch_size = batch_size
+        self.pooling = pooling
+
+    def _embed_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": attention_mask,
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        output = self.session.run(None, {name: value for name, value in inputs.items() if name in self.input_names})[0]
+        if output.ndim == 2:
+            # 模型已包含池化层
+            vectors = output
+        elif self.pooling == "mean":
+            mask = attention_mask[:, :, None].astype(output.dtype)
+            vectors = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1)
+        else:
+            vectors = output[:, 0]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-12)).astype(np.float32).tolist()
+
+    def embed_documents(self, texts):
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        vectors = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for i, vector in zip(batch, self._embed_batch([texts[i] for i in batch])):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text):
+        return self._embed_batch([text])[0]
+
+    def warm_up(self):
+        # 首次推理会分配内存并选择算子实现，放在启动时而不是第一个请求里
+        self._embed_batch(["warm up"] * min(self.batch_size, 8))
+
+
+def _zhipuai_provider():
+    from langchain_community.embeddings.zhipuai import ZhipuAIEmbeddings
+    from .rag_service import API_KEY
+    # 模型名沿用 EMBEDDING_MODEL 作为缓存命名空间，升级前缓存的向量仍然有效
+    embeddings = ZhipuAIEmbeddings(model=Config.EMBEDDING_MODEL, api_key=Config.EMBEDDING_API_KEY or API_KEY)
+    return EmbeddingProvider("zhipuai", Config.EMBEDDING_MODEL, embeddings)
+
+
+def _onnx_provider():
+    model_dir = Config.ONNX_EMBEDDING_MODEL_DIR
+    embeddings = OnnxEmbeddings(model_dir, batch_size=Config.ONNX_EMBEDDING_BATCH_SIZE,
+                                threads=Config.ONNX_EMBEDDING_THREADS, max_length=Config.ONNX_EMBEDDING_MAX_LENGTH,
+                                pooling=Config.ONNX_EMBEDDING_POOLING)
+    model = f"onnx:{os.path.basename(os.path.normpath(model_dir))}:{Config.ONNX_EMBEDDING_POOLING}"
+    # onnxruntime 已在一个批次内使用多核，并发批次只会争抢 CPU
+    return EmbeddingProvider("onnx", model, embeddings, local=True,
+                             batch_size=Config.ONNX_EMBEDDING_BATCH_SIZE, max_concurrency=1)
+
+
+_factories = {"zhipuai": _zhipuai_provider, "onnx": _onnx_provider}
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def register_provider(name, factory):
+    """Make `factory()` -> EmbeddingProvider available as EMBEDDING_PROVIDER=name."""
+    with _providers_lock:
+        _factories[name] = factory
+        _providers.pop(name, None)
+
+
+def get_provider(name):
+    """The process-wide instance of a provider, created on first use (local models are loaded once)."""
+    with _providers_lock:
+        provider = _providers.get(name)
+        if provider is None:
+            if name not in _factories:
+                raise ValueError(f"Unknown embedding provider {name!r}")
+            logger.info(f"Loading embedding provider {name}")
+            provider = _providers[name] = _factories[name]()
+        return provider
+
+
+def _overrides():
+    overrides = {}
+    for item in Config.EMBEDDING_PROVIDER_OVERRIDES.split(","):
+        if item.strip():
+            organization_id, name = item.split("=", 1)
+            overrides[int(organization_id)] = name.strip()
+    return overrides
+
+
+def provider_name_for(organization_id):
+    """The embedding provider the deployment assigns to an organization."""
+    return _overrides().get(int(organization_id), Config.EMBEDDING_PROVIDER)
+
+
+def configured_provider_names():
+    return {Config.EMBEDDING_PROVIDER} | set(_overrides().values())
+
+
+def warm_up_providers():
+    """Load every configured local provider and run one batch through it, so the first request is not slowed."""
+    for name in sorted(configured_provider_names()):
+        try:
+            provider = get_provider(name)
+            if provider.local:
+                provider.warm_up()
+                logger.info(f"Embedding provider {name} warmed up")
+        except Exception as e:
+            logger.error(f"Warming up embedding provider {name} failed: {str(e)}")
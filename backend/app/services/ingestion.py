@@ -0,0 +1,329 @@
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from ..models import Document
+from ..extensions import db
+from .document_parser import get_parse_pool, reset_parse_pool, parse_document
+from ..utils.metrics import STAGE_SECONDS
+from config import Config
+import os
+import socket
+import threading
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+QUEUE_KEY = "ingest:queue"
+# 组织被锁定时任务暂存在这里，score 为可以重试的时间
+DELAYED_KEY = "ingest:delayed"
+LOCKED_RETRY_DELAY = 5  # 秒
+JOB_TTL = 7 * 24 * 3600  # 任务状态保留 7 天
+ORGANIZATION_JOB_HISTORY = 200
+
+# 只有持有者才能释放锁
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# 只有持有者才能续期
+_RENEW_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# 把到期的暂存任务放回队尾
+_PROMOTE_DELAYED_SCRIPT = """
+local due = redis.call('zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 100)
+for _, job_id in ipairs(due) do
+    redis.call('zrem', KEYS[1], job_id)
+    redis.call('lpush', KEYS[2], job_id)
+end
+return #due
+"""
+
+
+class OrganizationLocked(Exception):
+    """Another process is currently writing this organization's index."""
+
+
+@contextmanager
+def organization_lock(redis_client, organization_id, wait=0):
+    """
+    Cross-process lock serializing index writes of one organization.
+    Waits up to `wait` seconds before raising OrganizationLocked. While it
+    is held, a background thread renews it every third of
+    INGESTION_LOCK_TIMEOUT, so it only expires if the holder dies.
+    """
+    key = f"ingest:lock:{organization_id}"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + wait
+    while not redis_client.set(key, token, nx=True, ex=Config.INGESTION_LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            raise OrganizationLocked(f"Index of organization {organization_id} is being updated")
+        time.sleep(0.2)
+    released = threading.Event()
+    threading.Thread(target=_renew_lock, args=(redis_client, key, token, released),
+                     name=f"organization-lock-{organization_id}", daemon=True).start()
+    try:
+        yield
+    finally:
+        released.set()
+        redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, key, token)
+
+
+def _renew_lock(redis_client, key, token, released):
+    while not released.wait(Config.INGESTION_LOCK_TIMEOUT / 3):
+        try:
+            if not redis_client.eval(_RENEW_LOCK_SCRIPT, 1, key, token, Config.INGESTION_LOCK_TIMEOUT * 1000):
+                logger.warning(f"Lock {key} was lost before it was released")
+                return
+        except Exception as e:
+            logger.warning(f"Renewing lock {key} failed: {str(e)}")
+
+
+_compacting = set()
+_compacting_lock = threading.Lock()
+
+
+def schedule_compaction(app, organization_id):
+    """
+    Compact an organization's vector index in a background thread, once
+    the organization lock is free, or migrate it to a newly configured
+    embedding provider (which compacts it as well). At most one compaction
+    per organization runs in a process at a time.
+    """
+    with _compacting_lock:
+        if organization_id in _compacting:
+            return
+        _compacting.add(organization_id)
+    threading.Thread(target=_compact, args=(app, organization_id),
+                     name=f"index-compaction-{organization_id}", daemon=True).start()
+
+
+def _compact(app, organization_id):
+    try:
+        with app.app_context():
+            with organization_lock(app.redis, organization_id, wait=Config.INGESTION_LOCK_TIMEOUT):
+                rag_system = app.rag_registry.get(organization_id)
+                if rag_system.needs_reembedding():
+                    rag_system.reembed()
+                elif rag_system.needs_compaction():
+                    rag_system.compact_index()
+                else:
+                    return
+                app.rag_registry.mark_updated(organization_id)
+                app.answer_cache.invalidate(organization_id)
+    except Exception as e:
+        logger.error(f"Index compaction of organization {organization_id} failed: {str(e)}")
+    finally:
+        with _compacting_lock:
+            _compacting.discard(organization_id)
+
+
+class IngestionQueue:
+    """
+    Durable ingestion queue in Redis. Each job is a hash at ingest:job:<id>
+    holding its status (queued, parsing, embedding, indexed, failed or
+    cancelled) and per-stage chunk counts (parsed, embedded, indexed).
+    """
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+
+    @staticmethod
+    def _job_key(job_id):
+        return f"ingest:job:{job_id}"
+
+    def enqueue(self, organization_id, document_id, file_path):
+        job_id = uuid.uuid4().hex
+        job = {
+            "id": job_id,
+            "organization_id": organization_id,
+            "document_id": document_id,
+            "file_path": file_path,
+            "status": "queued",
+            "parsed": 0,
+            "embedded": 0,
+            "indexed": 0,
+            "error": "",
+            "created_at": time.time(),
+        }
+        org_jobs_key = f"ingest:organization:{organization_id}:jobs"
+        pipe = self.redis.pipeline()
+        pipe.hset(self._job_key(job_id), mapping=job)
+        pipe.expire(self._job_key(job_id), JOB_TTL)
+        pipe.lpush(org_jobs_key, job_id)
+        pipe.ltrim(org_jobs_key, 0, ORGANIZATION_JOB_HISTORY - 1)
+        pipe.lpush(QUEUE_KEY, job_id)
+        pipe.execute()
+        logger.info(f"Queued ingestion job {job_id} for document {document_id}")
+        return job_id
+
+    def update(self, job_id, **fields):
+        self.redis.hset(self._job_key(job_id), mapping=fields)
+
+    def get_job(self, job_id):
+        raw = self.redis.hgetall(self._job_key(job_id))
+        if not raw:
+            return None
+        job = {k.decode('utf-8'): v.decode('utf-8') for k, v in raw.items()}
+        for field in ("organization_id", "document_id", "parsed", "embedded", "indexed"):
+            job[field] = int(job[field])
+        for field in ("created_at", "started_at", "finished_at"):
+            if field in job:
+                job[field] = float(job[field])
+        job.pop("file_path", None)
+        return job
+
+    def list_jobs(self, organization_id, limit=50):
+        job_ids = self.redis.lrange(f"ingest:organization:{organization_id}:jobs", 0, limit - 1)
+        jobs = [self.get_job(job_id.decode('utf-8')) for job_id in job_ids]
+        return [job for job in jobs if job is not None]
+
+    def file_path(self, job_id):
+        value = self.redis.hget(self._job_key(job_id), "file_path")
+        return value.decode('utf-8') if value is not None else None
+
+
+class IngestionWorker:
+    """
+    Background threads that take jobs off the queue with BRPOPLPUSH into a
+    per-worker processing list, so jobs held by a crashed worker are
+    requeued when a worker next starts. Parsing runs in the shared process
+    pool; embedding uses the RAG system's thread-pooled pipeline. Jobs of an
+    organization whose index is locked by another writer are parked in a
+    delayed set for LOCKED_RETRY_DELAY seconds, then go back to the end of
+    the queue.
+    """
+
+    def __init__(self, app, threads=None):
+        self.app = app
+        self.redis = app.redis
+        self.queue = app.ingestion_queue
+        self.threads = threads if threads is not None else app.config['INGESTION_WORKER_THREADS']
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.processing_key = f"ingest:processing:{self.worker_id}"
+        self._stop = threading.Event()
+
+    def start(self):
+        self._heartbeat_once()
+        self._recover_orphaned_jobs()
+        threading.Thread(target=self._heartbeat, name="ingestion-heartbeat", daemon=True).start()
+        for i in range(self.threads):
+            threading.Thread(target=self._run, name=f"ingestion-worker-{i}", daemon=True).start()
+        logger.info(f"Started {self.threads} ingestion worker threads ({self.worker_id})")
+
+    def stop(self):
+        self._stop.set()
+
+    def _heartbeat_once(self):
+        self.redis.set(f"ingest:worker:{self.worker_id}", 1, ex=30)
+
+    def _heartbeat(self):
+        while not self._stop.wait(10):
+            try:
+                self._heartbeat_once()
+                self._recover_orphaned_jobs()
+            except Exception as e:
+                logger.warning(f"Ingestion worker heartbeat failed: {str(e)}")
+
+    def _recover_orphaned_jobs(self):
+        for key in self.redis.scan_iter(match="ingest:processing:*"):
+            worker_id = key.decode('utf-8')[len("ingest:processing:"):]
+            if worker_id == self.worker_id or self.redis.exists(f"ingest:worker:{worker_id}"):
+                continue
+            recovered = 0
+            while self.redis.rpoplpush(key, QUEUE_KEY) is not None:
+                recovered += 1
+            if recovered:
+                logger.info(f"Requeued {recovered} ingestion jobs left by worker {worker_id}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.redis.eval(_PROMOTE_DELAYED_SCRIPT, 2, DELAYED_KEY, QUEUE_KEY, time.time())
+                job_id = self.redis.brpoplpush(QUEUE_KEY, self.processing_key, timeout=5)
+            except Exception as e:
+                logger.error(f"Failed to read ingestion queue: {str(e)}")
+                time.sleep(5)
+                continue
+            if job_id is None:
+                continue
+            try:
+                self._process(job_id.decode('utf-8'))
+            except Exception as e:
+                logger.error(f"Unexpected error in ingestion job {job_id}: {str(e)}")
+            finally:
+                self.redis.lrem(self.processing_key, 1, job_id)
+
+    def _process(self, job_id):
+        job = self.queue.get_job(job_id)
+        if job is None:
+            return
+        try:
+            with organization_lock(self.redis, job["organization_id"]):
+                self._ingest(job_id, job)
+        except OrganizationLocked:
+            # 同一组织的索引正在被写入，暂存一段时间后再放回队尾，避免反复取出同一任务
+            self.redis.zadd(DELAYED_KEY, {job_id: time.time() + LOCKED_RETRY_DELAY})
+
+    def _ingest(self, job_id, job):
+        organization_id = job["organization_id"]
+        document_id = job["document_id"]
+        file_path = self.queue.file_path(job_id)
+
+        with self.app.app_context():
+            if Document.query.get(document_id) is None:
+                self.queue.update(job_id, status="cancelled", finished_at=time.time())
+                return
+
+            self.queue.update(job_id, status="parsing", started_at=time.time())
+            try:
+                elements = self._parse(file_path, organization_id)
+                self.queue.update(job_id, status="embedding", parsed=len(elements))
+
+                rag_system = self.app.rag_registry.get(organization_id)
+                rag_system.add_document(file_path, document_id, elements=elements,
+                                        progress=lambda stage, count: self.queue.update(job_id, **{stage: count}))
+                self.app.rag_registry.mark_updated(organization_id)
+                self.app.answer_cache.invalidate(organization_id)
+                self._set_document_status(document_id, "indexed")
+                self.queue.update(job_id, status="indexed", finished_at=time.time())
+                logger.info(f"Ingestion job {job_id} finished for document {document_id}")
+                if rag_system.needs_compaction() or rag_system.needs_reembedding():
+                    schedule_compaction(self.app, organization_id)
+            except Exception as e:
+                logger.error(f"Ingestion job {job_id} failed: {str(e)}")
+                self._set_document_status(document_id, "failed")
+                self.queue.update(job_id, status="failed", error=str(e)[:1000], finished_at=time.time())
+
+    @staticmethod
+    def _set_document_status(document_id, status):
+        # 只有导入成功的文档才算重复上传，失败的文档再次上传时会重新导入
+        try:
+            document = Document.query.get(document_id)
+            if document is not None:
+                document.ingest_status = status
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Failed to record status of document {document_id}: {str(e)}")
+
+    @staticmethod
+    def _parse(file_path, organization_id):
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"File does not exist: {file_path}")
+        pool = get_parse_pool()
+        try:
+            # 解析在子进程中进行，耗时在这里统计；unstructured 的分段结果即为文本块
+            with STAGE_SECONDS.time("parse", str(organization_id)):
+                return pool.submit(parse_document, file_path, organization_id).result()
+        except BrokenProcessPool:
+            reset_parse_pool(pool)
+            raise
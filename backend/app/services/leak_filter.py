@@ -0,0 +1,174 @@
+from collections import deque
+from flask import current_app
+from ..models import Organization
+from .lexical_index import CJK_CHAR
+from config import Config
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "leak_filter:version"
+
+
+def _is_word_char(ch):
+    # 汉字、假名、韩文之间没有空格分隔，这些字符不要求单词边界
+    return ch.isalnum() and not CJK_CHAR.match(ch)
+
+
+class LeakFilter:
+    """
+    Aho-Corasick automaton over every organization's identifiers
+    ("Organization <id>") and names, matched case-insensitively.
+
+    One automaton serves all organizations: each pattern remembers which
+    organization it belongs to, and a scanner for organization X ignores
+    X's own patterns. Patterns match whole words only: a pattern that
+    starts or ends with a letter or digit needs a non-word character or
+    the edge of the text on that side, so "Organization 1" does not fire
+    on "Organization 12" and "Data" does not fire on "database". CJK
+    characters need no boundary. Names in `ignored_names` are too generic
+    to check.
+    """
+
+    def __init__(self, organizations, min_name_length=3, ignored_names=()):
+        ignored = {name.strip().casefold() for name in ignored_names}
+        patterns = [(f"organization {organization_id}", organization_id) for organization_id, _ in organizations]
+        for organization_id, name in organizations:
+            name = (name or "").strip().casefold()
+            if len(name) >= min_name_length and name not in ignored:
+                patterns.append((name, organization_id))
+
+        self.pattern_count = len(patterns)
+        self.max_pattern_length = max((len(p) for p, _ in patterns), default=0)
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for text, owner in patterns:
+            state = 0
+            for ch in text:
+                next_state = self._goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto[state][ch] = next_state
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                state = next_state
+            self._output[state].append((owner, len(text), _is_word_char(text[0]), _is_word_char(text[-1])))
+
+        # 按 BFS 顺序计算失败指针，并合并后缀模式的输出
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(ch, 0)
+                if self._fail[next_state] == next_state:
+                    self._fail[next_state] = 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def _step(self, state, ch):
+        while state and ch not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(ch, 0)
+
+    def scanner(self, organization_id):
+        return LeakScanner(self, organization_id)
+
+    def contains_leak(self, organization_id, text):
+        scanner = self.scanner(organization_id)
+        scanner.feed(text)
+        return scanner.finish()
+
+
+class LeakScanner:
+    """Incremental scanner: feed() text as it streams in; linear in the total length."""
+
+    def __init__(self, leak_filter, organization_id):
+        self.leak_filter = leak_filter
+        self.organization_id = organization_id
+        self.detected = False
+        self._state = 0
+        # 最近读入的字符，用于检查匹配之前的单词边界
+        self._recent = deque(maxlen=leak_filter.max_pattern_length + 1)
+        # 已匹配到模式，等待下一个字符确认其后的单词边界
+        self._pending = False
+
+    def feed(self, text):
+        """Scan the next piece of text. Returns True once a leak has been detected."""
+        if self.detected:
+            return True
+        for ch in text.casefold():
+            if self._pending:
+                if not _is_word_char(ch):
+                    self.detected = True
+                    return True
+                self._pending = False
+            self._recent.append(ch)
+            self._state = self.leak_filter._step(self._state, ch)
+            for owner, length, boundary_before, boundary_after in self.leak_filter._output[self._state]:
+                if owner == self.organization_id:
+                    continue
+                if boundary_before and len(self._recent) > length and _is_word_char(self._recent[-length - 1]):
+                    continue
+                if boundary_after:
+                    self._pending = True
+                else:
+                    self.detected = True
+                    return True
+        return False
+
+    def finish(self):
+        """Call at the end of the text: a match right at the end has its boundary."""
+        return self.detected or self._pending
+
+
+_leak_filter = None
+_leak_filter_version = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def get_leak_filter():
+    """
+    The process-wide LeakFilter, built from the Organization table. Other
+    processes signal changes by bumping a version counter in Redis, which
+    is checked at most every LEAK_FILTER_REFRESH_SECONDS.
+    """
+    global _leak_filter, _leak_filter_version, _checked_at
+    with _lock:
+        now = time.monotonic()
+        if _leak_filter is not None and now - _checked_at < Config.LEAK_FILTER_REFRESH_SECONDS:
+            return _leak_filter
+
+        try:
+            version = current_app.redis.get(VERSION_KEY)
+        except Exception as e:
+            logger.warning(f"Could not read leak filter version: {str(e)}")
+            version = _leak_filter_version
+        _checked_at = now
+        if _leak_filter is not None and version == _leak_filter_version:
+            return _leak_filter
+
+        organizations = Organization.query.with_entities(Organization.id, Organization.name).all()
+        _leak_filter = LeakFilter(organizations, Config.LEAK_FILTER_MIN_NAME_LENGTH,
+                                   Config.LEAK_FILTER_IGNORED_NAMES.split(','))
+        _leak_filter_version = version
+        logger.info(f"Built leak filter with {_leak_filter.pattern_count} patterns for {len(organizations)} organizations")
+        return _leak_filter
+
+
+def invalidate_leak_filter():
+    """Call after organizations are created or deleted."""
+    global _leak_filter
+    with _lock:
+        _leak_filter = None
+    try:
+        current_app.redis.incr(VERSION_KEY)
+    except Exception as e:
+        logger.warning(f"Could not bump leak filter version: {str(e)}")
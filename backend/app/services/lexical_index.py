@@ -0,0 +1,217 @@
+from array import array
+import heapq
+import json
+import math
+import os
+import re
+import zlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 汉字、假名、韩文等字符；分词、token 估算和泄露过滤共用这一定义
+CJK_CHARS = '぀-ヿ㐀-䶿一-鿿가-힯豈-﫿'
+CJK_CHAR = re.compile(f'[{CJK_CHARS}]')
+# 连续的 CJK 字符
+_CJK_RUN = re.compile(f'[{CJK_CHARS}]+')
+# 英文单词、数字以及 "AB-1234"、"v2.1" 这类编号
+_WORD = re.compile(r'[0-9a-z]+(?:[-_./][0-9a-z]+)*')
+_WORD_PARTS = re.compile(r'[0-9a-z]+')
+
+
+def tokenize(text):
+    """
+    CJK-aware tokenizer: CJK runs become overlapping character bigrams (a
+    single character stays a unigram); other text becomes lowercase words,
+    and codes such as "AB-1234" are kept whole as well as split into parts.
+    """
+    text = text.lower()
+    tokens = []
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    for word in _WORD.findall(_CJK_RUN.sub(' ', text)):
+        tokens.append(word)
+        parts = _WORD_PARTS.findall(word)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+
+class LexicalIndex:
+    """
+    In-memory BM25 inverted index over chunk texts.
+
+    Each term maps to a compact posting list: parallel arrays of chunk
+    numbers and term frequencies. Removed chunks are tombstoned and
+    dropped from the posting lists once they make up a quarter of the index.
+    """
+
+    FILE_NAME = "lexical_index.json.z"
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.chunk_ids = []          # 内部编号 -> 向量库中的文本块 ID
+        self.lengths = array('I')    # 每个文本块的词数
+        self.live = bytearray()      # 1 表示有效，0 表示已删除
+        self.postings = {}           # term -> (array('I') 文本块编号, array('H') 词频)
+        self._positions = {}         # 文本块 ID -> 内部编号
+        self._live_count = 0
+        self._total_length = 0
+
+    def __len__(self):
+        return self._live_count
+
+    def add(self, chunk_ids, texts):
+        for chunk_id, text in zip(chunk_ids, texts):
+            if chunk_id in self._positions:
+                self.remove([chunk_id])
+            position = len(self.chunk_ids)
+            tokens = tokenize(text)
+            frequencies = {}
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for token, tf in frequencies.items():
+                posting = self.postings.get(token)
+                if posting is None:
+                    posting = self.postings[token] = (array('I'), array('H'))
+                posting[0].append(position)
+                posting[1].append(min(tf, 65535))
+            self.chunk_ids.append(chunk_id)
+            self.lengths.append(len(tokens))
+            self.live.append(1)
+            self._positions[chunk_id] = position
+            self._live_count += 1
+            self._total_length += len(tokens)
+
+    def extend(self, other):
+        """Append every live chunk of another index; chunk IDs present in both take the other's version."""
+        self.remove([chunk_id for chunk_id in other.chunk_ids if chunk_id in self._positions])
+        offset = len(self.chunk_ids)
+        for term, (positions, frequencies) in other.postings.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = (array('I'), array('H'))
+            posting[0].extend(position + offset for position in positions)
+            posting[1].extend(frequencies)
+        self.chunk_ids.extend(other.chunk_ids)
+        self.lengths.extend(other.lengths)
+        self.live.extend(other.live)
+        for chunk_id, position in other._positions.items():
+            self._positions[chunk_id] = position + offset
+        self._live_count += other._live_count
+        self._total_length += other._total_length
+
+    def remove(self, chunk_ids):
+        for chunk_id in chunk_ids:
+            position = self._positions.pop(chunk_id, None)
+            if position is None:
+                continue
+            self.live[position] = 0
+            self._live_count -= 1
+            self._total_length -= self.lengths[position]
+        if len(self.chunk_ids) - self._live_count > max(1000, len(self.chunk_ids) // 4):
+            self.compact()
+
+    def retain(self, chunk_ids):
+        """Remove every chunk whose ID is not in chunk_ids."""
+        chunk_ids = set(chunk_ids)
+        self.remove([chunk_id for chunk_id in list(self._positions) if chunk_id not in chunk_ids])
+
+    def compact(self):
+        """Drop tombstoned chunks from every posting list and renumber the rest."""
+        chunk_ids, lengths, postings = self._compacted()
+        logger.info(f"Compacted lexical index from {len(self.chunk_ids)} to {len(chunk_ids)} chunks")
+        self.chunk_ids = chunk_ids
+        self.lengths = lengths
+        self.live = bytearray([1]) * len(chunk_ids)
+        self.postings = postings
+        self._positions = {chunk_id: i for i, chunk_id in enumerate(chunk_ids)}
+
+    def _compacted(self):
+        remap = {}
+        chunk_ids, lengths = [], array('I')
+        for position, chunk_id in enumerate(self.chunk_ids):
+            if self.live[position]:
+                remap[position] = len(chunk_ids)
+                chunk_ids.append(chunk_id)
+                lengths.append(self.lengths[position])
+        postings = {}
+        for term, (positions, frequencies) in self.postings.items():
+            new_positions, new_frequencies = array('I'), array('H')
+            for position, tf in zip(positions, frequencies):
+                new_position = remap.get(position)
+                if new_position is not None:
+                    new_positions.append(new_position)
+                    new_frequencies.append(tf)
+            if new_positions:
+                postings[term] = (new_positions, new_frequencies)
+        return chunk_ids, lengths, postings
+
+    def search(self, query, k=20):
+        """Return up to k (chunk_id, bm25 score) pairs, best first."""
+        if not self._live_count:
+            return []
+        average_length = self._total_length / self._live_count or 1.0
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            positions, frequencies = posting
+            # 文档频率包含尚未压缩掉的已删除文本块，误差有上限
+            df = len(positions)
+            idf = math.log(1 + (self._live_count - df + 0.5) / (df + 0.5))
+            for position, tf in zip(positions, frequencies):
+                if not self.live[position]:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[position] / average_length)
+                scores[position] = scores.get(position, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(self.chunk_ids[position], score) for position, score in best]
+
+    def save(self, directory):
+        """Write the live chunks only; does not modify the index, so a read lock is enough."""
+        if len(self.chunk_ids) != self._live_count:
+            chunk_ids, lengths, postings = self._compacted()
+        else:
+            chunk_ids, lengths, postings = self.chunk_ids, self.lengths, self.postings
+        payload = {
+            "k1": self.k1,
+            "b": self.b,
+            "chunk_ids": chunk_ids,
+            "lengths": lengths.tolist(),
+            "postings": {term: [p.tolist(), f.tolist()] for term, (p, f) in postings.items()},
+        }
+        with open(os.path.join(directory, self.FILE_NAME), 'wb') as f:
+            f.write(zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')))
+
+    @classmethod
+    def load(cls, directory):
+        """Load a saved index, or return None if the directory has none."""
+        path = os.path.join(directory, cls.FILE_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            payload = json.loads(zlib.decompress(f.read()).decode('utf-8'))
+        index = cls(payload["k1"], payload["b"])
+        index.chunk_ids = payload["chunk_ids"]
+        index.lengths = array('I', payload["lengths"])
+        index.live = bytearray([1]) * len(index.chunk_ids)
+        index.postings = {term: (array('I', p), array('H', f)) for term, (p, f) in payload["postings"].items()}
+        index._positions = {chunk_id: i for i, chunk_id in enumerate(index.chunk_ids)}
+        index._live_count = len(index.chunk_ids)
+        index._total_length = sum(index.lengths)
+        return index
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuse several best-first lists of IDs: score(id) = sum(1 / (k + rank))."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
@@ -0,0 +1,134 @@
+from ..models import User
+from ..utils.metrics import CACHE_LOOKUPS
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 用户 ID -> 最近一次修改（角色变更、删除）的时间；各进程通过频道实时得知修改
+CHANGED_KEY = "principals:changed"
+CHANNEL = "principals:invalidate"
+
+
+class Principal:
+    """Who is making the request: the user's ID, role and organization."""
+
+    __slots__ = ("user_id", "role", "organization_id")
+
+    def __init__(self, user_id, role, organization_id):
+        self.user_id = user_id
+        self.role = role
+        self.organization_id = organization_id
+
+    @property
+    def is_admin(self):
+        return self.role == 'admin'
+
+
+class PrincipalCache:
+    """
+    Resolves the principal of a request without touching the database in
+    the common case. Access tokens carry the user's role and organization
+    as claims, which are trusted unless the user was changed after the
+    token was issued. Changes are recorded in a Redis hash and announced
+    on a pub/sub channel that every process listens to. Users whose
+    claims are stale or missing are loaded from the database and cached
+    for `ttl` seconds.
+    """
+
+    def __init__(self, redis_client, ttl=30, max_age=900, max_entries=10000):
+        self.redis = redis_client
+        self.ttl = ttl
+        # 更早的修改不会再影响任何未过期的访问令牌
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}   # user_id -> (过期时间, Principal 或 None)
+        self._changed = {}   # user_id -> 修改时间
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def resolve(self, user_id, claims):
+        """The principal for a verified token's identity and claims, or None if the user no longer exists."""
+        self._ensure_listening()
+        user_id = int(user_id)
+        changed_at = self._changed.get(user_id)
+        if "role" in claims and "organization_id" in claims and (changed_at is None or claims["iat"] > changed_at):
+            return Principal(user_id, claims["role"], claims["organization_id"])
+        return self.get(user_id)
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > now:
+            CACHE_LOOKUPS.inc("principal", "hit")
+            return entry[1]
+        CACHE_LOOKUPS.inc("principal", "miss")
+
+        user = User.query.get(user_id)
+        principal = Principal(user.id, user.role, user.organization_id) if user else None
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries = {key: value for key, value in self._entries.items() if value[0] > now}
+                if len(self._entries) >= self.max_entries:
+                    self._entries.clear()
+            self._entries[user_id] = (now + self.ttl, principal)
+        return principal
+
+    def invalidate(self, user_id):
+        """Call after a user's role or organization changed or the user was deleted."""
+        user_id = int(user_id)
+        changed_at = time.time()
+        self._mark_changed(user_id, changed_at)
+        try:
+            self.redis.hset(CHANGED_KEY, str(user_id), changed_at)
+            self.redis.publish(CHANNEL, f"{user_id} {changed_at}")
+        except Exception as e:
+            logger.warning(f"Could not publish principal change of user {user_id}: {str(e)}")
+
+    def _mark_changed(self, user_id, changed_at):
+        with self._lock:
+            self._changed[user_id] = max(changed_at, self._changed.get(user_id, 0.0))
+            self._entries.pop(user_id, None)
+
+    def _load_changed(self):
+        cutoff = time.time() - self.max_age
+        expired = []
+        for user_id, changed_at in self.redis.hgetall(CHANGED_KEY).items():
+            if float(changed_at) < cutoff:
+                expired.append(user_id)
+            else:
+                self._mark_changed(int(user_id), float(changed_at))
+        if expired:
+            self.redis.hdel(CHANGED_KEY, *expired)
+
+    def _ensure_listening(self):
+        if self._listener is not None:
+            return
+        with self._listener_lock:
+            if self._listener is not None:
+                return
+            # 首次加载完成之后才信任令牌中的声明
+            try:
+                self._load_changed()
+            except Exception as e:
+                logger.warning(f"Could not load principal changes: {str(e)}")
+            listener = threading.Thread(target=self._listen, name="principal-invalidation", daemon=True)
+            listener.start()
+            self._listener = listener
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(CHANNEL)
+                # 订阅之后重新加载，断线期间错过的消息由哈希表补上
+                self._load_changed()
+                for message in pubsub.listen():
+                    user_id, changed_at = message["data"].decode().split()
+                    self._mark_changed(int(user_id), float(changed_at))
+            except Exception as e:
+                logger.warning(f"Principal invalidation listener failed, reconnecting: {str(e)}")
+                time.sleep(5)
@@ -0,0 +1,183 @@
+from collections import OrderedDict
+from .rag_service import RAGSystem
+from . import segments
+from ..utils.memory import process_memory
+import os
+import threading
+import weakref
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 每次修改索引都会原子替换清单，它的修改时间即可代表整个索引目录
+SIGNATURE_FILE = "manifest.json"
+
+
+class _Entry:
+    def __init__(self, rag_system, signature, size):
+        self.rag_system = rag_system
+        self.signature = signature
+        self.size = size
+        # 本实例正在写出的清单数；写出期间签名过时，但不是外部修改
+        self.writing = 0
+
+
+class RAGRegistry:
+    """
+    Process-wide cache of loaded RAGSystem instances, one per organization.
+
+    Entries are evicted in LRU order once either the number of cached
+    organizations or the total on-disk size of their indexes exceeds the
+    configured limits. Each entry remembers the modification time of its
+    index manifest, so an index changed by another worker process is
+    reloaded on the next lookup; manifests an instance writes itself are
+    written outside the registry lock and do not count as changes. Instances that are replaced or dropped
+    are not closed here: other threads may still be using them, and their
+    chunk store and segments are released when the last reference goes.
+    """
+
+    def __init__(self, max_entries=32, memory_budget=1024 * 1024 * 1024, factory=RAGSystem):
+        self.max_entries = max_entries
+        self.memory_budget = memory_budget
+        self._factory = factory
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.reloads = 0
+
+    def get(self, organization_id):
+        """Return the cached RAGSystem for an organization, loading it if needed."""
+        with self._lock:
+            entry = self._entries.get(organization_id)
+            if entry is not None and (entry.writing or
+                                      entry.signature == self._signature(entry.rag_system.vectorstore_path)):
+                self._entries.move_to_end(organization_id)
+                self.hits += 1
+                return entry.rag_system
+            loading_lock = self._loading_locks.setdefault(organization_id, threading.Lock())
+
+        # 同一组织只加载一次，其他请求等待加载完成
+        with loading_lock:
+            with self._lock:
+                current = self._entries.get(organization_id)
+                if current is not None and current is not entry:
+                    self._entries.move_to_end(organization_id)
+                    self.hits += 1
+                    return current.rag_system
+                if entry is not None:
+                    self.reloads += 1
+                    logger.info(f"Index of organization {organization_id} changed on disk, reloading")
+                self.misses += 1
+
+            rss_before = process_memory().get("rss_anon_bytes")
+            rag_system = self._factory(organization_id)
+            rag_system.manifest_writer = self._manifest_writer(organization_id, rag_system)
+            rss_after = process_memory().get("rss_anon_bytes")
+            if rss_before is not None and rss_after is not None:
+                # 内存映射的索引计入 RssFile，不计入本进程的私有内存
+                logger.info(f"Loaded RAG system of organization {organization_id}: private memory "
+                            f"{(rss_after - rss_before) / 1024 / 1024:+.1f} MB")
+            path = rag_system.vectorstore_path
+            new_entry = _Entry(rag_system, self._signature(path), self._index_size(path))
+
+            with self._lock:
+                self._entries[organization_id] = new_entry
+                self._entries.move_to_end(organization_id)
+                self._evict()
+            return rag_system
+
+    def _manifest_writer(self, organization_id, rag_system):
+        # 弱引用：实例持有这个函数，强引用会形成循环，实例被丢弃后不能及时回收
+        rag_system = weakref.ref(rag_system)
+
+        def write(path, manifest):
+            # 清单在注册表锁外写出，不阻塞其他组织的查找；写出期间本条目计为命中，
+            # 其他线程不会把本实例的写入当作外部修改而重新加载
+            with self._lock:
+                entry = self._entries.get(organization_id)
+                if entry is not None and entry.rag_system is not rag_system():
+                    entry = None
+                if entry is not None:
+                    entry.writing += 1
+            try:
+                segments.write_manifest(path, manifest)
+            finally:
+                if entry is not None:
+                    with self._lock:
+                        entry.writing -= 1
+                        entry.signature = self._signature(path)
+        return write
+
+    def mark_updated(self, organization_id):
+        """Refresh the size of an index the cached instance itself changed, evicting others if needed."""
+        with self._lock:
+            entry = self._entries.get(organization_id)
+            if entry is None:
+                return
+            entry.size = self._index_size(entry.rag_system.vectorstore_path)
+            self._evict()
+
+    def invalidate(self, organization_id):
+        """Drop the cached instance of an organization."""
+        with self._lock:
+            if self._entries.pop(organization_id, None) is not None:
+                logger.info(f"Invalidated cached RAG system of organization {organization_id}")
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "organizations": len(self._entries),
+                "memory_bytes": sum(e.size for e in self._entries.values()),
+                "memory_budget_bytes": self.memory_budget,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "reloads": self.reloads,
+                "process": process_memory(),
+            }
+
+    def index_stats(self):
+        """{organization_id: {"bytes", "chunks", "segments", "tombstones"}} of the loaded indexes."""
+        with self._lock:
+            entries = list(self._entries.items())
+        return {organization_id: {"bytes": entry.size,
+                                  "chunks": len(entry.rag_system.chunk_store),
+                                  "segments": len(entry.rag_system.segments),
+                                  "tombstones": entry.rag_system.tombstones}
+                for organization_id, entry in entries}
+
+    def _evict(self):
+        # 调用方需持有 self._lock；最近使用的条目始终保留
+        total = sum(e.size for e in self._entries.values())
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or total > self.memory_budget):
+            organization_id, entry = self._entries.popitem(last=False)
+            total -= entry.size
+            self.evictions += 1
+            logger.info(f"Evicted RAG system of organization {organization_id} ({entry.size} bytes)")
+
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.stat(os.path.join(path, SIGNATURE_FILE))
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    @staticmethod
+    def _index_size(path):
+        size = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return size
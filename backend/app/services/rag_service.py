@@ -1,13 +1,24 @@
-from langchain_community.embeddings.zhipuai import ZhipuAIEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
-from unstructured.partition.auto import partition
 from .custom_llm import CustomAPILLM
+from .embedding_providers import get_provider, provider_name_for
+from .embedding_cache import CachedEmbeddings, get_embedding_cache, get_query_vector_cache
+from .document_parser import parse_document, get_parse_pool, reset_parse_pool
+from .leak_filter import get_leak_filter
+from .lexical_index import LexicalIndex, reciprocal_rank_fusion
+from .context_assembler import assemble_context
+from .chunk_store import ChunkStore, migrate_pickled_docstore
+from . import segments, vector_index
+from ..utils.concurrency import ReadWriteLock
+from ..utils.metrics import STAGE_SECONDS
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from config import Config
 import os
-import shutil
+import json
+import numpy as np
 import logging
-import mimetypes
+import threading
+import time
 import traceback
 
 API_URL = ""
@@ -33,6 +44,17 @@ Question: {question}
 Now, as EchoSage, please respond to this question following the above guidelines:
 """
 
+# 新建空索引时写入的占位文本，检索时会被过滤掉
+EMPTY_INDEX_PLACEHOLDER = "Initial empty document"
+PLACEHOLDER_CHUNK_ID = "placeholder"
+
+# 引入分段存储之前的单文件索引，加载时转换为一个基础段
+LEGACY_INDEX_FILE = "index.faiss"
+# 清单未记录向量模型的索引都是由智谱 embedding 接口建立的
+LEGACY_EMBEDDING_PROVIDER = "zhipuai"
+
+LEAK_REFUSAL = "I apologize, but I can't provide that information."
+
 organization_specific_prompt = PromptTemplate(
     input_variables=["organization_id", "context", "question"],
     template=organization_specific_template
@@ -44,191 +66,839 @@ logger = logging.getLogger(__name__)
 class RAGSystem:
     def __init__(self, organization_id):
         self.organization_id = organization_id
-        self.embeddings = ZhipuAIEmbeddings(
-            model="embedding-2",
-            api_key=API_KEY
-        )
-        self.vectorstore_path = f"/app/vectorstores/organization_{organization_id}"
+        self.vectorstore_path = os.path.join(Config.VECTORSTORE_FOLDER, f"organization_{organization_id}")
+        # 建立索引所用的向量模型，查询必须使用同一个；由清单记录，加载索引时设置
+        self.embedding_provider = None
+        self.embeddings = None
+        self.embedding_pipeline = None
+        # 实例会被多个请求线程共享：查询持有读锁，替换或修改内存中的索引时持有写锁；
+        # write_mutex 串行化同一组织的解析、嵌入和保存，使耗时步骤不阻塞查询
+        self.lock = ReadWriteLock()
+        self.write_mutex = threading.Lock()
+        # 写出清单的函数；RAGRegistry 换成在注册表锁内写出并同时更新签名的版本
+        self.manifest_writer = segments.write_manifest
 
         # 确保 vectorstore_path 存在
         os.makedirs(self.vectorstore_path, exist_ok=True)
 
-        self.vectorstore = self._load_or_create_vectorstore()
-
-        custom_llm = CustomAPILLM(
+        # 清单记录当前的段和 chunk store 文件，每次修改都整体原子替换；文档引用了哪些文本块记在 chunk store 中
+        self.manifest = None
+        # 与向量库同步维护的 BM25 倒排索引，用于混合检索
+        self.lexical_index = None
+        # 基础段在前，之后是每次上传追加的增量段；段写出后不再修改，FAISS_MMAP 时以只读方式映射
+        self.segments = []
+        # 文本块的文本和元数据，按全局向量位置存放在 SQLite 中，查询时只读取前 k 个
+        self.chunk_store = None
+        self._load_or_create_index()
+
+        self.llm = CustomAPILLM(
             api_url=API_URL,
             api_key=API_KEY
         )
-        self.qa_chain = RetrievalQA.from_chain_type(
-            llm=custom_llm,
-            chain_type="stuff",
-            retriever=self.vectorstore.as_retriever(search_kwargs={"k": 5}) # 从向量数据库中搜索前5个最相关的
-        )
 
-    def _load_or_create_vectorstore(self):
-        index_file = os.path.join(self.vectorstore_path, "index.faiss")
-        if os.path.exists(index_file):
-            logger.info(f"Loading existing vectorstore from {self.vectorstore_path}")
-            return FAISS.load_local(
-                self.vectorstore_path,
-                self.embeddings,
-                allow_dangerous_deserialization=True
-            )
-
-        logger.info("Creating new vectorstore with initial empty document")
-        return self._create_new_vectorstore()
-
-    def _create_new_vectorstore(self):
-        vectorstore = FAISS.from_texts(["Initial empty document"], embedding=self.embeddings)
-        vectorstore.save_local(self.vectorstore_path)
-        return vectorstore
-
-
-    def add_document(self, file_path):
-        logger.info(f"Starting to process document: {file_path}")
-        if not os.path.exists(file_path):
-            logger.error(f"File does not exist: {file_path}")
+    def _load_or_create_index(self):
+        manifest = segments.read_manifest(self.vectorstore_path)
+        if manifest is None and os.path.exists(os.path.join(self.vectorstore_path, LEGACY_INDEX_FILE)):
+            try:
+                manifest = self._adopt_legacy_index()
+            except FileNotFoundError:
+                # 另一个进程刚刚完成了转换
+                manifest = segments.read_manifest(self.vectorstore_path)
+        if manifest is None:
+            logger.info("Creating new index with initial empty document")
+            self._use_provider(get_provider(provider_name_for(self.organization_id)))
+            self._create_empty_index()
             return
 
-        # Check file size and type
-        file_size = os.path.getsize(file_path)
-        mime_type, _ = mimetypes.guess_type(file_path)
-        logger.info(f"File size: {file_size} bytes, MIME type: {mime_type}")
-
-        logger.info("Partitioning document with unstructured")
-        try:
-            elements = partition(filename=file_path)
-            logger.info(f"Partitioned {len(elements)} elements from the document")
-
-            # Log detailed information about each element
-            for i, element in enumerate(elements):
-                logger.debug(f"Element {i}: Type: {type(element)}, Category: {element.category}")
-                logger.debug(f"Element {i} content preview: {str(element)[:100]}...")
+        logger.info(f"Loading index from {self.vectorstore_path} ({len(manifest['segments'])} segments)")
+        # 部署改用其他向量模型后，在 reembed() 完成迁移之前仍使用原来的模型
+        self._use_provider(get_provider(manifest.get("embedding_provider", LEGACY_EMBEDDING_PROVIDER)))
+        self.manifest = manifest
+        self.segments = [segments.load_segment(self.vectorstore_path, entry, mmap=Config.FAISS_MMAP)
+                         for entry in manifest["segments"]]
+        self.chunk_store = ChunkStore(os.path.join(self.vectorstore_path, manifest["chunk_store"]))
+        if "documents" in manifest:
+            # 旧版清单记录文档引用的文本块，迁入 chunk store；之后写出的清单不再包含它
+            self.chunk_store.import_documents(manifest["documents"])
+        self.lexical_index = segments.load_lexical_index(self.vectorstore_path, manifest)
+        if self.tombstones:
+            # 段文件不可修改，已删除文本块的倒排记录在加载时去掉
+            self.lexical_index.retain(self.chunk_store.chunk_ids())
+
+    def _adopt_legacy_index(self):
+        """
+        Convert a directory written before segments existed (index.faiss
+        plus chunks.sqlite3, or a pickled index.pkl) into a manifest with a
+        single base segment. Files are hard-linked rather than moved, so a
+        crash part-way leaves the old layout intact and the conversion
+        simply runs again on the next load.
+        """
+        path = self.vectorstore_path
+        if not os.path.exists(os.path.join(path, ChunkStore.FILE_NAME)):
+            migrate_pickled_docstore(path)
+        logger.info(f"Converting {path} to a segmented index")
+
+        name = segments.new_name("segment")
+        staging_path = os.path.join(path, f"{name}.tmp")
+        os.makedirs(staging_path)
+        os.link(os.path.join(path, LEGACY_INDEX_FILE), os.path.join(staging_path, segments.SEGMENT_INDEX_FILE))
+        chunk_store_name = segments.new_name("chunks", ".sqlite3")
+        os.link(os.path.join(path, ChunkStore.FILE_NAME), os.path.join(path, chunk_store_name))
+
+        lexical_index = LexicalIndex.load(path)
+        if lexical_index is None:
+            chunk_store = ChunkStore(os.path.join(path, chunk_store_name))
+            lexical_index = self._new_lexical_index()
+            for _, chunk_id, text, _ in chunk_store.iter_chunks():
+                if text != EMPTY_INDEX_PLACEHOLDER:
+                    lexical_index.add([chunk_id], [text])
+            chunk_store.close()
+        lexical_index.save(staging_path)
+        os.replace(staging_path, os.path.join(path, name))
+
+        count = vector_index.read_index(os.path.join(path, name, segments.SEGMENT_INDEX_FILE), mmap=True).ntotal
+        manifest = {
+            "segments": [{"name": name, "start": 0, "count": count}],
+            "chunk_store": chunk_store_name,
+            "next_position": count,
+            "documents": self._load_legacy_document_chunk_ids(),
+            "embedding_provider": LEGACY_EMBEDDING_PROVIDER,
+        }
+        segments.write_manifest(path, manifest)
+        for legacy_name in (LEGACY_INDEX_FILE, ChunkStore.FILE_NAME, LexicalIndex.FILE_NAME, "documents.json"):
+            if os.path.exists(os.path.join(path, legacy_name)):
+                os.remove(os.path.join(path, legacy_name))
+        return manifest
+
+    def _load_legacy_document_chunk_ids(self):
+        path = os.path.join(self.vectorstore_path, "documents.json")
+        if not os.path.exists(path):
+            # 旧版索引没有记录文档归属，删除时会回退到重建索引
+            return {}
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _create_empty_index(self):
+        # 只含占位文本的索引，检索时占位文本会被过滤掉
+        vectors = self.embedding_pipeline.embed([EMPTY_INDEX_PLACEHOLDER])
+        self._replace_base(vector_index.build_index(vectors), self._new_lexical_index(),
+                           ([PLACEHOLDER_CHUNK_ID], [EMPTY_INDEX_PLACEHOLDER], [{}]), {})
+
+    def _use_provider(self, provider):
+        self.embedding_provider = provider
+        # 向量按 (模型, 文本哈希) 缓存，重建索引和重复查询不会重复调用 embedding 接口
+        self.embedding_pipeline = provider.pipeline(get_embedding_cache())
+        self.embeddings = CachedEmbeddings(provider.embeddings, get_embedding_cache(), provider.model,
+                                           query_cache=get_query_vector_cache(), pipeline=self.embedding_pipeline,
+                                           separate_query_path=provider.separate_query_path)
+
+    @property
+    def dimension(self):
+        return self.segments[0].index.d
+
+    def _stage(self, stage):
+        """Time the enclosed block into the per-organization stage histogram."""
+        return STAGE_SECONDS.time(stage, str(self.organization_id))
+
+    @staticmethod
+    def _new_lexical_index():
+        return LexicalIndex(k1=Config.BM25_K1, b=Config.BM25_B)
+
+    def _open_segment(self, entry, index):
+        # FAISS_MMAP 时改为映射刚写出的文件，释放内存中的副本，页缓存由各 worker 进程共享
+        if Config.FAISS_MMAP:
+            return segments.load_segment(self.vectorstore_path, entry, mmap=True)
+        return segments.Segment(entry["name"], entry["start"], index)
+
+    def _replace_base(self, index, lexical_index, chunks, documents, provider=None):
+        """
+        Write `index` as a new base segment and `chunks` = (ids, texts,
+        metadatas) plus `documents` = {document_id: [chunk_id, ...]} as a new
+        chunk store, then point the manifest at them
+        alone, dropping every delta segment. `provider` is the embedding
+        provider that computed `index`, if not the current one. The old
+        files stay readable by other processes until they are removed after
+        LSM_FILE_GRACE_SECONDS.
+        """
+        provider = provider or self.embedding_provider
+        path = self.vectorstore_path
+        entry = {"name": segments.new_name("segment"), "start": 0, "count": index.ntotal}
+        segments.write_segment(path, entry["name"], index, lexical_index)
+        chunk_store_name = segments.new_name("chunks", ".sqlite3")
+        ChunkStore.create(os.path.join(path, chunk_store_name), *chunks, documents=documents)
+        manifest = {"segments": [entry], "chunk_store": chunk_store_name,
+                    "next_position": index.ntotal, "embedding_provider": provider.name}
+        # 记录旧文件不再被引用的时间，宽限期从此刻开始计算
+        manifest["retired"] = segments.retire(path, self.manifest, manifest)
+        self.manifest_writer(path, manifest)
+
+        base = self._open_segment(entry, index)
+        chunk_store = ChunkStore(os.path.join(path, chunk_store_name))
+        with self.lock.write():
+            old_chunk_store = self.chunk_store
+            self.manifest = manifest
+            self.segments = [base]
+            self.chunk_store = chunk_store
+            self.lexical_index = lexical_index
+            if provider is not self.embedding_provider:
+                self._use_provider(provider)
+        if old_chunk_store is not None:
+            old_chunk_store.close()
+        segments.remove_unreferenced(path, manifest, Config.LSM_FILE_GRACE_SECONDS)
+
+    def _write_manifest(self, **changes):
+        manifest = dict(self.manifest, **changes)
+        manifest.pop("documents", None)
+        # 记录不再被引用的段的时间，宽限期从此刻开始计算
+        manifest["retired"] = segments.retire(self.vectorstore_path, self.manifest, manifest)
+        self.manifest_writer(self.vectorstore_path, manifest)
+        return manifest
+
+    @staticmethod
+    def _chunk_metadata(document_id, texts):
+        ids = [f"doc-{document_id}-{i}" for i in range(len(texts))]
+        metadatas = [{"document_id": document_id} for _ in texts]
+        return ids, metadatas
+
+    @staticmethod
+    def _deduplicate_chunks(ids, texts, metadatas, known):
+        """
+        Drop chunks whose text repeats earlier in the document (page headers
+        and footers) or is already indexed, given `known` = {text: chunk_id}.
+        Returns (ids, texts, metadatas) of the chunks to add and the IDs of
+        every chunk the document refers to.
+        """
+        new_ids, new_texts, new_metadatas = [], [], []
+        document_ids = {}
+        added = {}
+        for chunk_id, text, metadata in zip(ids, texts, metadatas):
+            existing = known.get(text) or added.get(text)
+            if existing:
+                document_ids[existing] = None
+                continue
+            added[text] = chunk_id
+            document_ids[chunk_id] = None
+            new_ids.append(chunk_id)
+            new_texts.append(text)
+            new_metadatas.append(metadata)
+        return new_ids, new_texts, new_metadatas, list(document_ids)
+
+    def add_document(self, file_path, document_id, elements=None, progress=None):
+        """
+        Parse (unless `elements` were already parsed elsewhere), embed and
+        index a document. `progress(stage, count)` is called as chunks are
+        "parsed", "embedded" and "indexed". Returns the number of chunks added.
+        """
+        with self.write_mutex:
+            return self._add_document(file_path, document_id, elements, progress or (lambda stage, count: None))
+
+    def _add_document(self, file_path, document_id, elements, progress):
+        logger.info(f"Starting to process document: {file_path}")
+        if elements is None:
+            if not os.path.exists(file_path):
+                logger.error(f"File does not exist: {file_path}")
+                return 0
 
-        except Exception as e:
-            logger.error(f"Error partitioning document: {str(e)}")
-            logger.error(f"Traceback: {traceback.format_exc()}")
-            return
+            try:
+                elements = parse_document(file_path, self.organization_id)
+            except Exception as e:
+                logger.error(f"Error partitioning document: {str(e)}")
+                logger.error(f"Traceback: {traceback.format_exc()}")
+                return 0
 
         if len(elements) == 0:
             logger.warning(f"No elements extracted from {file_path}. The file might be empty or corrupted.")
-            return
+            return 0
 
-        texts = [str(element) for element in elements if hasattr(element, 'text')]
+        texts = [element["text"] for element in elements]
         logger.info(f"Extracted {len(texts)} text chunks")
+        progress("parsed", len(texts))
 
         if len(texts) == 0:
             logger.warning(f"No text content found in {file_path}.")
-            return
-
-        logger.info("Adding text chunks to vectorstore")
-        for i, text in enumerate(texts):
-            logger.debug(f"Adding chunk {i + 1}/{len(texts)} to vectorstore. Preview: {text[:100]}...")
-            self.vectorstore.add_texts([text])
-
-        logger.info(f"Saving vectorstore to {self.vectorstore_path}")
-        self.vectorstore.save_local(self.vectorstore_path)
-
-        logger.info(f"Total documents in vectorstore after addition: {len(self.vectorstore.index_to_docstore_id)}")
-
-    def query(self, question):
-        """Query the RAG system with strict organization isolation."""
+            return 0
+
+        # 已由其他文档索引的文本块直接引用，不再嵌入；本文档即将被替换的旧文本块除外
+        previous = self.chunk_store.document_chunk_ids(document_id)
+        replaced = set(previous) - set(self.chunk_store.chunk_owners(previous, excluding=document_id))
+        known = {text: chunk_id for text, chunk_id in self.chunk_store.find_texts(set(texts)).items()
+                 if chunk_id not in replaced and text != EMPTY_INDEX_PLACEHOLDER}
+        ids, metadatas = self._chunk_metadata(document_id, texts)
+        parsed = len(texts)
+        ids, texts, metadatas, document_chunk_ids = self._deduplicate_chunks(ids, texts, metadatas, known)
+        duplicates = parsed - len(ids)
+        if duplicates:
+            logger.info(f"Skipping {duplicates} duplicate text chunks")
+
+        logger.info("Embedding text chunks")
+        with self._stage("embedding"):
+            vectors = self.embedding_pipeline.embed(texts,
+                                                    progress=lambda done: progress("embedded", duplicates + done))
+
+        if previous:
+            self._delete_chunks(document_id)
+
+        if not ids:
+            # 所有文本块都已在索引中，只记录文档对它们的引用；删除了旧文本块时才需要其他进程重新加载
+            self.chunk_store.set_document_chunks(document_id, document_chunk_ids)
+            if previous:
+                self.manifest = self._write_manifest()
+            progress("indexed", parsed)
+            return 0
+
+        logger.info("Writing text chunks to a new delta segment")
+        indexing_started = time.perf_counter()
+        # 每次上传写一个小的增量段，写入量只与本次上传的文本块数有关
+        delta_index = vector_index.build_index(vectors, spec="Flat")
+        delta_lexical_index = self._new_lexical_index()
+        delta_lexical_index.add(ids, texts)
+        start = self.manifest["next_position"]
+        entry = {"name": segments.new_name("segment"), "start": start, "count": len(ids)}
+        segments.write_segment(self.vectorstore_path, entry["name"], delta_index, delta_lexical_index)
+
+        # 文本块先于清单写入：其他进程在清单替换之前不会检索到这些位置，
+        # 中途崩溃留下的行会在下次上传时被同一位置覆盖
+        self.chunk_store.add(range(start, start + len(ids)), ids, texts, metadatas)
+        self.chunk_store.set_document_chunks(document_id, document_chunk_ids)
+        manifest = self._write_manifest(segments=self.manifest["segments"] + [entry],
+                                        next_position=start + len(ids))
+
+        segment = self._open_segment(entry, delta_index)
+        with self.lock.write():
+            self.segments.append(segment)
+            self.lexical_index.add(ids, texts)
+            self.manifest = manifest
+        STAGE_SECONDS.observe(time.perf_counter() - indexing_started, "indexing", str(self.organization_id))
+
+        progress("indexed", parsed)
+
+        logger.info(f"Total chunks in the index after addition: {len(self.chunk_store)} "
+                    f"in {len(self.segments)} segments")
+        return len(texts)
+
+    @property
+    def tombstones(self):
+        """Vectors of deleted or replaced chunks still held by segments until the next compaction."""
+        return max(0, sum(segment.count for segment in self.segments) - len(self.chunk_store))
+
+    def _search(self, questions, k, vectors):
+        """
+        [(chunk_id, Document)] of the k most relevant chunks for each
+        question. With HYBRID_SEARCH, the top RETRIEVAL_CANDIDATES of the
+        vector search and of the BM25 index are merged by reciprocal rank
+        fusion, so exact matches on codes and names are found even when
+        their embeddings are not close to the question's. Caller holds the
+        read lock.
+        """
+        if Config.HYBRID_SEARCH:
+            candidates = max(k, Config.RETRIEVAL_CANDIDATES)
+            with self._stage("vector_search"):
+                vector_rankings = self._vector_search(vectors, candidates)
+            with self._stage("lexical_search"):
+                lexical_rankings = [[chunk_id for chunk_id, _ in self.lexical_index.search(question, candidates)]
+                                    for question in questions]
+            rankings = [reciprocal_rank_fusion([vector_ranking, lexical_ranking], k=Config.RRF_K)
+                        for vector_ranking, lexical_ranking in zip(vector_rankings, lexical_rankings)]
+        else:
+            # 多取一个，以便过滤掉空索引的占位文本
+            with self._stage("vector_search"):
+                rankings = self._vector_search(vectors, k + 1)
+        # 只读取最终进入提示词的文本块
+        rankings = [ranking[:k + 1] for ranking in rankings]
+        found = self.chunk_store.get({chunk_id for ranking in rankings for chunk_id in ranking})
+        return [[(chunk_id, found[chunk_id]) for chunk_id in ranking
+                 if chunk_id in found and found[chunk_id].page_content != EMPTY_INDEX_PLACEHOLDER][:k]
+                for ranking in rankings]
+
+    def _query_vectors(self, questions, vectors):
+        """`vectors` if given and from the current embedding model, otherwise the questions' embeddings."""
+        # 调用方嵌入问题之后，重新嵌入迁移可能已经切换了向量模型
+        if vectors is not None and len(vectors) == len(questions) and all(len(v) == self.dimension for v in vectors):
+            return vectors
+        with self._stage("query_embedding"):
+            return self.embeddings.embed_queries(questions)
+
+    def _vector_search(self, vectors, k):
+        """Chunk IDs of the k nearest vectors to each query vector, best first. Caller holds the read lock."""
+        # 已删除但尚未压缩的向量会占用结果位置，多取一些再跳过
+        fetch_k = k + min(self.tombstones, k)
+        rankings = segments.search_segments(self.segments, vectors, fetch_k)
+        chunk_ids = self.chunk_store.chunk_ids_at({p for positions in rankings for p in positions})
+        return [[chunk_ids[p] for p in positions if p in chunk_ids][:k] for positions in rankings]
+
+    def select_context(self, question, vector=None):
+        """
+        Retrieve CONTEXT_CANDIDATES chunks and let the context assembler
+        drop near-duplicates, diversify them by MMR and pack them into
+        CONTEXT_TOKEN_BUDGET. Returns (docs, report).
+        """
+        if vector is None:
+            with self._stage("query_embedding"):
+                vector = self.embeddings.embed_query(question)
+        return self.select_contexts([question], vectors=[vector])[0]
+
+    def select_contexts(self, questions, vectors=None):
+        """select_context() for many questions, with batched embedding and search. Returns [(docs, report)]."""
+        vectors = self._query_vectors(questions, vectors)
+        with self.lock.read():
+            retrieved = self._search(questions, Config.CONTEXT_CANDIDATES, vectors)
+            assembly_started = time.perf_counter()
+            # 候选文本块的向量直接从段中读出，不必查询嵌入缓存
+            positions = self.chunk_store.positions_of({chunk_id for hits in retrieved for chunk_id, _ in hits})
+            stored = segments.reconstruct(self.segments, set(positions.values()))
+        chunk_vectors = {chunk_id: stored[position] for chunk_id, position in positions.items() if position in stored}
+        # 只存有量化向量的段（SQ8、PQ）退回嵌入缓存，通常不会调用 embedding 接口
+        texts = list({doc.page_content: None for hits in retrieved for chunk_id, doc in hits
+                      if chunk_id not in chunk_vectors})
+        text_vectors = dict(zip(texts, self.embedding_pipeline.embed(texts))) if texts else {}
+        contexts = []
+        for vector, hits in zip(vectors, retrieved):
+            doc_vectors = [chunk_vectors[chunk_id] if chunk_id in chunk_vectors else text_vectors[doc.page_content]
+                           for chunk_id, doc in hits]
+            docs, report = assemble_context(vector, [doc for _, doc in hits], doc_vectors,
+                                            Config.CONTEXT_TOKEN_BUDGET, mmr_lambda=Config.CONTEXT_MMR_LAMBDA,
+                                            duplicate_threshold=Config.CONTEXT_DUPLICATE_THRESHOLD)
+            logger.info(f"Context: {report['selected']} of {report['candidates']} chunks, {report['tokens']} tokens "
+                        f"({report['tokens_saved']} saved, {report['duplicates']} duplicates)")
+            contexts.append((docs, report))
+        STAGE_SECONDS.observe(time.perf_counter() - assembly_started, "context_assembly", str(self.organization_id))
+        return contexts
+
+    def build_prompt(self, question, docs):
         # 添加公司特定的上下文
-        context = self.vectorstore.similarity_search(question, k=5)
-        prompt = organization_specific_prompt.format(
+        return organization_specific_prompt.format(
             organization_id=self.organization_id,
-            context=context,
+            context="\n\n".join(doc.page_content for doc in docs),
             question=question
         )
 
-        response = self.qa_chain.invoke(prompt)
+    def query(self, question, debug=False):
+        """
+        Query the RAG system with strict organization isolation.
+        Returns {"query", "result"}, plus per-stage "timings" in milliseconds,
+        "sources" and the context assembly report when debug is set.
+        """
+        timings = {}
+        start = time.perf_counter()
 
-        # 验证响应不包含其他公司的信息
-        if self._contains_other_organization_info(response):
-            return "I apologize, but I can't provide that information."
+        docs, context = self.select_context(question)
+        timings["retrieve_ms"] = (time.perf_counter() - start) * 1000
 
-        logger.info(f"Generated response: {response}")
-        return response
-
-    def _contains_other_organization_info(self, response):
-        # 实现检查逻辑，例如查找其他公司ID或关键词
-        # 这是一个简化的示例，您需要根据实际情况完善这个方法
-        other_organization_ids = [str(i) for i in range(1, 1000) if i != self.organization_id]
-        return any(f"Organization {id}" in response for id in other_organization_ids)
-
-    # FAISS不支持删除单个文档，只能通过重建index的方式来变相删除了，缺点是性能较差
-    def remove_document(self, document_path):
-        """Remove a document by rebuilding the index without it."""
-        # Get the base name of the document to be removed
-        doc_to_remove = os.path.basename(document_path)
-
-        # Get all documents in the vectorstore path
-        all_docs = [f for f in os.listdir(self.vectorstore_path) if
-                    os.path.isfile(os.path.join(self.vectorstore_path, f))]
-
-        # Filter out the document to be removed
-        docs_to_keep = [f for f in all_docs if f != doc_to_remove]
-
-        if len(docs_to_keep) == len(all_docs):
-            print(f"Document {doc_to_remove} not found in the index. No changes made.")
-            return
+        stage_start = time.perf_counter()
+        prompt = self.build_prompt(question, docs)
+        timings["prompt_ms"] = (time.perf_counter() - stage_start) * 1000
 
-        # Rebuild the index with the remaining documents
-        self.rebuild_index([os.path.join(self.vectorstore_path, f) for f in docs_to_keep])
+        stage_start = time.perf_counter()
+        response = self.llm.invoke(prompt)
+        timings["llm_ms"] = (time.perf_counter() - stage_start) * 1000
 
-        print(f"Document {doc_to_remove} removed and index rebuilt.")
-
-    def rebuild_index(self, document_paths):
-        """Rebuild the entire index with the given documents."""
-        logger.info(f"Starting index rebuild with {len(document_paths)} documents")
-        texts = []
-        for path in document_paths:
-            try:
-                logger.info(f"Processing document: {path}")
-
-                if not os.path.exists(path):
-                    logger.error(f"File does not exist: {path}")
+        # 验证响应不包含其他公司的信息
+        stage_start = time.perf_counter()
+        if self._contains_other_organization_info(response):
+            response = LEAK_REFUSAL
+        timings["leak_check_ms"] = (time.perf_counter() - stage_start) * 1000
+        timings["total_ms"] = (time.perf_counter() - start) * 1000
+        for stage in ("prompt", "llm", "leak_check"):
+            STAGE_SECONDS.observe(timings[f"{stage}_ms"] / 1000, stage, str(self.organization_id))
+
+        logger.info(f"Generated response of {len(response)} characters in {timings['total_ms']:.0f} ms")
+        result = {"query": question, "result": response}
+        if debug:
+            result["timings"] = {stage: round(ms, 2) for stage, ms in timings.items()}
+            result["sources"] = [doc.metadata.get("document_id") for doc in docs]
+            result["context"] = context
+        return result
+
+    def query_batch(self, questions, vectors=None, debug=False):
+        """
+        Answer many questions at once: the questions are embedded in one
+        batched call and searched with one FAISS search per segment, then
+        LLM calls run with at most BATCH_QUERY_MAX_CONCURRENCY in flight.
+        Returns one entry per question, in order: {"query", "result"} (plus
+        "sources" and "context" when debug is set) or {"query", "error"}.
+        """
+        if not questions:
+            return []
+        start = time.perf_counter()
+        # 工作线程没有 Flask 应用上下文，泄露过滤器在当前线程取出
+        leak_filter = get_leak_filter()
+        contexts = self.select_contexts(questions, vectors=vectors)
+        retrieve_ms = (time.perf_counter() - start) * 1000
+
+        def answer(question, docs):
+            with self._stage("prompt"):
+                prompt = self.build_prompt(question, docs)
+            with self._stage("llm"):
+                response = self.llm.invoke(prompt)
+            with self._stage("leak_check"):
+                if leak_filter.contains_leak(self.organization_id, response):
+                    return LEAK_REFUSAL
+            return response
+
+        results = [None] * len(questions)
+        with ThreadPoolExecutor(max_workers=min(Config.BATCH_QUERY_MAX_CONCURRENCY, len(questions))) as pool:
+            futures = {pool.submit(answer, question, docs): i
+                       for i, (question, (docs, _)) in enumerate(zip(questions, contexts))}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    response = future.result()
+                except Exception as e:
+                    logger.error(f"Batch query {i} failed: {str(e)}")
+                    response = f"Error: {str(e)}"
+                # CustomAPILLM 以 "Error:" 开头的文本表示接口调用失败
+                if response.startswith("Error:"):
+                    results[i] = {"query": questions[i], "error": response}
                     continue
+                results[i] = {"query": questions[i], "result": response}
+                if debug:
+                    docs, report = contexts[i]
+                    results[i]["sources"] = [doc.metadata.get("document_id") for doc in docs]
+                    results[i]["context"] = report
+
+        failed = sum(1 for result in results if "error" in result)
+        logger.info(f"Answered {len(questions) - failed} of {len(questions)} batched questions in "
+                    f"{(time.perf_counter() - start) * 1000:.0f} ms (retrieval {retrieve_ms:.0f} ms)")
+        return results
+
+    def stream_query(self, question):
+        """
+        Stream the answer as events: {"type": "token", "text"} pieces, then
+        {"type": "done"}, or {"type": "blocked", "result"} if the leak check
+        fires. The last characters (up to the longest leak pattern) are held
+        back until they can no longer be part of a match, so blocked text is
+        never sent. Closing the generator cancels the upstream LLM request.
+        """
+        leak_filter = get_leak_filter()
+        scanner = leak_filter.scanner(self.organization_id)
+        holdback = leak_filter.max_pattern_length
+
+        docs, _ = self.select_context(question)
+        prompt = self.build_prompt(question, docs)
+
+        text = ""
+        emitted = 0
+        llm_started = time.perf_counter()
+        tokens = self.llm.stream(prompt)
+        try:
+            for token in tokens:
+                text += token
+                # 扫描器保存自动机状态，只需扫描新到达的文本
+                if scanner.feed(token):
+                    logger.warning(f"Blocked streamed response for organization {self.organization_id}")
+                    yield {"type": "blocked", "result": LEAK_REFUSAL}
+                    return
+                safe = len(text) - holdback
+                if safe > emitted:
+                    yield {"type": "token", "text": text[emitted:safe]}
+                    emitted = safe
+        finally:
+            tokens.close()
+        STAGE_SECONDS.observe(time.perf_counter() - llm_started, "llm", str(self.organization_id))
+
+        if scanner.finish():
+            logger.warning(f"Blocked streamed response for organization {self.organization_id}")
+            yield {"type": "blocked", "result": LEAK_REFUSAL}
+            return
+        if emitted < len(text):
+            yield {"type": "token", "text": text[emitted:]}
+        logger.info(f"Streamed response of {len(text)} characters")
+        yield {"type": "done", "result": text}
 
-                # Check file size and type
-                file_size = os.path.getsize(path)
-                mime_type, _ = mimetypes.guess_type(path)
-                logger.info(f"File size: {file_size} bytes, MIME type: {mime_type}")
-
-                logger.info("Partitioning document with unstructured")
-                elements = partition(filename=path)
-                logger.info(f"Partitioned {len(elements)} elements from the document")
+    def _contains_other_organization_info(self, response):
+        # 检查响应中是否出现其他组织的 ID 或名称
+        return get_leak_filter().contains_leak(self.organization_id, response)
+
+    def remove_document(self, document_id):
+        """
+        Remove a document's chunks from the index by their chunk IDs.
+        Returns False when the document is unknown but the index still holds
+        untagged chunks from before chunks were tagged, in which case the
+        caller should rebuild the index from the remaining documents.
+        """
+        with self.write_mutex:
+            if not self.chunk_store.document_chunk_ids(document_id):
+                logger.warning(f"Document {document_id} not found in the index of organization {self.organization_id}")
+                return not self._has_untagged_chunks()
+            self._delete_chunks(document_id)
+            # 向量只是成为墓碑，段文件本身不需要重写
+            self.manifest = self._write_manifest()
+            return True
+
+    def _has_untagged_chunks(self):
+        # 减去创建空索引时的占位文本
+        return len(self.chunk_store) - self.chunk_store.tagged_count() > 1
+
+    def _delete_chunks(self, document_id):
+        # 删除文本块后其向量成为墓碑（位置保持不变），由 compact_index 清理；其他文档仍引用的文本块保留
+        document_ids = self.chunk_store.document_chunk_ids(document_id)
+        owners = self.chunk_store.chunk_owners(document_ids, excluding=document_id)
+        ids = [chunk_id for chunk_id in document_ids if chunk_id not in owners]
+        # 保留的文本块如果记在被删除的文档名下，改为归属仍引用它的文档
+        shared = self.chunk_store.get(chunk_id for chunk_id in document_ids if chunk_id in owners)
+        reassigned = {chunk_id: dict(doc.metadata, document_id=int(owners[chunk_id]))
+                      for chunk_id, doc in shared.items()
+                      if str(doc.metadata.get("document_id")) == str(document_id)}
+        with self.lock.write():
+            self.chunk_store.delete(ids)
+            self.chunk_store.delete_document(document_id)
+            self.lexical_index.remove(ids)
+            if reassigned:
+                self.chunk_store.update_metadata(reassigned)
+        logger.info(f"Removed {len(ids)} chunks of document {document_id} from the index")
+
+    def rebuild_index(self, documents):
+        """
+        Rebuild the entire index from (document_id, file_path) pairs.
+        Documents are parsed in parallel in the shared process pool and each
+        one is embedded as soon as its parse finishes. A document that fails
+        is skipped and reported instead of aborting the rebuild.
+        Returns {"documents", "indexed", "chunks", "failed": {document_id: error}}.
+        """
+        with self.write_mutex, self._stage("rebuild"):
+            return self._rebuild_index(documents)
+
+    def _rebuild_index(self, documents):
+        documents = list(documents)
+        logger.info(f"Starting index rebuild with {len(documents)} documents")
+        texts, vectors, metadatas, ids = [], [], [], []
+        document_chunk_ids = {}
+        failed = {}
+        # 文本 -> 首个文本块 ID；文档之间重复的文本块只嵌入和索引一次
+        known = {}
+
+        def index(document_id, path, future):
+            try:
+                elements = future.result()
 
                 # Extract text from all elements
-                doc_texts = [str(element) for element in elements if hasattr(element, 'text')]
+                doc_texts = [element["text"] for element in elements]
                 logger.info(f"Extracted {len(doc_texts)} text chunks from {path}")
 
                 if len(doc_texts) == 0:
                     logger.warning(f"No text content found in {path}. Skipping this document.")
-                    continue
+                    return
 
+                doc_ids, doc_metadatas = self._chunk_metadata(document_id, doc_texts)
+                doc_ids, doc_texts, doc_metadatas, doc_chunk_ids = self._deduplicate_chunks(
+                    doc_ids, doc_texts, doc_metadatas, known)
+                doc_vectors = self.embedding_pipeline.embed(doc_texts)
+                known.update(zip(doc_texts, doc_ids))
                 texts.extend(doc_texts)
+                vectors.extend(doc_vectors)
+                metadatas.extend(doc_metadatas)
+                ids.extend(doc_ids)
+                document_chunk_ids[str(document_id)] = doc_chunk_ids
 
             except Exception as e:
                 logger.error(f"Error processing file {path}: {str(e)}")
                 logger.error(f"Traceback: {traceback.format_exc()}")
+                failed[document_id] = str(e)
+
+        pool = get_parse_pool()
+        futures = {}
+        crashed = []
+        for document_id, path in documents:
+            if not os.path.exists(path):
+                logger.error(f"File does not exist: {path}")
+                failed[document_id] = "File does not exist"
                 continue
-
+            try:
+                futures[pool.submit(parse_document, path, self.organization_id)] = (document_id, path)
+            except BrokenProcessPool:
+                crashed.append((document_id, path))
+
+        # 每个文档解析完成后立即嵌入，其余文档继续在子进程中解析
+        for future in as_completed(futures):
+            if isinstance(future.exception(), BrokenProcessPool):
+                # 一个子进程崩溃后，所有未完成的文档都会报同样的错误，稍后逐个重新解析
+                crashed.append(futures[future])
+                continue
+            index(*futures[future], future)
+
+        if crashed:
+            logger.warning(f"A parse process crashed; parsing {len(crashed)} documents again one at a time")
+            reset_parse_pool(pool)
+            for document_id, path in crashed:
+                # 逐个提交，再次崩溃的只会是出问题的那个文件
+                pool = get_parse_pool()
+                future = pool.submit(parse_document, path, self.organization_id)
+                if isinstance(future.exception(), BrokenProcessPool):
+                    reset_parse_pool(pool)
+                index(document_id, path, future)
+
+        summary = {"documents": len(documents), "indexed": len(document_chunk_ids),
+                   "chunks": len(texts), "failed": failed}
+        if documents and len(failed) == len(documents):
+            logger.error("Every document failed to process. Keeping the current index.")
+            return summary
+
+        # Create a new FAISS index; its type follows the number of chunks
         if not texts:
-            logger.error("No valid documents to index. Aborting rebuild.")
-            return
-
-        # Create a new FAISS index
-        new_vectorstore = FAISS.from_texts(texts, self.embeddings)
-
-        # Save the new index
-        if os.path.exists(self.vectorstore_path):
-            logger.info(f"Removing old vectorstore at {self.vectorstore_path}")
-            shutil.rmtree(self.vectorstore_path)
-
-        logger.info(f"Saving new vectorstore to {self.vectorstore_path}")
-        new_vectorstore.save_local(self.vectorstore_path)
-
-        # Update the current vectorstore
-        self.vectorstore = new_vectorstore
-        logger.info(f"Index rebuilt with {len(texts)} text chunks from {len(document_paths)} documents.")
+            logger.warning("No valid documents to index. Rebuilding an empty index.")
+            texts, vectors = [EMPTY_INDEX_PLACEHOLDER], self.embedding_pipeline.embed([EMPTY_INDEX_PLACEHOLDER])
+            ids, metadatas = [PLACEHOLDER_CHUNK_ID], [{}]
+        new_index = vector_index.build_index(vectors)
+
+        new_lexical_index = self._new_lexical_index()
+        new_lexical_index.add([i for i, text in zip(ids, texts) if text != EMPTY_INDEX_PLACEHOLDER],
+                              [text for text in texts if text != EMPTY_INDEX_PLACEHOLDER])
+
+        # Save the new index as a fresh base segment; the manifest swap keeps the live index available
+        logger.info(f"Saving new index to {self.vectorstore_path}")
+        self._replace_base(new_index, new_lexical_index, (ids, texts, metadatas), document_chunk_ids)
+        logger.info(f"Index rebuilt with {len(new_lexical_index)} text chunks from {len(document_chunk_ids)} of "
+                    f"{len(documents)} documents ({len(failed)} failed).")
+        return summary
+
+    def needs_compaction(self):
+        with self.lock.read():
+            return self._compaction_reason() is not None or self._merge_plan() is not None
+
+    def _compaction_reason(self):
+        """Why the segments should be rebuilt into a new base, or None. Caller holds the lock."""
+        return vector_index.reindex_reason(self.segments[0].index, len(self.chunk_store),
+                                           sum(segment.count for segment in self.segments))
+
+    def _merge_plan(self):
+        """The (start, end) slice of the delta segments to merge next, or None. Caller holds the lock."""
+        return segments.plan_merge(self.segments[1:], Config.LSM_MAX_DELTA_SEGMENTS, Config.LSM_MERGE_FACTOR)
+
+    def compact_index(self):
+        """
+        When the base index no longer suits the corpus (see
+        vector_index.reindex_reason), rebuild a new base from the chunks
+        still live, dropping tombstones and switching to the index type that
+        suits the current number of chunks. Otherwise, when there are too
+        many delta segments, merge a few adjacent ones (segments.plan_merge);
+        that work is proportional to their size, not to the corpus. Vectors
+        are read back from the segments, so this normally makes no embedding
+        API calls. Returns the description of the base index.
+        """
+        with self.write_mutex:
+            with self.lock.read():
+                reason = self._compaction_reason()
+                plan = self._merge_plan() if reason is None else None
+                if reason is None and plan is None:
+                    return vector_index.describe_index(self.segments[0].index)
+
+            compaction_started = time.perf_counter()
+            if reason is not None:
+                logger.info(f"Rebuilding vector index of organization {self.organization_id}: {reason}")
+                self._rebuild_base_from_chunks(self.embedding_provider)
+            else:
+                self._merge_deltas(*plan)
+            STAGE_SECONDS.observe(time.perf_counter() - compaction_started, "compaction", str(self.organization_id))
+            return vector_index.describe_index(self.segments[0].index)
+
+    def _merge_deltas(self, start, end):
+        """Replace the delta segments [start, end) by one segment over the same positions. Caller holds write_mutex."""
+        path = self.vectorstore_path
+        merged = self.segments[1 + start:1 + end]
+        first, last = merged[0], merged[-1]
+        count = last.start + last.count - first.start
+        logger.info(f"Merging {len(merged)} delta segments ({count} vectors) of organization {self.organization_id}")
+
+        # 增量段都是 Flat 索引，向量可以原样读出；被删除的向量保留，位置不变
+        index = vector_index.build_index(np.concatenate([segment.index.reconstruct_n(0, segment.count)
+                                                         for segment in merged]), spec="Flat")
+        lexical_index = None
+        for segment in merged:
+            segment_index = LexicalIndex.load(os.path.join(path, segment.name))
+            if lexical_index is None:
+                lexical_index = segment_index
+            else:
+                lexical_index.extend(segment_index)
+        lexical_index.retain(self.chunk_store.chunk_ids_at(range(first.start, first.start + count)).values())
+
+        entry = {"name": segments.new_name("segment"), "start": first.start, "count": count}
+        segments.write_segment(path, entry["name"], index, lexical_index)
+        entries = self.manifest["segments"]
+        manifest = self._write_manifest(segments=entries[:1 + start] + [entry] + entries[1 + end:])
+
+        segment = self._open_segment(entry, index)
+        with self.lock.write():
+            self.segments = self.segments[:1 + start] + [segment] + self.segments[1 + end:]
+            self.manifest = manifest
+        segments.remove_unreferenced(path, manifest, Config.LSM_FILE_GRACE_SECONDS)
+
+    def _rebuild_base_from_chunks(self, provider):
+        """Replace the segments by a base of the live chunks embedded by `provider`. Caller holds write_mutex."""
+        chunks = list(self.chunk_store.iter_chunks())
+        ids = [chunk_id for _, chunk_id, _, _ in chunks]
+        texts = [text for _, _, text, _ in chunks]
+        if provider is self.embedding_provider:
+            # 向量从段中读出；只存有量化向量的段退回嵌入缓存
+            with self.lock.read():
+                vectors, found = segments.read_vectors(self.segments, [position for position, _, _, _ in chunks],
+                                                       self.dimension)
+            missing = np.flatnonzero(~found)
+            if len(missing):
+                vectors[missing] = np.asarray(self.embedding_pipeline.embed([texts[i] for i in missing]),
+                                              dtype=np.float32)
+        else:
+            vectors = np.asarray(provider.pipeline(get_embedding_cache()).embed(texts), dtype=np.float32)
+        new_index = vector_index.build_index(vectors)
+        new_lexical_index = self._new_lexical_index()
+        new_lexical_index.add([i for i, text in zip(ids, texts) if text != EMPTY_INDEX_PLACEHOLDER],
+                              [text for text in texts if text != EMPTY_INDEX_PLACEHOLDER])
+        self._replace_base(new_index, new_lexical_index, (ids, texts, [metadata for _, _, _, metadata in chunks]),
+                           self.chunk_store.documents(), provider=provider)
+        return new_index
+
+    def needs_reembedding(self):
+        """Whether the deployment now assigns the organization a different embedding provider than its index uses."""
+        return provider_name_for(self.organization_id) != self.embedding_provider.name
+
+    def reembed(self):
+        """
+        Migrate the index to the embedding provider now configured for the
+        organization: every live chunk is embedded again and the segments
+        are replaced by a new base, as in a full compact_index(). Queries keep
+        using the old index and provider until the swap. Returns the name of
+        the provider the index uses.
+        """
+        with self.write_mutex:
+            name = provider_name_for(self.organization_id)
+            if name == self.embedding_provider.name:
+                return name
+            provider = get_provider(name)
+            logger.info(f"Re-embedding index of organization {self.organization_id}: "
+                        f"{self.embedding_provider.name} -> {name}")
+            reembedding_started = time.perf_counter()
+            self._rebuild_base_from_chunks(provider)
+            STAGE_SECONDS.observe(time.perf_counter() - reembedding_started, "reembedding", str(self.organization_id))
+            return name
+
+    def index_info(self):
+        with self.lock.read():
+            base = self.segments[0].index
+            chunks = len(self.chunk_store)
+            info = vector_index.describe_index(base)
+            info["chunks"] = chunks
+            info["segments"] = len(self.segments)
+            info["delta_vectors"] = sum(segment.count for segment in self.segments[1:])
+            info["tombstones"] = self.tombstones
+            info["recommended"] = vector_index.choose_index_spec(chunks, base.d)
+            info["reindex_reason"] = self._compaction_reason()
+            info["embedding_provider"] = self.embedding_provider.name
+            info["embedding_model"] = self.embedding_provider.model
+        info["configured_embedding_provider"] = provider_name_for(self.organization_id)
+        return info
+
+    def recall_report(self, k=10, queries=100):
+        """
+        Recall@k against exact search and latency for a sweep of the base
+        index's nprobe or efSearch, using a sample of its stored chunks as
+        queries. Delta segments are exact and not measured. Queries are
+        blocked while the sweep runs.
+        """
+        # 持有 write_mutex，保证向量位置在嵌入期间不变
+        with self.write_mutex:
+            base = self.segments[0]
+            chunks = [chunk for chunk in self.chunk_store.iter_chunks() if chunk[0] < base.start + base.count]
+            vectors = np.array(self.embedding_pipeline.embed([text for _, _, text, _ in chunks]), dtype=np.float32)
+            sample = np.random.default_rng().choice(len(vectors), min(queries, len(vectors)), replace=False)
+            with self.lock.write():
+                return vector_index.recall_report(base.index, [position for position, _, _, _ in chunks],
+                                                  vectors, vectors[sample], k=k)
@@ -0,0 +1,206 @@
+from .lexical_index import LexicalIndex
+from . import vector_index
+import heapq
+import json
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+SEGMENT_INDEX_FILE = "index.faiss"
+
+
+def new_name(prefix, suffix=""):
+    # 名称带随机后缀，并发写出的文件不会互相覆盖，未被清单引用的文件稍后统一清理
+    return f"{prefix}-{uuid.uuid4().hex[:12]}{suffix}"
+
+
+class Segment:
+    """
+    One immutable slice of an organization's vectors: a FAISS index whose
+    local position i is global position `start + i` in the chunk store,
+    plus the BM25 postings of its chunks.
+    """
+
+    def __init__(self, name, start, index):
+        self.name = name
+        self.start = start
+        self.index = index
+
+    @property
+    def count(self):
+        return self.index.ntotal
+
+
+def read_manifest(directory):
+    """
+    The organization's manifest, or None if there is none yet:
+
+        {"segments": [{"name", "start", "count"}, ...],   base first, then deltas
+         "chunk_store": file name of the SQLite chunk store,
+         "next_position": first position not used by any segment,
+         "documents": {document_id: [chunk_id, ...]},
+         "retired": {file name: time it stopped being referenced}}
+    """
+    path = os.path.join(directory, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_manifest(directory, manifest):
+    """Atomically replace the manifest: readers see either the old or the new set of segments, never a mix."""
+    staging_path = os.path.join(directory, f"{MANIFEST_FILE}.tmp")
+    with open(staging_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(staging_path, os.path.join(directory, MANIFEST_FILE))
+
+
+def write_segment(directory, name, index, lexical_index):
+    """Write a segment to a staging directory and rename it into place."""
+    staging_path = os.path.join(directory, f"{name}.tmp")
+    shutil.rmtree(staging_path, ignore_errors=True)
+    os.makedirs(staging_path)
+    vector_index.write_index(index, os.path.join(staging_path, SEGMENT_INDEX_FILE))
+    lexical_index.save(staging_path)
+    os.replace(staging_path, os.path.join(directory, name))
+
+
+def load_segment(directory, entry, mmap=False):
+    index = vector_index.read_index(os.path.join(directory, entry["name"], SEGMENT_INDEX_FILE), mmap=mmap)
+    return Segment(entry["name"], entry["start"], index)
+
+
+def load_lexical_index(directory, manifest):
+    """One BM25 index over every segment; a chunk ID in a later segment replaces earlier copies."""
+    lexical_index = None
+    for entry in manifest["segments"]:
+        segment_index = LexicalIndex.load(os.path.join(directory, entry["name"]))
+        if lexical_index is None:
+            lexical_index = segment_index
+        else:
+            lexical_index.extend(segment_index)
+    return lexical_index
+
+
+def search_segments(segments, vectors, k):
+    """
+    For each query vector, the global positions of the k nearest vectors
+    across all segments, nearest first. Each segment is searched once for
+    all queries.
+    """
+    queries = np.array(vectors, dtype=np.float32)
+    hits = [[] for _ in range(len(queries))]
+    for segment in segments:
+        if not segment.count:
+            continue
+        distances, positions = segment.index.search(queries, min(k, segment.count))
+        for row_hits, row_distances, row_positions in zip(hits, distances, positions):
+            row_hits.extend((float(d), segment.start + int(p)) for d, p in zip(row_distances, row_positions) if p != -1)
+    return [[position for _, position in heapq.nsmallest(k, row_hits)] for row_hits in hits]
+
+
+def read_vectors(segments, positions, dimension):
+    """
+    Float32 matrix with one row per global position, read back from the
+    segments that hold them, and a boolean mask of the rows that were
+    found: segments that only store quantized vectors are skipped.
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    vectors = np.zeros((len(positions), dimension), dtype=np.float32)
+    found = np.zeros(len(positions), dtype=bool)
+    for segment in segments:
+        if not segment.count or not vector_index.stores_exact_vectors(segment.index):
+            continue
+        rows = np.flatnonzero((positions >= segment.start) & (positions < segment.start + segment.count))
+        if len(rows):
+            vectors[rows] = segment.index.reconstruct_batch(positions[rows] - segment.start)
+            found[rows] = True
+    return vectors, found
+
+
+def reconstruct(segments, positions):
+    """{position: vector} for the given global positions that read_vectors() can read back."""
+    positions = list(positions)
+    if not positions:
+        return {}
+    vectors, found = read_vectors(segments, positions, segments[0].index.d)
+    return {position: vectors[row] for row, position in enumerate(positions) if found[row]}
+
+
+def plan_merge(deltas, max_segments, factor):
+    """
+    Size-tiered merge policy for delta segments: once there are more than
+    max_segments, merge the `factor` adjacent deltas whose largest member
+    is smallest (the newest such run on ties). Small recent deltas are
+    merged with each other first and large ones only with similarly large
+    ones, so a vector is rewritten about log_factor(n) times.
+    Returns the (start, end) slice of `deltas` to merge, or None.
+    """
+    if len(deltas) <= max_segments:
+        return None
+    factor = max(2, min(factor, len(deltas)))
+    best_size, best_start = None, None
+    for start in range(len(deltas) - factor + 1):
+        size = max(delta.count for delta in deltas[start:start + factor])
+        if best_size is None or size <= best_size:
+            best_size, best_start = size, start
+    return best_start, best_start + factor
+
+
+def referenced_files(manifest):
+    names = {manifest["chunk_store"]}
+    names.update(entry["name"] for entry in manifest["segments"])
+    return names
+
+
+def retire(directory, previous, manifest):
+    """
+    The "retired" map for `manifest`, which replaces `previous`: the files
+    `previous` referenced and `manifest` no longer does, stamped with the
+    current time, plus earlier retired files that still exist.
+    """
+    if previous is None:
+        return {}
+    retired = {name: retired_at for name, retired_at in previous.get("retired", {}).items()
+               if os.path.exists(os.path.join(directory, name))}
+    now = time.time()
+    for name in referenced_files(previous) - referenced_files(manifest):
+        retired.setdefault(name, now)
+    return retired
+
+
+def remove_unreferenced(directory, manifest, grace_seconds):
+    """
+    Delete segment directories and chunk stores the manifest no longer
+    references, grace_seconds after they were retired: other processes
+    may still be reading them through the previous manifest.
+    """
+    referenced = referenced_files(manifest) | {MANIFEST_FILE}
+    retired = manifest.get("retired", {})
+    cutoff = time.time() - grace_seconds
+    removed = 0
+    for entry in os.scandir(directory):
+        # 也保留当前 chunk store 的日志文件
+        if entry.name in referenced or entry.name.startswith(manifest["chunk_store"]):
+            continue
+        # 从未被清单引用的文件（写到一半中断）以及旧版清单中的文件按修改时间计算
+        retired_at = next((retired_at for name, retired_at in retired.items() if entry.name.startswith(name)),
+                          entry.stat().st_mtime)
+        if retired_at > cutoff:
+            continue
+        if entry.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            os.remove(entry.path)
+        removed += 1
+    if removed:
+        logger.info(f"Removed {removed} unreferenced files from {directory}")
@@ -0,0 +1,216 @@
+from config import Config
+import faiss
+import math
+import time
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 训练 IVF / PQ 时最多使用的样本数
+MAX_TRAINING_VECTORS = 100000
+
+
+def choose_index_spec(n_vectors, dimension):
+    """
+    FAISS index_factory description for a corpus of n_vectors:
+
+        fewer than FAISS_FLAT_MAX_VECTORS  "Flat" (exact search)
+        FAISS_INDEX_TYPE=hnsw              "HNSW<M>", "HNSW<M>,SQ8" or "HNSW<M>,PQ<m>"
+        FAISS_INDEX_TYPE=ivf               "IVF<nlist>,Flat", "IVF<nlist>,SQ8" or "IVF<nlist>,PQ<m>"
+
+    FAISS_QUANTIZATION selects the vector encoding: "none", "sq8" (4x
+    smaller) or "pq" (dimension / FAISS_PQ_M times 4 smaller).
+    """
+    if n_vectors < Config.FAISS_FLAT_MAX_VECTORS:
+        return "Flat"
+
+    quantization = Config.FAISS_QUANTIZATION
+    if quantization == "sq8":
+        encoding = "SQ8"
+    elif quantization == "pq":
+        encoding = f"PQ{_pq_subquantizers(dimension)}"
+    else:
+        encoding = "Flat"
+
+    if Config.FAISS_INDEX_TYPE == "hnsw":
+        return f"HNSW{Config.FAISS_HNSW_M}" if encoding == "Flat" else f"HNSW{Config.FAISS_HNSW_M},{encoding}"
+    return f"IVF{_nlist(n_vectors)},{encoding}"
+
+
+def _nlist(n_vectors):
+    # 约 4·√n 个聚类，同时保证每个聚类至少有 39 个训练样本
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+
+def _pq_subquantizers(dimension):
+    m = Config.FAISS_PQ_M or dimension // 4
+    # 子量化器个数必须整除向量维度
+    while dimension % m:
+        m -= 1
+    return m
+
+
+def _ivf(index):
+    try:
+        return faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return None
+
+
+def _hnsw(index):
+    index = faiss.downcast_index(index)
+    return index.hnsw if hasattr(index, "hnsw") else None
+
+
+def stores_exact_vectors(index):
+    """Whether reconstruct() returns the vectors the index was built from (not a quantized approximation)."""
+    return isinstance(faiss.downcast_index(index), (faiss.IndexFlat, faiss.IndexHNSWFlat))
+
+
+def index_kind(index):
+    if _ivf(index) is not None:
+        return "ivf"
+    if _hnsw(index) is not None:
+        return "hnsw"
+    return "flat"
+
+
+def apply_search_params(index, nprobe=None, ef_search=None):
+    ivf = _ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe or Config.FAISS_NPROBE, ivf.nlist)
+    hnsw = _hnsw(index)
+    if hnsw is not None:
+        hnsw.efSearch = ef_search or Config.FAISS_EF_SEARCH
+
+
+def read_index(path, mmap=False):
+    """
+    Read an index file. With mmap the vector data is served from the page
+    cache, which every process mapping the same file shares, and the index
+    is read-only.
+    """
+    flags = 0
+    if mmap:
+        # IO_FLAG_MMAP_IFC（较新版本的 faiss）让 Flat 索引的向量也走内存映射
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    index = faiss.read_index(path, flags)
+    apply_search_params(index)
+    return index
+
+
+def write_index(index, path):
+    faiss.write_index(index, path)
+
+
+def build_index(vectors, spec=None):
+    """Create, train and fill the index chosen for these vectors (float32, one per row)."""
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n_vectors, dimension = vectors.shape
+    spec = spec or choose_index_spec(n_vectors, dimension)
+    started = time.perf_counter()
+    index = faiss.index_factory(dimension, spec, faiss.METRIC_L2)
+
+    hnsw = _hnsw(index)
+    if hnsw is not None:
+        hnsw.efConstruction = Config.FAISS_EF_CONSTRUCTION
+    if not index.is_trained:
+        sample = vectors
+        if n_vectors > MAX_TRAINING_VECTORS:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(n_vectors, MAX_TRAINING_VECTORS, replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    apply_search_params(index)
+
+    logger.info(f"Built {spec} index over {n_vectors} vectors in {time.perf_counter() - started:.1f}s")
+    return index
+
+
+def reindex_reason(index, n_live, n_total=None):
+    """
+    Why the index no longer suits its corpus (wrong type, stale IVF
+    training, too many tombstones), or None. n_total is the number of
+    stored vectors, tombstones included, when they span several indexes.
+    """
+    desired = choose_index_spec(n_live, index.d)
+    desired_kind = "ivf" if desired.startswith("IVF") else "hnsw" if desired.startswith("HNSW") else "flat"
+    if index_kind(index) != desired_kind:
+        return f"corpus of {n_live} vectors should use {desired}"
+    ivf = _ivf(index)
+    if ivf is not None and _nlist(n_live) > 2 * ivf.nlist:
+        return f"IVF trained with {ivf.nlist} lists, corpus now needs {_nlist(n_live)}"
+    n_total = index.ntotal if n_total is None else n_total
+    tombstones = n_total - n_live
+    if tombstones > Config.FAISS_COMPACT_RATIO * max(n_total, 1):
+        return f"{tombstones} of {n_total} vectors are deleted"
+    return None
+
+
+def describe_index(index):
+    info = {"type": index_kind(index), "vectors": index.ntotal, "dimension": index.d}
+    ivf = _ivf(index)
+    if ivf is not None:
+        info["nlist"] = ivf.nlist
+        info["nprobe"] = ivf.nprobe
+        info["bytes_per_vector"] = ivf.code_size
+    hnsw = _hnsw(index)
+    if hnsw is not None:
+        info["ef_search"] = hnsw.efSearch
+        info["bytes_per_vector"] = faiss.downcast_index(index).storage.sa_code_size()
+    if info["type"] == "flat":
+        info["bytes_per_vector"] = index.d * 4
+    return info
+
+
+def recall_report(index, live_positions, live_vectors, queries, k=10):
+    """
+    Recall@k and mean latency per query for a sweep of nprobe (IVF) or
+    efSearch (HNSW) values, measured against exact search over the live
+    vectors. Positions missing from live_positions are tombstones and
+    are skipped in the approximate results. Restores the current setting.
+    """
+    live_vectors = np.ascontiguousarray(live_vectors, dtype=np.float32)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    live_positions = np.asarray(live_positions, dtype=np.int64)
+    k = min(k, len(live_positions))
+    exact = faiss.IndexFlatL2(index.d)
+    exact.add(live_vectors)
+    _, truth = exact.search(queries, k)
+    truth = [set(live_positions[row]) for row in truth]
+
+    live = set(live_positions.tolist())
+    fetch_k = min(index.ntotal, k + index.ntotal - len(live))
+
+    def measure():
+        started = time.perf_counter()
+        _, found = index.search(queries, fetch_k)
+        latency_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        hits = 0
+        for row, expected in zip(found, truth):
+            returned = [p for p in row if p in live][:k]
+            hits += len(expected.intersection(returned))
+        return round(hits / (k * len(queries)), 4), round(latency_ms, 3)
+
+    ivf, hnsw = _ivf(index), _hnsw(index)
+    results = []
+    if ivf is not None:
+        current = ivf.nprobe
+        for nprobe in [p for p in (1, 2, 4, 8, 16, 32, 64, 128, 256) if p <= ivf.nlist]:
+            ivf.nprobe = nprobe
+            recall, latency_ms = measure()
+            results.append({"nprobe": nprobe, "recall": recall, "latency_ms": latency_ms})
+        ivf.nprobe = current
+    elif hnsw is not None:
+        current = hnsw.efSearch
+        for ef_search in [e for e in (16, 32, 64, 128, 256, 512) if e >= k]:
+            hnsw.efSearch = ef_search
+            recall, latency_ms = measure()
+            results.append({"ef_search": ef_search, "recall": recall, "latency_ms": latency_ms})
+        hnsw.efSearch = current
+    else:
+        recall, latency_ms = measure()
+        results.append({"recall": recall, "latency_ms": latency_ms})
+
+    return {"index": describe_index(index), "k": k, "queries": len(queries), "results": results}
@@ -0,0 +1,21 @@
+import os
+import resource
+
+
+def process_memory():
+    """
+    Resident memory of this process in bytes. On Linux the total is split
+    into anonymous (private heap) and file-backed pages; memory-mapped
+    indexes count as file-backed and are shared with other processes.
+    """
+    usage = {"pid": os.getpid()}
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        for name, key in (("VmRSS", "rss_bytes"), ("RssAnon", "rss_anon_bytes"), ("RssFile", "rss_file_bytes")):
+            if name in fields:
+                usage[key] = int(fields[name].split()[0]) * 1024
+    except OSError:
+        # 非 Linux 系统只能拿到峰值
+        usage["max_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return usage
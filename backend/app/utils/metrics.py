@@ -0,0 +1,177 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 秒；覆盖从毫秒级的检索到数十秒的 LLM 调用和文档解析
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, label_values, value) for label_values, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=()):
+        super().__init__(name, documentation, labels)
+        self._values = {}
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    @contextmanager
+    def track(self, *label_values):
+        """Count the enclosed block as in progress."""
+        self.inc(*label_values)
+        try:
+            yield
+        finally:
+            self.dec(*label_values)
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, label_values, value) for label_values, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # label values -> [每个桶的计数..., +Inf 桶计数, 总和]
+
+    def observe(self, value, *label_values):
+        # 只在对应的桶上加一，导出时再累加成 Prometheus 的累计桶
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self):
+        with self._lock:
+            series = {label_values: list(values) for label_values, values in self._series.items()}
+        samples = []
+        for label_values, values in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", label_values + (_format_value(bound),), cumulative))
+            samples.append((f"{self.name}_count", label_values, cumulative))
+            samples.append((f"{self.name}_sum", label_values, values[-1]))
+        return samples
+
+    def sample_labels(self, name):
+        return self.labels + ("le",) if name.endswith("_bucket") else self.labels
+
+
+_metrics = []
+_collectors = {}
+
+
+def register_collector(name, collector):
+    """
+    Register a function called on every scrape that returns
+    [(name, type, documentation, [(labels_dict, value), ...])], for values
+    that are cheaper to read on demand than to keep up to date (cache and
+    index sizes). Registering the same name again replaces the collector.
+    """
+    _collectors[name] = collector
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def render():
+    """All metrics of this process in the Prometheus text exposition format."""
+    lines = []
+    for metric in list(_metrics):
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, label_values, value in metric.samples():
+            labels = metric.sample_labels(name) if isinstance(metric, Histogram) else metric.labels
+            lines.append(f"{name}{_format_labels(labels, label_values)} {_format_value(value)}")
+    for collector_name, collector in list(_collectors.items()):
+        try:
+            families = collector()
+        except Exception as e:
+            logger.warning(f"Metrics collector {collector_name} failed: {str(e)}")
+            continue
+        for name, metric_type, documentation, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(tuple(labels), tuple(labels.values()))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+# 各环节耗时，按组织区分；ingestion 的解析、嵌入、写索引与查询的检索、LLM 调用共用一个直方图
+STAGE_SECONDS = Histogram("echosage_stage_seconds", "Time spent in each query and ingestion stage",
+                          ("stage", "organization"))
+REQUEST_SECONDS = Histogram("echosage_request_seconds", "HTTP request latency", ("endpoint", "status"))
+REQUESTS_IN_FLIGHT = Gauge("echosage_requests_in_flight", "HTTP requests being served", ("endpoint",))
+CACHE_LOOKUPS = Counter("echosage_cache_lookups_total", "Cache lookups by cache and result", ("cache", "result"))
+LLM_RETRIES = Counter("echosage_llm_retries_total", "LLM API requests retried, by status code or connection error",
+                      ("reason",))
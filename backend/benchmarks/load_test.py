@@ -0,0 +1,363 @@
+"""
+End-to-end HTTP load test of the Flask API.
+
+By default the whole stack runs locally: the app is served by werkzeug's
+threaded server (as with `flask run`) on a SQLite database in a scratch
+directory, with a local redis-server (or fakeredis[lua] when redis-server is
+not installed), the hash embedding stub and the stub chat server. Pass
+--base-url to load an existing deployment instead; it then needs the
+admin credentials.
+
+Organizations, users and a seed document per organization are created
+through the admin and document routes. Virtual users then run a weighted
+mix of login, query, list-documents and upload requests at each
+concurrency level, and the report shows throughput, latency percentiles
+and error rates per endpoint.
+
+Run from the backend directory:
+
+    python -m benchmarks.load_test --concurrency 1 8 32 --duration 30
+    python -m benchmarks.load_test --mix query=8,login=1,list_documents=1 --llm-latency-ms 500
+    python -m benchmarks.load_test --base-url http://localhost:5000 --admin-password ...
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import httpx
+from benchmarks.run import RESULTS_DIR, configure_environment, git_commit, percentiles
+
+DEFAULT_MIX = "query=6,login=1,list_documents=2,upload=1"
+WORDS = ("warranty", "pricing", "installation", "battery", "firmware", "shipping", "returns", "support",
+         "AB-1042", "AB-2077", "maintenance", "compatibility", "invoice", "subscription", "license", "safety")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Asyncio HTTP load test of the Flask API")
+    parser.add_argument("--base-url", help="load an existing deployment instead of starting a local stack")
+    parser.add_argument("--admin-user", default="admin")
+    parser.add_argument("--admin-password", default=os.environ.get("ADMIN_PASSWORD", "secure_admin_password"))
+    parser.add_argument("--organizations", type=int, default=4)
+    parser.add_argument("--users-per-organization", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64], help="virtual users per level")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per concurrency level")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation weights, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--llm-latency-ms", type=float, default=200)
+    parser.add_argument("--llm-jitter-ms", type=float, default=50)
+    parser.add_argument("--dimension", type=int, default=1024)
+    parser.add_argument("--redis-url", help="local stack: use this Redis instead of starting one")
+    parser.add_argument("--workdir", help="local stack: scratch directory (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="result file (default: benchmarks/results/load-<time>-<commit>.json)")
+    parser.add_argument("--verbose", action="store_true", help="keep the application's INFO logging")
+    return parser.parse_args(argv)
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in OPERATIONS:
+            raise SystemExit(f"Unknown operation {name!r}; choose from {', '.join(OPERATIONS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalStack:
+    """The app, Redis and the LLM stub on local ports, torn down on exit."""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = args.workdir or tempfile.mkdtemp(prefix="rag-load-")
+        self._redis_process = None
+        self._server = None
+        self._chat = None
+        self.base_url = None
+
+    def __enter__(self):
+        from benchmarks.stubs import StubChatServer, install_stub_backends
+
+        configure_environment(self.workdir)
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(self.workdir, 'app.db')}"
+        os.environ["ADMIN_PASSWORD"] = self.args.admin_password
+        use_fakeredis = self._start_redis()
+
+        self._chat = StubChatServer(self.args.llm_latency_ms, self.args.llm_jitter_ms).__enter__()
+        # 以下模块在设置环境变量之后导入，Config 才会读到上面的地址和路径
+        install_stub_backends(self.args.dimension, self._chat.url)
+        if use_fakeredis:
+            import fakeredis
+            import redis
+            server = fakeredis.FakeServer()
+            redis.StrictRedis.from_url = classmethod(lambda cls, url, **kwargs: fakeredis.FakeStrictRedis(server=server))
+        from werkzeug.serving import make_server
+        from app import create_app
+        from app.init_db import init_db
+        from app.services.ingestion import IngestionWorker
+
+        init_db()
+        if not self.args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+        app = create_app()
+        app.config['UPLOAD_FOLDER'] = os.path.join(self.workdir, "uploads")
+        IngestionWorker(app).start()
+
+        port = _free_port()
+        self._server = make_server("127.0.0.1", port, app, threaded=True)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{port}"
+        return self
+
+    def _start_redis(self):
+        """Point REDIS_HOST/PORT at a Redis for this run. Returns True when fakeredis has to stand in."""
+        if self.args.redis_url:
+            url = httpx.URL(self.args.redis_url)
+            os.environ["REDIS_HOST"], os.environ["REDIS_PORT"] = url.host, str(url.port or 6379)
+            return False
+        if shutil.which("redis-server"):
+            port = _free_port()
+            self._redis_process = subprocess.Popen(
+                ["redis-server", "--port", str(port), "--save", "", "--appendonly", "no"],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            os.environ["REDIS_HOST"], os.environ["REDIS_PORT"] = "127.0.0.1", str(port)
+            for _ in range(50):
+                try:
+                    socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                    return False
+                except OSError:
+                    time.sleep(0.1)
+            raise RuntimeError("redis-server did not start")
+        try:
+            import fakeredis
+        except ImportError:
+            raise SystemExit("Install redis-server or fakeredis[lua], or pass --redis-url")
+        # 组织锁和导入队列用 Lua 脚本，fakeredis 没有 lupa 时 EVAL 不可用，压测结果会全是错误
+        try:
+            fakeredis.FakeStrictRedis(server=fakeredis.FakeServer()).eval("return 1", 0)
+        except Exception as e:
+            raise SystemExit(f"fakeredis cannot run Lua scripts ({e}); install fakeredis[lua] "
+                             f"or redis-server, or pass --redis-url")
+        return True
+
+    def __exit__(self, *exc):
+        if self._server is not None:
+            self._server.shutdown()
+        if self._chat is not None:
+            self._chat.__exit__(*exc)
+        if self._redis_process is not None:
+            self._redis_process.terminate()
+            self._redis_process.wait()
+        if not self.args.keep and not self.args.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class Stats:
+    """Latencies and outcomes per endpoint for one concurrency level."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.statuses = {}
+
+    def record(self, endpoint, seconds, status):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        self.statuses.setdefault(endpoint, {}).setdefault(str(status), 0)
+        self.statuses[endpoint][str(status)] += 1
+        if not isinstance(status, int) or status >= 400:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            errors = self.errors.get(endpoint, 0)
+            endpoints[endpoint] = {"requests": len(latencies), "requests_per_second": round(len(latencies) / elapsed, 2),
+                                   "error_rate": round(errors / len(latencies), 4), "statuses": self.statuses[endpoint],
+                                   **percentiles(latencies)}
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {"seconds": round(elapsed, 2), "requests": total, "requests_per_second": round(total / elapsed, 2),
+                "error_rate": round(sum(self.errors.values()) / total, 4) if total else 0.0, "endpoints": endpoints}
+
+
+async def timed(client, stats, endpoint, method, url, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+        status = response.status_code
+    except httpx.HTTPError as e:
+        response, status = None, type(e).__name__
+    stats.record(endpoint, time.perf_counter() - started, status)
+    return response
+
+
+def _auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def login(client, stats, username, password):
+    response = await timed(client, stats, "login", "POST", "/api/auth/login",
+                           json={"username": username, "password": password})
+    if response is None or response.status_code != 200:
+        return None
+    return response.json()["access_token"]
+
+
+def _document(rng, n_paragraphs=20):
+    paragraphs = [" ".join(rng.choice(WORDS) for _ in range(40)) for _ in range(n_paragraphs)]
+    return "\n\n".join(paragraphs).encode('utf-8')
+
+
+async def upload(client, stats, admin_token, organization_id, rng):
+    files = {"files": (f"load-{rng.randrange(10 ** 9)}.txt", _document(rng), "text/plain")}
+    return await timed(client, stats, "upload", "POST", f"/api/documents/organizations/{organization_id}/upload",
+                       headers=_auth(admin_token), files=files)
+
+
+async def provision(client, args, rng):
+    """Create organizations, users and one indexed seed document per organization through the API."""
+    stats = Stats()
+    admin_token = await login(client, stats, args.admin_user, args.admin_password)
+    if admin_token is None:
+        raise SystemExit("Admin login failed")
+    run_id = rng.randrange(10 ** 6)
+    users, job_ids = [], []
+    for o in range(args.organizations):
+        response = await timed(client, stats, "create_organization", "POST", "/api/admin/organizations",
+                               headers=_auth(admin_token), json={"name": f"Load Test {run_id} Org {o}"})
+        response.raise_for_status()
+        organization_id = response.json()["id"]
+        for u in range(args.users_per_organization):
+            username = f"load{run_id}_{o}_{u}"
+            password = f"Load-test-{run_id}-password!"
+            response = await timed(client, stats, "create_user", "POST", "/api/admin/users",
+                                   headers=_auth(admin_token),
+                                   json={"username": username, "email": f"{username}@example.com",
+                                         "password": password, "organization_id": organization_id})
+            response.raise_for_status()
+            users.append({"username": username, "password": password, "organization_id": organization_id})
+        response = await upload(client, stats, admin_token, organization_id, rng)
+        response.raise_for_status()
+        job_ids.extend(response.json()["job_ids"])
+
+    # 等种子文档建好索引，查询才有内容可检索
+    deadline = time.monotonic() + 300
+    pending = set(job_ids)
+    while pending and time.monotonic() < deadline:
+        for job_id in list(pending):
+            response = await client.get(f"/api/documents/jobs/{job_id}", headers=_auth(admin_token))
+            if response.status_code == 200 and response.json().get("status") in ("indexed", "failed", "cancelled"):
+                pending.discard(job_id)
+        await asyncio.sleep(0.5)
+    if pending:
+        logging.warning(f"{len(pending)} seed documents were not indexed in time")
+    return admin_token, users
+
+
+async def op_login(client, stats, user, state, rng):
+    token = await login(client, stats, user["username"], user["password"])
+    if token is not None:
+        state["token"] = token
+
+
+async def op_query(client, stats, user, state, rng):
+    question = "What about " + " ".join(rng.sample(WORDS, 3)) + f" {rng.randrange(10 ** 6)}?"
+    await timed(client, stats, "query", "POST", "/api/rag/query", headers=_auth(state["token"]),
+                json={"question": question})
+
+
+async def op_list_documents(client, stats, user, state, rng):
+    await timed(client, stats, "list_documents", "GET",
+                f"/api/documents/organizations/{user['organization_id']}/documents",
+                headers=_auth(state["admin_token"]))
+
+
+async def op_upload(client, stats, user, state, rng):
+    await upload(client, stats, state["admin_token"], user["organization_id"], rng)
+
+
+OPERATIONS = {"login": op_login, "query": op_query, "list_documents": op_list_documents, "upload": op_upload}
+
+
+async def virtual_user(client, stats, user, admin_token, weights, deadline, rng):
+    state = {"token": await login(client, stats, user["username"], user["password"]), "admin_token": admin_token}
+    names, name_weights = list(weights), list(weights.values())
+    while time.monotonic() < deadline:
+        if state["token"] is None:
+            await op_login(client, stats, user, state, rng)
+            continue
+        name = rng.choices(names, weights=name_weights)[0]
+        await OPERATIONS[name](client, stats, user, state, rng)
+
+
+async def run_level(base_url, args, concurrency, admin_token, users, weights, rng):
+    stats = Stats()
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        started = time.perf_counter()
+        deadline = time.monotonic() + args.duration
+        await asyncio.gather(*(virtual_user(client, stats, users[i % len(users)], admin_token, weights, deadline,
+                                            random.Random(rng.random()))
+                               for i in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return stats.report(elapsed)
+
+
+def print_level(concurrency, report):
+    print(f"\nconcurrency {concurrency}: {report['requests']} requests, {report['requests_per_second']} req/s, "
+          f"{report['error_rate'] * 100:.2f}% errors")
+    print(f"  {'endpoint':16} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>8}")
+    for endpoint, row in report["endpoints"].items():
+        print(f"  {endpoint:16} {row['requests_per_second']:>8} {row['p50_ms']:>9} {row['p95_ms']:>9} "
+              f"{row['p99_ms']:>9} {row['error_rate'] * 100:>7.2f}%")
+
+
+async def load_test(base_url, args):
+    weights = parse_mix(args.mix)
+    rng = random.Random(args.seed)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout) as client:
+        admin_token, users = await provision(client, args, rng)
+    levels = {}
+    for concurrency in args.concurrency:
+        report = await run_level(base_url, args, concurrency, admin_token, users, weights, rng)
+        print_level(concurrency, report)
+        levels[str(concurrency)] = report
+    return levels
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    parse_mix(args.mix)
+    report = {"started_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "git_commit": git_commit(),
+              "args": {k: v for k, v in vars(args).items() if k != "admin_password"}}
+    if args.base_url:
+        report["levels"] = asyncio.run(load_test(args.base_url, args))
+    else:
+        with LocalStack(args) as stack:
+            report["levels"] = asyncio.run(load_test(stack.base_url, args))
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"load-{time.strftime('%Y%m%d-%H%M%S')}-{report['git_commit'] or 'unknown'}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
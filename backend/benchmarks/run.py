@@ -0,0 +1,310 @@
+"""
+Offline benchmarks for RAGSystem ingestion and querying.
+
+Everything runs locally: embeddings come from a deterministic hash-based
+stub of the real dimension and the LLM is a stub chat-completions server
+with configurable latency, so results are repeatable and cost nothing.
+Each corpus size runs in a fresh subprocess so peak RSS is per size.
+
+Run from the backend directory:
+
+    python -m benchmarks.run --chunks 1000 10000 100000
+    python -m benchmarks.run --chunks 1000000 --queries 500 --skip-rebuild
+    python -m benchmarks.run --chunks 10000 --compare benchmarks/results/<earlier run>.json
+
+Results are written to benchmarks/results/ as JSON.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+ORGANIZATION_ID = 900001
+
+# 对比时展示的指标：(场景, 字段, 越大越好)
+KEY_METRICS = [
+    ("ingest", "chunks_per_second", True),
+    ("ingest", "p95_ms", False),
+    ("query", "queries_per_second", True),
+    ("query", "p50_ms", False),
+    ("query", "p95_ms", False),
+    ("query", "p99_ms", False),
+    ("query_batch", "queries_per_second", True),
+    ("remove", "p95_ms", False),
+    ("rebuild", "chunks_per_second", True),
+    ("process", "peak_rss_bytes", False),
+]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline RAGSystem benchmarks with stub embedding and LLM backends")
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 10000], help="corpus sizes in chunks")
+    parser.add_argument("--chunks-per-document", type=int, default=50)
+    parser.add_argument("--words-per-chunk", type=int, default=80)
+    parser.add_argument("--dimension", type=int, default=1024, help="embedding dimension (embedding-2 uses 1024)")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1, help="threads issuing queries")
+    parser.add_argument("--batch-size", type=int, default=50, help="questions per query_batch call")
+    parser.add_argument("--removals", type=int, default=20, help="documents removed in the remove scenario")
+    parser.add_argument("--llm-latency-ms", type=float, default=200)
+    parser.add_argument("--llm-jitter-ms", type=float, default=0)
+    parser.add_argument("--skip-rebuild", action="store_true", help="skip rebuild_index (it parses files with unstructured)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", help="directory for indexes and caches (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("--verbose", action="store_true", help="keep the application's INFO logging")
+    parser.add_argument("--single-size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def configure_environment(workdir):
+    """Point every on-disk path at workdir and lift the embedding rate limit; must run before importing app."""
+    os.environ["VECTORSTORE_FOLDER"] = os.path.join(workdir, "vectorstores")
+    os.environ["PARSE_CACHE_FOLDER"] = os.path.join(workdir, "parse_cache")
+    os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(workdir, "embedding_cache.sqlite3")
+    # 桩向量由 install_stub_backends 注册的 hash 提供方计算，模型名不同，不会与真实向量共用缓存条目
+    os.environ["EMBEDDING_PROVIDER"] = "hash"
+    os.environ.setdefault("EMBEDDING_RATE_LIMIT", "1000000")
+    os.environ.setdefault("EMBEDDING_RATE_BURST", "1000000")
+    os.makedirs(os.environ["VECTORSTORE_FOLDER"], exist_ok=True)
+
+
+def percentiles(seconds):
+    if not seconds:
+        return {}
+    ordered = sorted(seconds)
+
+    def at(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+    return {"p50_ms": at(0.50), "p95_ms": at(0.95), "p99_ms": at(0.99),
+            "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2), "max_ms": round(ordered[-1] * 1000, 2)}
+
+
+def peak_rss_bytes():
+    # Linux 上 ru_maxrss 的单位是 KB，macOS 上是字节
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def synthetic_corpus(n_chunks, chunks_per_document, words_per_chunk, seed):
+    """[(document_id, [chunk text, ...])] with a Zipf-like vocabulary and product codes, deterministic per seed."""
+    rng = random.Random(seed)
+    vocabulary = [f"term{i}" for i in range(20000)]
+    weights = [1.0 / (i + 1) for i in range(len(vocabulary))]
+    codes = [f"AB-{i:04d}" for i in range(2000)]
+    documents = []
+    chunk_number = 0
+    document_id = 1
+    while chunk_number < n_chunks:
+        texts = []
+        for _ in range(min(chunks_per_document, n_chunks - chunk_number)):
+            words = rng.choices(vocabulary, weights=weights, k=words_per_chunk)
+            words[rng.randrange(words_per_chunk)] = rng.choice(codes)
+            texts.append(" ".join(words))
+            chunk_number += 1
+        documents.append((document_id, texts))
+        document_id += 1
+    return documents
+
+
+def make_queries(documents, n, seed):
+    rng = random.Random(seed + 1)
+    queries = []
+    for _ in range(n):
+        _, texts = rng.choice(documents)
+        words = rng.choice(texts).split(" ")
+        start = rng.randrange(max(1, len(words) - 6))
+        queries.append("What does the documentation say about " + " ".join(words[start:start + 6]) + "?")
+    return queries
+
+
+def run_size(n_chunks, args, workdir):
+    """Run every scenario for one corpus size in this process and return the results."""
+    configure_environment(workdir)
+    # 以下模块在设置环境变量之后导入，Config 才会读到上面的路径
+    from benchmarks.stubs import StubChatServer, install_stub_backends
+    from app.services import rag_service
+    from app.services.leak_filter import LeakFilter
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    # 泄露过滤器需要数据库，这里换成固定的组织列表
+    leak_filter = LeakFilter([(ORGANIZATION_ID, "Benchmark Organization")] +
+                             [(i, f"Competitor {i}") for i in range(1, 51)])
+    rag_service.get_leak_filter = lambda: leak_filter
+
+    documents = synthetic_corpus(n_chunks, args.chunks_per_document, args.words_per_chunk, args.seed)
+    queries = make_queries(documents, args.queries, args.seed)
+    results = {"chunks": n_chunks, "documents": len(documents)}
+
+    with StubChatServer(args.llm_latency_ms, args.llm_jitter_ms) as server:
+        install_stub_backends(args.dimension, server.url)
+        rag_system = rag_service.RAGSystem(ORGANIZATION_ID)
+
+        # 与 ingestion worker 一样，每个文档写入后按需压缩
+        latencies, compactions = [], []
+        started = time.perf_counter()
+        for document_id, texts in documents:
+            elements = [{"text": text, "category": "NarrativeText"} for text in texts]
+            t = time.perf_counter()
+            rag_system.add_document(f"{document_id}.txt", document_id, elements=elements)
+            latencies.append(time.perf_counter() - t)
+            if rag_system.needs_compaction():
+                t = time.perf_counter()
+                rag_system.compact_index()
+                compactions.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - started
+        results["ingest"] = {"seconds": round(elapsed, 3), "chunks_per_second": round(n_chunks / elapsed, 1),
+                             "documents_per_second": round(len(documents) / elapsed, 2), **percentiles(latencies),
+                             "compactions": len(compactions), "compaction_seconds": round(sum(compactions), 3),
+                             "peak_rss_bytes": peak_rss_bytes()}
+        results["index"] = rag_system.index_info()
+
+        latencies = []
+
+        def timed_query(question):
+            t = time.perf_counter()
+            rag_system.query(question)
+            latencies.append(time.perf_counter() - t)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            list(pool.map(timed_query, queries))
+        elapsed = time.perf_counter() - started
+        results["query"] = {"queries": len(queries), "concurrency": args.concurrency,
+                            "queries_per_second": round(len(queries) / elapsed, 2), **percentiles(latencies),
+                            "peak_rss_bytes": peak_rss_bytes()}
+
+        # 使用不同的问题，避免查询向量缓存让批量查询显得更快
+        batch_queries = make_queries(documents, args.queries, args.seed + 1000)
+        latencies = []
+        started = time.perf_counter()
+        for i in range(0, len(batch_queries), args.batch_size):
+            t = time.perf_counter()
+            rag_system.query_batch(batch_queries[i:i + args.batch_size])
+            latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - started
+        results["query_batch"] = {"queries": len(batch_queries), "batch_size": args.batch_size,
+                                  "queries_per_second": round(len(batch_queries) / elapsed, 2),
+                                  **percentiles(latencies)}
+
+        latencies = []
+        for document_id, _ in random.Random(args.seed + 2).sample(documents, min(args.removals, len(documents))):
+            t = time.perf_counter()
+            rag_system.remove_document(document_id)
+            latencies.append(time.perf_counter() - t)
+        results["remove"] = {"documents": len(latencies), **percentiles(latencies)}
+
+        if not args.skip_rebuild:
+            document_dir = os.path.join(workdir, "documents")
+            os.makedirs(document_dir, exist_ok=True)
+            paths = []
+            for document_id, texts in documents:
+                path = os.path.join(document_dir, f"{document_id}.txt")
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write("\n\n".join(texts))
+                paths.append((document_id, path))
+            started = time.perf_counter()
+            summary = rag_system.rebuild_index(paths)
+            elapsed = time.perf_counter() - started
+            results["rebuild"] = {"seconds": round(elapsed, 3), "chunks": summary["chunks"],
+                                  "chunks_per_second": round(summary["chunks"] / elapsed, 1),
+                                  "failed": len(summary["failed"]), "peak_rss_bytes": peak_rss_bytes()}
+
+        results["llm_requests"] = server.requests
+
+    results["process"] = {"peak_rss_bytes": peak_rss_bytes()}
+    return results
+
+
+def compare(current, previous):
+    """Print the key metrics of both runs side by side, per corpus size."""
+    print(f"\nCompared with {previous.get('started_at')} ({previous.get('git_commit')})")
+    for size, result in current["results"].items():
+        before = previous.get("results", {}).get(size)
+        if before is None:
+            continue
+        print(f"\n{size} chunks")
+        for scenario, field, higher_is_better in KEY_METRICS:
+            new, old = result.get(scenario, {}).get(field), before.get(scenario, {}).get(field)
+            if new is None or old is None:
+                continue
+            change = (new - old) / old * 100 if old else 0.0
+            better = (change > 0) == higher_is_better
+            verdict = "" if abs(change) < 5 else ("better" if better else "WORSE")
+            print(f"  {scenario + '.' + field:32} {old:>14} -> {new:>14}  {change:+7.1f}%  {verdict}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.single_size is not None:
+        # 子进程：只跑一个规模，结果写入父进程指定的文件
+        results = run_size(args.single_size, args, args.workdir)
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump(results, f)
+        return
+
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("single_size", "result_file")},
+        "results": {},
+    }
+    for n_chunks in args.chunks:
+        workdir = os.path.join(args.workdir, str(n_chunks)) if args.workdir else tempfile.mkdtemp(prefix="rag-bench-")
+        os.makedirs(workdir, exist_ok=True)
+        result_file = os.path.join(workdir, "result.json")
+        print(f"Benchmarking {n_chunks} chunks in {workdir}", flush=True)
+        try:
+            command = [sys.executable, "-m", "benchmarks.run", *(argv if argv is not None else sys.argv[1:]),
+                       "--single-size", str(n_chunks), "--workdir", workdir, "--result-file", result_file]
+            subprocess.run(command, check=True)
+            with open(result_file, encoding='utf-8') as f:
+                result = json.load(f)
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+        report["results"][str(n_chunks)] = result
+        print(json.dumps(result, indent=2), flush=True)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{report['git_commit'] or 'unknown'}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
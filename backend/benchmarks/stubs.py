@@ -0,0 +1,128 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from langchain_core.embeddings import Embeddings
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+
+_TOKEN = re.compile(r'\w+')
+
+
+class HashEmbeddings(Embeddings):
+    """
+    Deterministic local stand-in for the embedding API: feature hashing of
+    the text's words into `dimension` signed buckets, L2-normalized. Texts
+    that share words get similar vectors, so retrieval behaves plausibly,
+    and the same text always gets the same vector across runs.
+    """
+
+    def __init__(self, dimension=1024):
+        self.dimension = dimension
+
+    def _embed(self, text):
+        vector = [0.0] * self.dimension
+        for token in _TOKEN.findall(text.lower()):
+            digest = hashlib.blake2b(token.encode('utf-8'), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], 'little') % self.dimension
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+def install_stub_backends(dimension, llm_url):
+    """
+    Register HashEmbeddings as the "hash" embedding provider and route chat
+    calls to the local stub; call before any RAGSystem is created. The
+    provider is driven like the remote API (batched, concurrent, rate
+    limited) so the pipeline overhead shows up in the results.
+    """
+    from app.services import rag_service
+    from app.services.embedding_providers import EmbeddingProvider, register_provider
+    register_provider("hash", lambda: EmbeddingProvider("hash", f"benchmark-hash-{dimension}",
+                                                        HashEmbeddings(dimension)))
+    rag_service.API_URL = llm_url
+
+
+class _ChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        answer = server.answer
+        latency = max(0.0, random.gauss(server.latency, server.jitter)) if server.jitter else server.latency
+
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            words = answer.split(" ")
+            for i, word in enumerate(words):
+                # 首个 token 之前等待一半延迟，其余均匀分布在各 token 之间
+                time.sleep(latency / 2 if i == 0 else latency / 2 / len(words))
+                piece = word if i == 0 else " " + word
+                chunk = {"choices": [{"delta": {"content": piece}}]}
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.close_connection = True
+            return
+
+        time.sleep(latency)
+        payload = json.dumps({"choices": [{"message": {"role": "assistant", "content": answer}}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubChatServer:
+    """
+    Local chat-completions endpoint in a background thread. Replies after
+    `latency_ms` (normally distributed with `jitter_ms`), as one JSON body
+    or as a server-sent event stream when the request sets "stream".
+    """
+
+    def __init__(self, latency_ms=200, jitter_ms=0, answer=None, host="127.0.0.1", port=0):
+        self.httpd = ThreadingHTTPServer((host, port), _ChatHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.latency = latency_ms / 1000
+        self.httpd.jitter = jitter_ms / 1000
+        self.httpd.answer = answer or ("Based on the available information, the requested product details "
+                                       "are described in the provided documents.")
+        self.httpd.lock = threading.Lock()
+        self.httpd.requests = 0
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -13,4 +13,92 @@ class Config:
     # Redis 配置
     REDIS_HOST = os.environ.get('REDIS_HOST', 'redis')
     REDIS_PORT = int(os.environ.get('REDIS_PORT', 6379))
-    REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/0"
\ No newline at end of file
+    REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/0"
+
+    # 向量库配置
+    VECTORSTORE_FOLDER = os.environ.get('VECTORSTORE_FOLDER', '/app/vectorstores')
+    RAG_CACHE_MAX_ORGANIZATIONS = int(os.environ.get('RAG_CACHE_MAX_ORGANIZATIONS', 32))  # 进程内最多缓存的组织数
+    RAG_CACHE_MEMORY_BUDGET_MB = int(os.environ.get('RAG_CACHE_MEMORY_BUDGET_MB', 1024))  # 缓存索引的总内存预算
+
+    PARSE_CACHE_FOLDER = os.environ.get('PARSE_CACHE_FOLDER', os.path.join(VECTORSTORE_FOLDER, 'parse_cache'))  # 文档解析结果缓存
+
+    # 后台导入配置
+    BACKGROUND_SERVICES = os.environ.get('BACKGROUND_SERVICES', 'false').lower() == 'true'  # flask run 时启动导入任务线程和模型预热，由 start.sh 设置
+    INGESTION_WORKER_THREADS = int(os.environ.get('INGESTION_WORKER_THREADS', 2))  # 0 表示本进程不处理导入任务
+    PARSE_PROCESSES = int(os.environ.get('PARSE_PROCESSES', 2))  # 文档解析进程数
+    INGESTION_LOCK_TIMEOUT = int(os.environ.get('INGESTION_LOCK_TIMEOUT', 1800))  # 组织写锁超时（秒）
+
+    # Embedding 配置
+    EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'embedding-2')
+    EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', os.path.join(VECTORSTORE_FOLDER, 'embedding_cache.sqlite3'))
+    EMBEDDING_CACHE_MAX_ENTRIES = int(os.environ.get('EMBEDDING_CACHE_MAX_ENTRIES', 500000))
+    QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get('QUERY_EMBEDDING_CACHE_SIZE', 10000))  # 进程内问题向量 LRU 大小
+    EMBEDDING_PROVIDER = os.environ.get('EMBEDDING_PROVIDER', 'zhipuai')  # zhipuai（远程接口）或 onnx（本地 CPU 模型）
+    EMBEDDING_PROVIDER_OVERRIDES = os.environ.get('EMBEDDING_PROVIDER_OVERRIDES', '')  # 按组织指定，如 "3=onnx,7=zhipuai"
+    EMBEDDING_API_KEY = os.environ.get('EMBEDDING_API_KEY', '')  # 为空时使用 LLM 的 API_KEY
+    EMBEDDING_WARMUP = os.environ.get('EMBEDDING_WARMUP', 'true').lower() == 'true'  # 启动时预热本地模型
+    ONNX_EMBEDDING_MODEL_DIR = os.environ.get('ONNX_EMBEDDING_MODEL_DIR', '/app/models/embedding')  # 含 model.onnx 和 tokenizer.json
+    ONNX_EMBEDDING_THREADS = int(os.environ.get('ONNX_EMBEDDING_THREADS', 0))  # 推理线程数，0 表示使用全部核心
+    ONNX_EMBEDDING_BATCH_SIZE = int(os.environ.get('ONNX_EMBEDDING_BATCH_SIZE', 32))
+    ONNX_EMBEDDING_MAX_LENGTH = int(os.environ.get('ONNX_EMBEDDING_MAX_LENGTH', 512))  # 超出的 token 被截断
+    ONNX_EMBEDDING_POOLING = os.environ.get('ONNX_EMBEDDING_POOLING', 'cls')  # cls 或 mean，取决于模型
+    EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 32))  # 每次请求嵌入的文本块数
+    EMBEDDING_MAX_CONCURRENCY = int(os.environ.get('EMBEDDING_MAX_CONCURRENCY', 4))  # 同时进行的批次数
+    EMBEDDING_RATE_LIMIT = float(os.environ.get('EMBEDDING_RATE_LIMIT', 5))  # 每秒请求数
+    EMBEDDING_RATE_BURST = int(os.environ.get('EMBEDDING_RATE_BURST', 10))
+    EMBEDDING_MAX_RETRIES = int(os.environ.get('EMBEDDING_MAX_RETRIES', 5))
+
+    # LLM 接口配置
+    LLM_POOL_SIZE = int(os.environ.get('LLM_POOL_SIZE', 20))  # 连接池大小
+    LLM_CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT', 5))  # 秒
+    LLM_READ_TIMEOUT = float(os.environ.get('LLM_READ_TIMEOUT', 120))  # 秒
+    LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 3))  # 429/5xx 及建立连接失败的重试次数；读超时不重试
+    LLM_REQUEST_DEADLINE = float(os.environ.get('LLM_REQUEST_DEADLINE', 180))  # 一次调用含重试的总时间上限，秒
+    LLM_BACKOFF_BASE = float(os.environ.get('LLM_BACKOFF_BASE', 0.5))  # 秒
+    LLM_BACKOFF_MAX = float(os.environ.get('LLM_BACKOFF_MAX', 10))  # 秒
+
+    # 组织信息泄漏检查
+    LEAK_FILTER_REFRESH_SECONDS = int(os.environ.get('LEAK_FILTER_REFRESH_SECONDS', 30))  # 检查其他进程是否更新了组织列表的间隔
+    LEAK_FILTER_MIN_NAME_LENGTH = int(os.environ.get('LEAK_FILTER_MIN_NAME_LENGTH', 3))  # 过短的组织名称不参与匹配
+    LEAK_FILTER_IGNORED_NAMES = os.environ.get('LEAK_FILTER_IGNORED_NAMES', 'Default Organization')  # 逗号分隔，过于常见的名称不参与匹配
+
+    # FAISS 索引配置：语料较小时用精确的 Flat 索引，超过阈值后改用 IVF 或 HNSW
+    FAISS_FLAT_MAX_VECTORS = int(os.environ.get('FAISS_FLAT_MAX_VECTORS', 20000))
+    FAISS_INDEX_TYPE = os.environ.get('FAISS_INDEX_TYPE', 'ivf')  # ivf 或 hnsw
+    FAISS_QUANTIZATION = os.environ.get('FAISS_QUANTIZATION', 'none')  # none、sq8（4 倍压缩）或 pq
+    FAISS_PQ_M = int(os.environ.get('FAISS_PQ_M', 0))  # PQ 子量化器个数，0 表示维度的 1/4（16 倍压缩）
+    FAISS_NPROBE = int(os.environ.get('FAISS_NPROBE', 16))  # IVF 每次查询扫描的聚类数
+    FAISS_HNSW_M = int(os.environ.get('FAISS_HNSW_M', 32))
+    FAISS_EF_CONSTRUCTION = int(os.environ.get('FAISS_EF_CONSTRUCTION', 200))
+    FAISS_EF_SEARCH = int(os.environ.get('FAISS_EF_SEARCH', 64))
+    FAISS_MMAP = os.environ.get('FAISS_MMAP', 'true').lower() == 'true'  # 以只读内存映射方式加载索引，worker 进程间共享
+    FAISS_COMPACT_RATIO = float(os.environ.get('FAISS_COMPACT_RATIO', 0.2))  # 墓碑占比超过该值时压缩索引
+    LSM_MAX_DELTA_SEGMENTS = int(os.environ.get('LSM_MAX_DELTA_SEGMENTS', 8))  # 增量段超过该数量时合并其中相邻的几个
+    LSM_MERGE_FACTOR = int(os.environ.get('LSM_MERGE_FACTOR', 4))  # 每次合并的增量段数
+    LSM_FILE_GRACE_SECONDS = int(os.environ.get('LSM_FILE_GRACE_SECONDS', 600))  # 合并后旧段文件保留的秒数，供其他进程读完
+
+    # 混合检索配置（向量 + BM25，倒数排名融合）
+    HYBRID_SEARCH = os.environ.get('HYBRID_SEARCH', 'true').lower() == 'true'
+    RETRIEVAL_CANDIDATES = int(os.environ.get('RETRIEVAL_CANDIDATES', 20))  # 每路检索参与融合的候选数
+    RRF_K = int(os.environ.get('RRF_K', 60))
+    BM25_K1 = float(os.environ.get('BM25_K1', 1.5))
+    BM25_B = float(os.environ.get('BM25_B', 0.75))
+
+    # 提示词上下文组装配置
+    CONTEXT_CANDIDATES = int(os.environ.get('CONTEXT_CANDIDATES', 10))  # 检索后参与筛选的文本块数
+    CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 2000))  # 上下文最多占用的 token 数（估算）
+    CONTEXT_MMR_LAMBDA = float(os.environ.get('CONTEXT_MMR_LAMBDA', 0.7))  # 1 只看相关性，0 只看多样性
+    CONTEXT_DUPLICATE_THRESHOLD = float(os.environ.get('CONTEXT_DUPLICATE_THRESHOLD', 0.95))  # 余弦相似度不低于该值视为重复
+
+    # 批量查询配置
+    BATCH_QUERY_MAX_QUESTIONS = int(os.environ.get('BATCH_QUERY_MAX_QUESTIONS', 500))  # 单次请求最多的问题数
+    BATCH_QUERY_MAX_CONCURRENCY = int(os.environ.get('BATCH_QUERY_MAX_CONCURRENCY', 8))  # 同时进行的 LLM 调用数
+
+    # 监控指标配置
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # 非空时 /metrics 要求 "Authorization: Bearer <token>"
+
+    PRINCIPAL_CACHE_TTL = int(os.environ.get('PRINCIPAL_CACHE_TTL', 30))  # 秒；令牌声明不可用时从数据库加载的用户信息的缓存时间
+
+    # 答案缓存配置（存储在 Redis 中）
+    ANSWER_CACHE_TTL = int(os.environ.get('ANSWER_CACHE_TTL', 3600))  # 秒
+    ANSWER_CACHE_SIMILARITY_THRESHOLD = float(os.environ.get('ANSWER_CACHE_SIMILARITY_THRESHOLD', 0))  # 余弦相似度阈值，0 表示只做精确匹配
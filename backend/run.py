@@ -1,9 +1,28 @@
 from app import create_app
 from app.extensions import db
+from app.services.ingestion import IngestionWorker
+from app.services.embedding_providers import warm_up_providers
+import threading
 
 app = create_app()
 
+
+def start_background_services(app):
+    """Start the ingestion worker threads and the embedding warm-up; only the process serving requests does this."""
+    if app.config['INGESTION_WORKER_THREADS'] > 0:
+        IngestionWorker(app).start()
+
+    if app.config['EMBEDDING_WARMUP']:
+        # 在后台加载本地向量模型并完成首次推理，不阻塞启动
+        threading.Thread(target=warm_up_providers, name="embedding-warmup", daemon=True).start()
+
+
 if __name__ == '__main__':
+    start_background_services(app)
     with app.app_context():
         db.create_all()
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000)
+elif app.config['BACKGROUND_SERVICES'] and __name__ != '__mp_main__':
+    # flask 的各个命令都会导入本文件，解析子进程（spawn）也会以 __mp_main__ 重新导入，
+    # 只有设置了 BACKGROUND_SERVICES 的 flask run 才启动后台服务
+    start_background_services(app)
\ No newline at end of file
@@ -5,4 +5,4 @@ echo "Running database initialization..."
 python -m app.init_db
 
 echo "Starting Flask application..."
-flask run --host=0.0.0.0
\ No newline at end of file
+BACKGROUND_SERVICES=true exec flask run --host=0.0.0.0
\ No newline at end of file